@@ -0,0 +1,607 @@
+import time
+import math
+import copy
+from typing import List
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from peft import LoraConfig, get_peft_model
+
+from sklearn.metrics import roc_auc_score
+from training import (apply_defaults, load_baseline_kcs, get_baseline_model, get_baseline_fns, compute_baseline_loss, check_stack_args,
+                      get_stacked_losses, get_lmkt_loss_packed, get_lmkt_loss_unpacked, BASELINE_MODELS, NON_FLAT_KC_ARCH, STACKABLE_BASELINES)
+from data_loading import load_annotated_data, get_default_fold
+from kt_data_loading import (DKTDataset, DKTCollator, LMKTDatasetPacked, LMKTCollatorPacked, LMKTDatasetUnpacked, LMKTCollatorUnpacked,
+                             LMKTCollatorIncremental, get_dataloader)
+from prompting import get_true_false_tokens
+from models import simplekt
+from models.simplekt import simpleKT
+from models.kv_cache import get_incremental_model
+from models.packed_lstm import dkt_forward, run_lstm, get_lstm_plan, MIN_SEGMENTED_SEQ_LEN
+from models.stacked_dkt import StackedDKT, StackedAdamW
+from models.dkt_sem import ALT_ARCH
+from models.streaming import step_sessions
+from models.lm import get_model, get_tiny_random_model, release_model, on_cpu, LORA_TARGET_MODULES
+from models.lm_inference import LMKTIncrementalEngine, LMKTPrefixCache
+from utils import initialize_seeds, device
+
+def run_train_epoch(run_model, loss_fn, optimizer, dataloader, args):
+    # Returns time taken and average loss for one training epoch
+    start_time = time.perf_counter()
+    total_loss = 0
+    for batch in dataloader:
+        loss = compute_baseline_loss(run_model, batch, args, loss_fn)[0]
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        total_loss += loss.item()
+    return time.perf_counter() - start_time, total_loss / len(dataloader)
+
+def benchmark_compile(args):
+    """
+    Compare eager and compiled training throughput of a baseline model on the training set
+    Each mode starts with an untimed warmup epoch, which for the compiled model includes compiling every length bucket
+    """
+    assert args.model_type in BASELINE_MODELS
+    kc_dict, kc_emb_matrix, sbert_model = load_baseline_kcs(args)
+    train_df, _, _ = load_annotated_data(args, get_default_fold(args))
+    dataset = DKTDataset(train_df, kc_dict, kc_emb_matrix, sbert_model)
+    num_turns = sum(len(sample["labels"]) for sample in dataset.data)
+    flatten_kcs = args.model_type not in NON_FLAT_KC_ARCH
+    for compile_model in [False, True]:
+        args.compile = compile_model
+        initialize_seeds(221)
+        model = get_baseline_model(kc_dict, kc_emb_matrix, args)
+        model.train()
+        run_model, loss_fn = get_baseline_fns(model, args)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.wd)
+        dataloader = get_dataloader(dataset, DKTCollator(flatten_kcs, compile_model), args.batch_size, True)
+        warmup_time, _ = run_train_epoch(run_model, loss_fn, optimizer, dataloader, args)
+        epoch_times = []
+        for _ in range(args.benchmark_epochs):
+            epoch_time, loss = run_train_epoch(run_model, loss_fn, optimizer, dataloader, args)
+            epoch_times.append(epoch_time)
+        epoch_time = sum(epoch_times) / len(epoch_times)
+        print(f"{'Compiled' if compile_model else 'Eager'} {args.model_type} - warmup epoch: {warmup_time:.2f}s, "
+              f"epoch: {epoch_time:.2f}s, {len(dataset) / epoch_time:.1f} dialogues/s, {num_turns / epoch_time:.1f} turns/s, "
+              f"final loss: {loss:.4f}")
+
+def reference_nopeek_mask(seqlen, mask, device):
+    # Mask construction from the original pykt implementation, rebuilt on every call
+    nopeek_mask = np.triu(np.ones((1, 1, seqlen, seqlen)), k=mask).astype("uint8")
+    return (torch.from_numpy(nopeek_mask) == 0).to(device)
+
+def reference_attention(q, k, v, d_k, mask, dropout, zero_pad):
+    # Unfused attention from the original pykt implementation
+    scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(d_k)
+    bs, head, seqlen = scores.size(0), scores.size(1), scores.size(2)
+    scores.masked_fill_(mask == 0, -1e32)
+    scores = F.softmax(scores, dim=-1)
+    if zero_pad:
+        pad_zero = torch.zeros(bs, head, 1, seqlen).to(device)
+        scores = torch.cat([pad_zero, scores[:, :, 1:, :]], dim=2)
+    scores = dropout(scores)
+    return torch.matmul(scores, v)
+
+def run_simplekt(model, batch, backward: bool):
+    preds = model({
+        "qseqs": batch[0][:, :-1], "cseqs": batch[0][:, :-1], "rseqs": batch[1][:, :-1],
+        "shft_qseqs": batch[0][:, 1:], "shft_cseqs": batch[0][:, 1:], "shft_rseqs": batch[1][:, 1:]
+    })
+    if backward:
+        preds.sum().backward()
+    return preds
+
+def time_steps(step_fn, num_steps: int):
+    # Seconds per step after one warmup step
+    step_fn()
+    start_time = time.perf_counter()
+    for _ in range(num_steps):
+        step_fn()
+    return (time.perf_counter() - start_time) / num_steps
+
+def benchmark_attention(args):
+    """
+    Check that simpleKT with fused attention and cached masks matches the original attention implementation,
+    then compare inference (forward) and training (forward + backward) throughput of both at increasing sequence lengths
+    """
+    assert args.model_type == "simplekt"
+    seq_lens = [128, 256, 512, 1024]
+    num_kcs = 100
+    initialize_seeds(221)
+    model = simpleKT(num_kcs, num_kcs, args.emb_size, 4, 0.2, d_ff=args.emb_size, final_fc_dim=args.emb_size,
+                     final_fc_dim2=args.emb_size, seq_len=max(seq_lens) + 1).to(device)
+    implementations = {
+        "fused": (simplekt.attention, simplekt.get_nopeek_mask),
+        "reference": (reference_attention, reference_nopeek_mask)
+    }
+    for seq_len in seq_lens:
+        batch = (torch.randint(0, num_kcs, (args.batch_size, seq_len + 1), device=device),
+                 torch.randint(0, 2, (args.batch_size, seq_len + 1), device=device))
+        preds = {}
+        inference_time = {}
+        train_time = {}
+        for name, (attention_fn, mask_fn) in implementations.items():
+            simplekt.attention, simplekt.get_nopeek_mask = attention_fn, mask_fn
+            model.eval()
+            with torch.no_grad():
+                preds[name] = run_simplekt(model, batch, False)
+                inference_time[name] = time_steps(lambda: run_simplekt(model, batch, False), args.benchmark_epochs)
+            model.train()
+            train_time[name] = time_steps(lambda: run_simplekt(model, batch, True), args.benchmark_epochs)
+        simplekt.attention, simplekt.get_nopeek_mask = implementations["fused"]
+        max_diff = (preds["fused"] - preds["reference"]).abs().max().item()
+        if max_diff > 1e-5:
+            raise Exception(f"Fused attention differs from reference at length {seq_len}: {max_diff}")
+        print(f"Length {seq_len} - max diff: {max_diff:.2e}")
+        for mode, mode_time in [("inference", inference_time), ("training", train_time)]:
+            print(f"    {mode} - reference: {args.batch_size / mode_time['reference']:.1f} seqs/s, "
+                  f"fused: {args.batch_size / mode_time['fused']:.1f} seqs/s, speedup: {mode_time['reference'] / mode_time['fused']:.2f}x")
+
+def run_full_sequence(model, kc_ids, labels, model_type: str):
+    # Outputs for every position of the flat sequence (B x L x K(all)), aligned with incremental steps
+    if model_type == "akt":
+        return model(kc_ids, labels, kc_ids)[0]
+    if model_type == "saint":
+        return model(kc_ids, kc_ids, labels[:, :-1])
+    # simpleKT concatenates the first unshifted position with the shifted sequence, which also supports length 1
+    return model({
+        "qseqs": kc_ids[:, :1], "cseqs": kc_ids[:, :1], "rseqs": labels[:, :1],
+        "shft_qseqs": kc_ids[:, 1:], "shft_cseqs": kc_ids[:, 1:], "shft_rseqs": labels[:, 1:]
+    })
+
+def run_online(model, kc_ids, labels, model_type: str, cached: bool):
+    # Predict at each position after appending it, either with cached inference or recomputing the full prefix
+    if cached:
+        incremental = get_incremental_model(model)
+        return torch.stack([incremental.step(kc_ids[:, t], labels[:, t]) for t in range(kc_ids.shape[1])], dim=1)
+    return torch.stack([
+        run_full_sequence(model, kc_ids[:, :t + 1], labels[:, :t + 1], model_type)[:, -1] for t in range(kc_ids.shape[1])
+    ], dim=1)
+
+def benchmark_kv_cache(args):
+    """
+    Check that cached incremental inference matches the full-sequence forward at every position,
+    then compare per-prediction latency of online inference with the cache and with recomputing the full prefix
+    """
+    assert args.model_type in ("simplekt", "akt", "saint")
+    seq_lens = [50, 100, 200] # simpleKT positional embeddings only cover 200 positions
+    num_kcs = 100
+    initialize_seeds(221)
+    model = get_baseline_model({str(kc_idx): kc_idx for kc_idx in range(num_kcs)}, None, args)
+    model.eval()
+    for seq_len in seq_lens:
+        kc_ids = torch.randint(0, num_kcs, (args.batch_size, seq_len), device=device)
+        labels = torch.randint(0, 2, (args.batch_size, seq_len), device=device)
+        with torch.no_grad():
+            full_preds = run_full_sequence(model, kc_ids, labels, args.model_type)
+            max_diff = (full_preds - run_online(model, kc_ids, labels, args.model_type, True)).abs().max().item()
+            if max_diff > 1e-5:
+                raise Exception(f"Cached inference differs from full forward at length {seq_len}: {max_diff}")
+            recompute_time = time_steps(lambda: run_online(model, kc_ids, labels, args.model_type, False), args.benchmark_epochs) / seq_len
+            cached_time = time_steps(lambda: run_online(model, kc_ids, labels, args.model_type, True), args.benchmark_epochs) / seq_len
+        print(f"Length {seq_len} - max diff: {max_diff:.2e}, per-prediction latency - recompute: {recompute_time * 1000:.2f}ms, "
+              f"cached: {cached_time * 1000:.2f}ms, speedup: {recompute_time / cached_time:.2f}x")
+
+def run_lstm_baseline(model, batch, args, packed: bool):
+    # Outputs for all KCs at every step, running the LSTM over all padded steps or length-sorted segments
+    if args.model_type == "dkt":
+        return dkt_forward(model, batch["kc_ids_flat"], batch["labels_flat"], batch["flat_lens"] if packed else None)
+    return model(batch if packed else {key: val for key, val in batch.items() if key != "seq_lens"})
+
+def run_lstm_baseline_epoch(model, batches, args, packed: bool, backward: bool):
+    for batch in batches:
+        preds = run_lstm_baseline(model, batch, args, packed)
+        if backward:
+            preds.sum().backward()
+
+PACKED_SYNTHETIC_LENS = [32, 64, 128, 256] # Batches of 16 steps or fewer are never split, see MIN_SEGMENT_LEN
+PACKED_SYNTHETIC_BATCH_SIZE = 64
+
+def benchmark_packed(args):
+    """
+    Check that length-sorted LSTM execution matches padded execution at all valid steps of the training set, which has skewed dialogue lengths,
+    then compare inference (forward) and training (forward + backward) epoch times of both
+    Dialogue batches are usually shorter than MIN_SEGMENTED_SEQ_LEN, so longer synthetic batches are also checked and timed
+    """
+    assert args.model_type in ("dkt-multi", "dkt-sem", "dkt")
+    kc_dict, kc_emb_matrix, sbert_model = load_baseline_kcs(args)
+    train_df, _, _ = load_annotated_data(args, get_default_fold(args))
+    dataset = DKTDataset(train_df, kc_dict, kc_emb_matrix, sbert_model)
+    lens_key = "flat_lens" if args.model_type == "dkt" else "seq_lens"
+    seq_lens = dataset.tensors[lens_key].type(torch.float)
+    initialize_seeds(221)
+    batches = list(get_dataloader(dataset, DKTCollator(args.model_type not in NON_FLAT_KC_ARCH), args.batch_size, True))
+    num_padded_steps = sum(len(batch[lens_key]) * batch[lens_key].max().item() for batch in batches)
+    print(f"Sequence lengths - min: {seq_lens.min():.0f}, median: {seq_lens.median():.0f}, mean: {seq_lens.mean():.1f}, "
+          f"max: {seq_lens.max():.0f}, padding: {1 - seq_lens.sum().item() / num_padded_steps:.1%} of padded steps")
+
+    model = get_baseline_model(kc_dict, kc_emb_matrix, args)
+    model.eval()
+    max_diff = 0
+    with torch.no_grad():
+        for batch in batches:
+            mask = torch.arange(batch["labels_flat" if args.model_type == "dkt" else "labels"].shape[1], device=device) < batch[lens_key].unsqueeze(1)
+            preds_diff = run_lstm_baseline(model, batch, args, True) - run_lstm_baseline(model, batch, args, False)
+            max_diff = max(max_diff, preds_diff[mask].abs().max().item())
+    if max_diff > 1e-5:
+        raise Exception(f"Length-sorted LSTM outputs differ from padded: {max_diff}")
+    num_segmented = sum(get_lstm_plan(batch[lens_key], batch[lens_key].max().item()) is not None for batch in batches)
+    print(f"Max diff at valid steps: {max_diff:.2e}, {num_segmented} / {len(batches)} batches segmented "
+          f"(batches shorter than {MIN_SEGMENTED_SEQ_LEN} steps run in a single call in both modes)")
+
+    for mode, backward in [("inference", False), ("training", True)]:
+        model.train(backward)
+        epoch_time = {}
+        for packed in [False, True]:
+            with torch.set_grad_enabled(backward):
+                epoch_time[packed] = time_steps(lambda: run_lstm_baseline_epoch(model, batches, args, packed, backward), args.benchmark_epochs)
+        print(f"{mode} - padded: {epoch_time[False]:.2f}s/epoch, length-sorted: {epoch_time[True]:.2f}s/epoch, "
+              f"speedup: {epoch_time[False] / epoch_time[True]:.2f}x")
+    benchmark_packed_synthetic(model.lstm_layer, args)
+
+def get_skewed_lens(batch_size: int, max_seq_len: int):
+    # Skewed lengths like dialogue data, where most sequences are much shorter than the longest one
+    seq_lens = (torch.rand(batch_size) ** 3 * max_seq_len).ceil().long().clamp(min=2)
+    seq_lens[0] = max_seq_len
+    return seq_lens.to(device)
+
+def benchmark_packed_synthetic(lstm, args):
+    """
+    Check length-sorted execution against padded execution on batches with skewed synthetic lengths, segmenting at every length,
+    and compare training step times of both to show from which batch length segmenting pays off (see MIN_SEGMENTED_SEQ_LEN)
+    """
+    lstm.train()
+    for max_seq_len in PACKED_SYNTHETIC_LENS:
+        seq_lens = get_skewed_lens(PACKED_SYNTHETIC_BATCH_SIZE, max_seq_len)
+        x = torch.randn(PACKED_SYNTHETIC_BATCH_SIZE, max_seq_len, lstm.input_size, device=device)
+        if get_lstm_plan(seq_lens, max_seq_len, 0) is None:
+            raise Exception(f"Synthetic batch of length {max_seq_len} isn't segmented")
+        mask = torch.arange(max_seq_len, device=device) < seq_lens.unsqueeze(1)
+        with torch.no_grad():
+            max_diff = (run_lstm(lstm, x, seq_lens, 0) - lstm(x)[0])[mask].abs().max().item()
+        if max_diff > 1e-5:
+            raise Exception(f"Length-sorted LSTM outputs differ from padded at synthetic length {max_seq_len}: {max_diff}")
+        step_time = {}
+        for segmented in [False, True]:
+            step_time[segmented] = time_steps(
+                lambda: run_lstm(lstm, x, seq_lens if segmented else None, 0).sum().backward(), args.benchmark_epochs * 10
+            )
+        default_mode = "length-sorted" if max_seq_len >= MIN_SEGMENTED_SEQ_LEN else "padded"
+        print(f"Synthetic length {max_seq_len} ({default_mode} by default) - max diff: {max_diff:.2e}, training step - "
+              f"padded: {step_time[False] * 1000:.2f}ms, length-sorted: {step_time[True] * 1000:.2f}ms, "
+              f"speedup: {step_time[False] / step_time[True]:.2f}x")
+
+def get_stream_turn(dataset: DKTDataset, dialogue_idx: int, turn_idx: int, model_type: str):
+    # One turn of a dataset dialogue in the session turn format of models/streaming.py
+    dialogue = dataset.data[dialogue_idx]
+    if model_type == "dkt-multi":
+        return {"kc_ids": dialogue["kc_ids"][turn_idx], "labels": dialogue["labels"][turn_idx]}
+    if ALT_ARCH:
+        return {"turn_embs": dataset.tensors["turn_embs"][dialogue_idx, turn_idx]}
+    return {
+        **{key: dataset.tensors[key][dialogue_idx, turn_idx] for key in ["teacher_embs", "student_embs", "kc_embs"]},
+        "labels": dialogue["labels"][turn_idx]
+    }
+
+def run_streaming(model, dataset: DKTDataset, dialogue_idxs: List[int], model_type: str):
+    """
+    Stream dialogues as concurrent sessions, session i starting i steps after the first so new and ongoing sessions share steps
+    Returns KC probabilities after each turn of each dialogue (L x K(all) per dialogue)
+    """
+    seq_lens = [len(dataset.data[dialogue_idx]["labels"]) for dialogue_idx in dialogue_idxs]
+    states = [None] * len(dialogue_idxs)
+    kc_probs = [[] for _ in dialogue_idxs]
+    for step_idx in range(max(session_idx + seq_len for session_idx, seq_len in enumerate(seq_lens))):
+        active = [session_idx for session_idx, seq_len in enumerate(seq_lens) if 0 <= step_idx - session_idx < seq_len]
+        new_states, step_kc_probs = step_sessions(
+            model, [states[session_idx] for session_idx in active],
+            [get_stream_turn(dataset, dialogue_idxs[session_idx], step_idx - session_idx, model_type) for session_idx in active]
+        )
+        for session_idx, state, session_kc_probs in zip(active, new_states, step_kc_probs):
+            states[session_idx] = state
+            kc_probs[session_idx].append(session_kc_probs)
+    return [torch.stack(session_kc_probs) for session_kc_probs in kc_probs]
+
+def benchmark_streaming(args):
+    """
+    Check that streaming the test dialogues turn by turn with step matches the full-sequence forward after every turn,
+    then measure per-turn latency of streaming batches of concurrent sessions
+    """
+    assert args.model_type in ("dkt-multi", "dkt-sem")
+    kc_dict, kc_emb_matrix, sbert_model = load_baseline_kcs(args)
+    _, _, test_df = load_annotated_data(args, get_default_fold(args))
+    dataset = DKTDataset(test_df, kc_dict, kc_emb_matrix, sbert_model)
+    num_turns = sum(len(dialogue["labels"]) for dialogue in dataset.data)
+    initialize_seeds(221)
+    model = get_baseline_model(kc_dict, kc_emb_matrix, args)
+    model.eval()
+    max_diff = 0
+    with torch.no_grad():
+        # Unshuffled batches hold consecutive dialogues, so each batch row lines up with a dataset dialogue
+        for batch_idx, batch in enumerate(get_dataloader(dataset, DKTCollator(False), args.batch_size, False)):
+            dialogue_idxs = list(range(batch_idx * args.batch_size, min((batch_idx + 1) * args.batch_size, len(dataset))))
+            full_kc_probs = model(batch)
+            for dialogue_idx, kc_probs in enumerate(run_streaming(model, dataset, dialogue_idxs, args.model_type)):
+                max_diff = max(max_diff, (full_kc_probs[dialogue_idx, :kc_probs.shape[0]] - kc_probs).abs().max().item())
+    if max_diff > 1e-5:
+        raise Exception(f"Streaming outputs differ from full forward: {max_diff}")
+    print(f"Max diff over {num_turns} turns: {max_diff:.2e}")
+
+    batches = [list(range(start_idx, min(start_idx + args.batch_size, len(dataset)))) for start_idx in range(0, len(dataset), args.batch_size)]
+    epoch_time = time_steps(lambda: [run_streaming(model, dataset, dialogue_idxs, args.model_type) for dialogue_idxs in batches], args.benchmark_epochs)
+    print(f"Streaming {args.batch_size} concurrent sessions - {epoch_time / num_turns * 1000:.2f}ms/turn, {num_turns / epoch_time:.1f} turns/s")
+
+STACKED_BENCHMARK_LRS = [1e-4, 5e-4, 1e-3, 5e-3]
+
+def get_stacked_benchmark_models(kc_dict: dict, kc_emb_matrix: torch.Tensor, configs: list):
+    # Models initialized as in train_baseline_stacked, without dropout since stacked models draw dropout masks differently
+    models = []
+    for config_args in configs:
+        initialize_seeds(221)
+        model = get_baseline_model(kc_dict, kc_emb_matrix, config_args)
+        model.dropout_layer.p = 0
+        models.append(model)
+    return models
+
+def eval_baseline_batches(model, batches, args):
+    # Returns average loss and AUC of model over batches
+    model.eval()
+    total_loss = 0
+    all_labels = []
+    all_preds = []
+    with torch.no_grad():
+        for batch in batches:
+            loss, corr_probs = compute_baseline_loss(model, batch, args)
+            labels = batch["labels"][:, 1:]
+            mask = labels != -100
+            total_loss += loss.item()
+            all_labels.append(labels[mask])
+            all_preds.append(corr_probs[mask])
+    return total_loss / len(batches), roc_auc_score(torch.concat(all_labels).tolist(), torch.concat(all_preds).tolist())
+
+def benchmark_stacked(args):
+    """
+    Train a learning rate sweep independently and as one stacked model on the same batches, check that each stacked model
+    ends with the same validation loss and AUC as its independently trained config, and compare training time per epoch
+    """
+    assert args.model_type in STACKABLE_BASELINES
+    check_stack_args(args)
+    kc_dict, kc_emb_matrix, sbert_model = load_baseline_kcs(args)
+    train_df, val_df, _ = load_annotated_data(args, get_default_fold(args))
+    collator = DKTCollator(args.model_type not in NON_FLAT_KC_ARCH)
+    initialize_seeds(221)
+    train_batches = list(get_dataloader(DKTDataset(train_df, kc_dict, kc_emb_matrix, sbert_model), collator, args.batch_size, True))
+    val_batches = list(get_dataloader(DKTDataset(val_df, kc_dict, kc_emb_matrix, sbert_model), collator, args.batch_size, False))
+    configs = []
+    for lr in STACKED_BENCHMARK_LRS:
+        config_args = copy.copy(args)
+        config_args.lr = lr
+        configs.append(config_args)
+
+    # Train each config on its own, as in a sweep without stacking
+    independent_time = 0
+    independent_metrics = []
+    for model, config_args in zip(get_stacked_benchmark_models(kc_dict, kc_emb_matrix, configs), configs):
+        model.train()
+        optimizer = torch.optim.AdamW(model.parameters(), lr=config_args.lr, weight_decay=config_args.wd)
+        start_time = time.perf_counter()
+        for _ in range(args.benchmark_epochs):
+            for batch in train_batches:
+                compute_baseline_loss(model, batch, config_args)[0].backward()
+                if args.gc:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.gc)
+                optimizer.step()
+                optimizer.zero_grad()
+        independent_time += time.perf_counter() - start_time
+        independent_metrics.append(eval_baseline_batches(model, val_batches, config_args))
+
+    # Train all configs as one stacked model, then evaluate each one loaded back into its original architecture
+    models = get_stacked_benchmark_models(kc_dict, kc_emb_matrix, configs)
+    model = StackedDKT(models).to(device)
+    model.train()
+    optimizer = StackedAdamW(model.parameters(), [config_args.lr for config_args in configs], [config_args.wd for config_args in configs])
+    start_time = time.perf_counter()
+    for _ in range(args.benchmark_epochs):
+        for batch in train_batches:
+            get_stacked_losses(model, batch, configs).sum().backward()
+            if args.gc:
+                optimizer.clip_grad_norm_(args.gc)
+            optimizer.step()
+            optimizer.zero_grad()
+    stacked_time = time.perf_counter() - start_time
+    max_diff = 0
+    for model_idx, config_args in enumerate(configs):
+        models[model_idx].load_state_dict(model.get_state_dict(model_idx))
+        (loss, auc), (stacked_loss, stacked_auc) = independent_metrics[model_idx], eval_baseline_batches(models[model_idx], val_batches, config_args)
+        print(f"lr {config_args.lr} - independent val loss: {loss:.4f}, AUC: {auc:.4f}; stacked val loss: {stacked_loss:.4f}, AUC: {stacked_auc:.4f}")
+        max_diff = max(max_diff, abs(loss - stacked_loss), abs(auc - stacked_auc))
+    if max_diff > 1e-3:
+        raise Exception(f"Stacked models' validation metrics differ from independently trained models: {max_diff}")
+    print(f"Max metric diff: {max_diff:.2e}")
+    independent_time /= args.benchmark_epochs
+    stacked_time /= args.benchmark_epochs
+    print(f"{len(configs)} configs - independent: {independent_time:.2f}s/epoch, stacked: {stacked_time:.2f}s/epoch, "
+          f"speedup: {independent_time / stacked_time:.2f}x")
+
+# Name, merge_lora, quantize, cpu_dtype - the first config is the reference
+LMKT_CPU_CONFIGS = [
+    ("fp32", False, False, "fp32"),
+    ("fp32 merged", True, False, "fp32"),
+    ("bf16 merged", True, False, "bf16"),
+    ("int8 merged", True, True, "fp32")
+]
+LMKT_CPU_DIALOGUES = 5
+
+def run_lmkt_batches(model, batches, true_token, false_token, args, prefix_cache: LMKTPrefixCache = None):
+    # KC probabilities for all batches, the packed loss inverts the attention mask in place so each run gets a copy
+    get_loss = get_lmkt_loss_packed if args.pack_kcs else get_lmkt_loss_unpacked
+    with torch.no_grad():
+        return torch.concat([
+            get_loss(
+                model, {**batch, "attention_mask": batch["attention_mask"].clone()}, true_token, false_token, args, prefix_cache=prefix_cache
+            )[1].float()
+            for batch in batches
+        ])
+
+def benchmark_lmkt_cpu(args):
+    """
+    Compare LLMKT CPU inference with f32 weights and unmerged LoRA adapters against merged adapters, bf16 weights and dynamic int8 quantization,
+    on the first test set dialogues, reporting KC probability diffs from the f32 model and time per batch
+    Can be run with a small local base model, e.g. a tiny Llama config saved with save_pretrained
+    """
+    if not on_cpu:
+        raise Exception("LLMKT CPU benchmark needs to run without a GPU, e.g. with CUDA_VISIBLE_DEVICES=")
+    _, _, test_df = load_annotated_data(args, get_default_fold(args))
+    KTDataset = LMKTDatasetPacked if args.pack_kcs else LMKTDatasetUnpacked
+    KTCollator = LMKTCollatorPacked if args.pack_kcs else LMKTCollatorUnpacked
+    ref_kc_probs = None
+    for name, merge_lora, quantize, cpu_dtype in LMKT_CPU_CONFIGS:
+        model, tokenizer = get_model(args.base_model, True, model_name=args.model_name, quantize=quantize,
+                                     merge_lora=merge_lora, cpu_dtype=cpu_dtype, cpu_threads=args.cpu_threads)
+        model.eval()
+        dataset = KTDataset(test_df[:LMKT_CPU_DIALOGUES], tokenizer, args, skip_first_turn=not args.inc_first_label)
+        batches = list(get_dataloader(dataset, KTCollator(tokenizer), args.batch_size, False))
+        true_token, false_token = get_true_false_tokens(tokenizer)
+        kc_probs = run_lmkt_batches(model, batches, true_token, false_token, args)
+        batch_time = time_steps(lambda: run_lmkt_batches(model, batches, true_token, false_token, args), args.benchmark_epochs) / len(batches)
+        if ref_kc_probs is None:
+            ref_kc_probs = kc_probs
+        diff = (kc_probs - ref_kc_probs).abs()
+        print(f"{name} - max diff: {diff.max().item():.2e}, mean diff: {diff.mean().item():.2e}, time per batch: {batch_time * 1000:.1f}ms "
+              f"({torch.get_num_threads()} threads)")
+        release_model(model)
+
+LMKT_CHECK_DIALOGUES = 10
+
+def get_lmkt_check_data(tokenizer, test_df, args, batch_size: int = 1):
+    # Test samples of the first dialogues, with full-prompt batches for the reference and the model's True/False tokens
+    KTDataset = LMKTDatasetPacked if args.pack_kcs else LMKTDatasetUnpacked
+    KTCollator = LMKTCollatorPacked if args.pack_kcs else LMKTCollatorUnpacked
+    dataset = KTDataset(test_df[:LMKT_CHECK_DIALOGUES], tokenizer, args, skip_first_turn=not args.inc_first_label)
+    batches = list(get_dataloader(dataset, KTCollator(tokenizer), batch_size, False))
+    true_token, false_token = get_true_false_tokens(tokenizer)
+    return dataset, batches, true_token, false_token
+
+def run_lmkt_incremental(engine: LMKTIncrementalEngine, samples: list):
+    with torch.no_grad():
+        return torch.concat([engine.predict(sample) for sample in samples]).float()
+
+def benchmark_lmkt_incremental(args):
+    """
+    Check that incremental LLMKT inference (--kv_cache), which reuses the KV cache of previous turns, matches the full-prompt forward
+    of get_lmkt_loss_packed/unpacked for every KC, with and without KC packing, then compare time per sample of both
+    Uses a tiny random Llama with the tokenizer of base_model, so it runs anywhere without loading the full model
+    """
+    model, tokenizer = get_tiny_random_model(args.base_model)
+    _, _, test_df = load_annotated_data(args, get_default_fold(args))
+    for pack_kcs in [True, False]:
+        check_args = copy.copy(args)
+        check_args.pack_kcs = pack_kcs
+        dataset, batches, true_token, false_token = get_lmkt_check_data(tokenizer, test_df, check_args)
+        samples = [sample for batch in get_dataloader(dataset, LMKTCollatorIncremental(), 1, False) for sample in batch["meta_data"]]
+        full_kc_probs = run_lmkt_batches(model, batches, true_token, false_token, check_args)
+        engine = LMKTIncrementalEngine(model, tokenizer, pack_kcs)
+        max_diff = (run_lmkt_incremental(engine, samples) - full_kc_probs).abs().max().item()
+        if max_diff > 1e-5:
+            raise Exception(f"Incremental inference differs from full prompts with pack_kcs={pack_kcs}: {max_diff}")
+        full_time = time_steps(lambda: run_lmkt_batches(model, batches, true_token, false_token, check_args), args.benchmark_epochs) / len(samples)
+        incremental_time = time_steps(lambda: run_lmkt_incremental(engine, samples), args.benchmark_epochs) / len(samples)
+        print(f"pack_kcs={pack_kcs} - {len(samples)} samples, {len(full_kc_probs)} KCs, max diff: {max_diff:.2e}, time per sample - "
+              f"full prompt: {full_time * 1000:.1f}ms, incremental: {incremental_time * 1000:.1f}ms, speedup: {full_time / incremental_time:.2f}x")
+
+def check_prefix_cache_entries(prefix_cache: LMKTPrefixCache):
+    # Stored entries must still hold exactly their prefix after being reused, and the token count must match the entries within budget
+    for (_, prefix_ids), entry in prefix_cache.entries.items():
+        if entry.get_seq_length() != len(prefix_ids):
+            raise Exception(f"Prefix cache entry of {len(prefix_ids)} tokens was modified to {entry.get_seq_length()} tokens")
+    num_tokens = sum(len(prefix_ids) for _, prefix_ids in prefix_cache.entries)
+    if num_tokens != prefix_cache.num_tokens or (num_tokens > prefix_cache.max_tokens and len(prefix_cache.entries) > 1):
+        raise Exception(f"Prefix cache holds {num_tokens} tokens, counted {prefix_cache.num_tokens} with budget {prefix_cache.max_tokens}")
+
+def check_prefix_cache_lru(prefix_cache: LMKTPrefixCache):
+    # Least recently used entries are evicted first once over the token budget, with a hit counting as a use
+    prefix_cache.clear()
+    prefix_cache.max_tokens = 10
+    prefix_cache.add_entry([1, 2, 3, 4], DynamicCache())
+    prefix_cache.add_entry([5, 6, 7, 8], DynamicCache())
+    prefix_cache.get_entry([1, 2, 3, 4])
+    prefix_cache.add_entry([9, 10, 11], DynamicCache())
+    if [prefix_ids for _, prefix_ids in prefix_cache.entries] != [(1, 2, 3, 4), (9, 10, 11)] or prefix_cache.num_tokens != 7:
+        raise Exception(f"Prefix cache evicted wrong entries: {list(prefix_cache.entries)}")
+
+def benchmark_lmkt_prefix_cache(args):
+    """
+    Check that KV states of prompt prefixes from LMKTPrefixCache (--prefix_cache_tokens) give the same KC probabilities as full prompts,
+    both when entries are first computed and when they are reused, for batch sizes 1 and 3 with and without KC packing,
+    with a budget large enough to keep all prefixes and one that only fits the longest, then check LRU eviction and keying by active adapter
+    Uses a tiny random Llama with the tokenizer of base_model, so it runs anywhere without loading the full model
+    """
+    model, tokenizer = get_tiny_random_model(args.base_model)
+    _, _, test_df = load_annotated_data(args, get_default_fold(args))
+    for pack_kcs in [True, False]:
+        check_args = copy.copy(args)
+        check_args.pack_kcs = pack_kcs
+        for batch_size in [1, 3]:
+            _, batches, true_token, false_token = get_lmkt_check_data(tokenizer, test_df, check_args, batch_size)
+            full_kc_probs = run_lmkt_batches(model, batches, true_token, false_token, check_args)
+            max_tokens = 100000
+            for _ in range(2):
+                prefix_cache = LMKTPrefixCache(model, tokenizer, max_tokens)
+                miss_diff = (run_lmkt_batches(model, batches, true_token, false_token, check_args, prefix_cache) - full_kc_probs).abs().max().item()
+                check_prefix_cache_entries(prefix_cache)
+                hit_diff = (run_lmkt_batches(model, batches, true_token, false_token, check_args, prefix_cache) - full_kc_probs).abs().max().item()
+                check_prefix_cache_entries(prefix_cache)
+                if max(miss_diff, hit_diff) > 1e-5:
+                    raise Exception(f"Prefix cache outputs differ from full prompts with pack_kcs={pack_kcs}, batch size {batch_size}, "
+                                    f"budget {max_tokens}: {miss_diff} (first pass), {hit_diff} (second pass)")
+                full_time = time_steps(lambda: run_lmkt_batches(model, batches, true_token, false_token, check_args), args.benchmark_epochs)
+                cached_time = time_steps(
+                    lambda: run_lmkt_batches(model, batches, true_token, false_token, check_args, prefix_cache), args.benchmark_epochs
+                )
+                print(f"pack_kcs={pack_kcs}, batch size {batch_size}, budget {max_tokens} - {len(prefix_cache.entries)} entries, "
+                      f"max diff first pass: {miss_diff:.2e}, second pass: {hit_diff:.2e}, time per batch - full prompt: "
+                      f"{full_time / len(batches) * 1000:.1f}ms, prefix cache: {cached_time / len(batches) * 1000:.1f}ms")
+                # Rerun with only room for the longest prefix, so entries are evicted and recomputed
+                max_tokens = max(len(prefix_ids) for _, prefix_ids in prefix_cache.entries)
+    check_prefix_cache_lru(LMKTPrefixCache(model, tokenizer, 0))
+
+    # Two adapters sharing one cache, entries of one must not be reused for the other
+    model = get_peft_model(model, LoraConfig(target_modules=LORA_TARGET_MODULES, r=4, lora_alpha=4, init_lora_weights=False), adapter_name="a")
+    model.add_adapter("b", LoraConfig(target_modules=LORA_TARGET_MODULES, r=4, lora_alpha=4, init_lora_weights=False))
+    model.eval()
+    _, batches, true_token, false_token = get_lmkt_check_data(tokenizer, test_df, args)
+    prefix_cache = LMKTPrefixCache(model, tokenizer, 100000)
+    for adapter_name in ["a", "b", "a"]:
+        model.set_adapter(adapter_name)
+        full_kc_probs = run_lmkt_batches(model, batches, true_token, false_token, args)
+        max_diff = (run_lmkt_batches(model, batches, true_token, false_token, args, prefix_cache) - full_kc_probs).abs().max().item()
+        if max_diff > 1e-5:
+            raise Exception(f"Prefix cache outputs differ from full prompts with adapter {adapter_name} after switching adapters: {max_diff}")
+    if {adapter_name for adapter_name, _ in prefix_cache.entries} != {"a", "b"}:
+        raise Exception("Prefix cache entries aren't keyed by active adapter")
+    print("LRU eviction and adapter keying checks passed")
+
+def benchmark(args):
+    apply_defaults(args)
+    if args.benchmark == "compile":
+        benchmark_compile(args)
+    elif args.benchmark == "attention":
+        benchmark_attention(args)
+    elif args.benchmark == "kv_cache":
+        benchmark_kv_cache(args)
+    elif args.benchmark == "packed":
+        benchmark_packed(args)
+    elif args.benchmark == "streaming":
+        benchmark_streaming(args)
+    elif args.benchmark == "stacked":
+        benchmark_stacked(args)
+    elif args.benchmark == "lmkt_cpu":
+        benchmark_lmkt_cpu(args)
+    elif args.benchmark == "lmkt_incremental":
+        benchmark_lmkt_incremental(args)
+    elif args.benchmark == "lmkt_prefix_cache":
+        benchmark_lmkt_prefix_cache(args)
+    else:
+        raise Exception(f"Benchmark {args.benchmark} not supported")
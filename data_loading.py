@@ -161,6 +161,7 @@ def load_annotated_data(args, fold: Union[int, str, None] = 1):
 
 def get_model_file_suffix(args, fold = None):
     suffix = "_incfirst" if args.inc_first_label else ""
+    suffix += getattr(args, "eval_suffix", "") # Set when evaluating multiple splits/aggregation methods at once
     suffix += f"_{fold}" if fold else ""
     if args.model_name:
         return args.model_name + suffix
@@ -0,0 +1,116 @@
+import os
+import fcntl
+import hashlib
+from typing import List
+from contextlib import contextmanager
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+class SBERTEmbeddingCache:
+    """
+    Persistent store of SBERT text embeddings, keyed by model name and text hash
+    Embeddings are float16 rows appended to a memory-mapped file, with the hash of each row's text appended to an index file
+    and the embedding size in a separate file
+    Texts are deduplicated before encoding, so each unique text is only ever embedded once across runs, folds and configs
+    The SBERT model itself is only loaded if there are texts that haven't been embedded yet
+    """
+
+    def __init__(self, model_name: str, cache_dir: str = "data/embeddings"):
+        self.model_name = model_name
+        self.cache_dir = os.path.join(cache_dir, model_name.replace("/", "-"))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.emb_path = os.path.join(self.cache_dir, "embs.f16")
+        self.index_path = os.path.join(self.cache_dir, "index.txt")
+        self.dim_path = os.path.join(self.cache_dir, "dim.txt")
+        self.model = None
+        self.hash_to_row = {}
+        self.embs = None
+
+    @staticmethod
+    def get_hash(text: str):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @contextmanager
+    def lock(self):
+        # File lock so parallel sweep workers don't append to the store at the same time
+        with open(os.path.join(self.cache_dir, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load_index(self):
+        """
+        Load index and memory-map embeddings, should be called while holding the lock
+        A crash between the embedding and index appends leaves extra bytes or a partial index line, so both files are truncated
+        to the complete rows listed in the index, which is appended after the embedding file
+        """
+        self.hash_to_row = {}
+        self.embs = None
+        if not os.path.exists(self.dim_path):
+            # Nothing was ever added, or the store predates the dim file and its rows can't be checked
+            for path in [self.emb_path, self.index_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+        with open(self.dim_path) as dim_file:
+            emb_size = int(dim_file.read())
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r+") as index_file:
+                index = index_file.read()
+                index = index[:index.rfind("\n") + 1]
+                index_file.truncate(len(index))
+            self.hash_to_row = {text_hash: row for row, text_hash in enumerate(index.split())}
+        num_bytes = len(self.hash_to_row) * emb_size * 2
+        if os.path.exists(self.emb_path) and os.path.getsize(self.emb_path) > num_bytes:
+            os.truncate(self.emb_path, num_bytes)
+        if self.hash_to_row:
+            self.embs = np.memmap(self.emb_path, dtype=np.float16, mode="r", shape=(len(self.hash_to_row), emb_size))
+
+    def load_model(self):
+        if self.model is None:
+            self.model = SentenceTransformer(self.model_name)
+        return self.model
+
+    def get_emb_size(self):
+        # Read from the store if anything was added, otherwise ask the model
+        if self.embs is None:
+            with self.lock():
+                self.load_index()
+        if self.embs is not None:
+            return self.embs.shape[1]
+        return self.load_model().get_sentence_embedding_dimension()
+
+    def add(self, texts: List[str], text_hashes: List[str]):
+        print(f"Computing SBERT embeddings for {len(texts)} new texts...")
+        embs = self.load_model().encode(texts, batch_size=512, convert_to_numpy=True).astype(np.float16)
+        if not os.path.exists(self.dim_path):
+            with open(self.dim_path, "w") as dim_file:
+                dim_file.write(str(embs.shape[1]))
+        with open(self.emb_path, "ab") as emb_file:
+            emb_file.write(embs.tobytes())
+        with open(self.index_path, "a") as index_file:
+            index_file.write("".join(text_hash + "\n" for text_hash in text_hashes))
+
+    def encode(self, texts: List[str]):
+        """
+        Returns float32 tensor of embeddings (N x D) for texts, only encoding unique texts that aren't in the store yet
+        """
+        if not texts:
+            return torch.empty(0, self.get_emb_size())
+        text_hashes = [self.get_hash(text) for text in texts]
+        if any(text_hash not in self.hash_to_row for text_hash in text_hashes):
+            with self.lock():
+                # Other processes may have added texts since last load
+                self.load_index()
+                new_texts = {
+                    text_hash: text for text_hash, text in zip(text_hashes, texts)
+                    if text_hash not in self.hash_to_row
+                }
+                if new_texts:
+                    self.add(list(new_texts.values()), list(new_texts.keys()))
+                    self.load_index()
+        rows = [self.hash_to_row[text_hash] for text_hash in text_hashes]
+        return torch.from_numpy(self.embs[rows].astype(np.float32))
@@ -0,0 +1,147 @@
+import os
+import time
+import json
+import inspect
+import numpy as np
+import torch
+from torch.nn import Module
+import onnx
+
+from training import apply_defaults, load_baseline_kcs, get_baseline_model, NON_FLAT_KC_ARCH
+from data_loading import load_annotated_data, get_default_fold, COMTA_SUBJECTS
+from kt_data_loading import DKTDataset, DKTCollator, get_dataloader
+from models.dkt_sem import ALT_ARCH
+from models.onnx_predictor import ONNXKTPredictor
+from utils import device, get_checkpoint_path
+
+ONNX_INPUTS = {
+    "dkt-multi": ["kc_ids", "num_kcs", "labels"],
+    "dkt-sem": ["turn_embs"] if ALT_ARCH else ["teacher_embs", "student_embs", "kc_embs", "labels"],
+    "dkt": ["kc_ids_flat", "labels_flat"]
+}
+ONNX_OPSET = 17
+EXPORT_AXIS_SIZES = {"batch": 2, "seq": 5, "kcs": 3}
+
+class DKTMultiKCExport(Module):
+    # Named positional inputs for export, the LSTM runs over all padded steps since sequence lengths aren't inputs
+    def __init__(self, model: Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, kc_ids: torch.Tensor, num_kcs: torch.Tensor, labels: torch.Tensor):
+        return self.model({"kc_ids": kc_ids, "num_kcs": num_kcs, "labels": labels})
+
+class DKTSemExport(DKTMultiKCExport):
+    def forward(self, teacher_embs: torch.Tensor, student_embs: torch.Tensor, kc_embs: torch.Tensor, labels: torch.Tensor):
+        return self.model({"teacher_embs": teacher_embs, "student_embs": student_embs, "kc_embs": kc_embs, "labels": labels})
+
+class DKTSemAltExport(DKTMultiKCExport):
+    def forward(self, turn_embs: torch.Tensor):
+        return self.model({"turn_embs": turn_embs})
+
+def get_export_module(model: Module, model_type: str):
+    # Module taking ONNX_INPUTS positionally and returning probabilities for all KCs at every step, pykt DKT already does
+    if model_type == "dkt-multi":
+        return DKTMultiKCExport(model).eval()
+    if model_type == "dkt-sem":
+        return (DKTSemAltExport(model) if ALT_ARCH else DKTSemExport(model)).eval()
+    return model.eval()
+
+def get_onnx_path(model_name: str):
+    return get_checkpoint_path(model_name + ".onnx")
+
+def get_export_example(example_batch: dict, input_names: list, dynamic_axes: dict):
+    """
+    Placeholder inputs with the batch's dtypes and static dims (one KC with id 0 per turn), dynamic axes get distinct sizes above 1,
+    since tracing can specialize axes of size 1 and merge axes of equal size
+    """
+    example = []
+    for name in input_names:
+        shape = list(example_batch[name].shape)
+        for axis, axis_name in dynamic_axes[name].items():
+            shape[axis] = EXPORT_AXIS_SIZES[axis_name]
+        fill_fn = torch.ones if name == "num_kcs" else torch.zeros
+        example.append(fill_fn(shape, dtype=example_batch[name].dtype, device=example_batch[name].device))
+    return tuple(example)
+
+def export_onnx(model: Module, kc_dict: dict, example_batch: dict, onnx_path: str, args):
+    """
+    Export model to ONNX with dynamic batch and sequence axes (and number of KCs per turn for dkt-multi) on inputs and output
+    Model type and KC dictionary are stored in the ONNX metadata for ONNXKTPredictor
+    """
+    input_names = ONNX_INPUTS[args.model_type]
+    dynamic_axes = {name: {0: "batch", 1: "seq"} for name in input_names + ["kc_probs"]}
+    if args.model_type == "dkt-multi":
+        dynamic_axes["kc_ids"][2] = "kcs"
+    # torch.export, the default exporter in newer PyTorch versions, specializes the LSTM sequence axis to the example length,
+    # so always use the TorchScript exporter, which keeps dynamic axes on the output too
+    export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(
+        get_export_module(model, args.model_type), get_export_example(example_batch, input_names, dynamic_axes), onnx_path,
+        input_names=input_names, output_names=["kc_probs"], dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET, **export_kwargs
+    )
+    onnx_model = onnx.load(onnx_path)
+    onnx.helper.set_model_props(onnx_model, {"model_type": args.model_type, "kc_dict": json.dumps(kc_dict)})
+    onnx.save(onnx_model, onnx_path)
+
+def check_onnx_parity(model: Module, predictor: ONNXKTPredictor, dataloader, args):
+    """
+    Check that the ONNX output has dynamic batch and sequence axes and that ONNX Runtime outputs match the PyTorch model
+    on every batch, and compare inference time of both
+    """
+    output_shape = predictor.session.get_outputs()[0].shape
+    if output_shape != ["batch", "seq", len(predictor.kc_dict)]:
+        raise Exception(f"ONNX output shape {output_shape} doesn't have dynamic batch and sequence axes")
+    input_names = ONNX_INPUTS[args.model_type]
+    export_module = get_export_module(model, args.model_type)
+    max_diff = 0
+    torch_time = 0
+    ort_time = 0
+    for batch in dataloader:
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            torch_preds = export_module(*[batch[name] for name in input_names]).cpu().numpy()
+        torch_time += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        ort_preds = predictor.predict({name: batch[name].cpu().numpy() for name in input_names})
+        ort_time += time.perf_counter() - start_time
+        if ort_preds.shape != torch_preds.shape:
+            raise Exception(f"ONNX Runtime output shape {ort_preds.shape} differs from PyTorch: {torch_preds.shape}")
+        max_diff = max(max_diff, np.abs(ort_preds - torch_preds).max())
+    if max_diff > 1e-4:
+        raise Exception(f"ONNX Runtime outputs differ from PyTorch: {max_diff}")
+    print(f"Max diff: {max_diff:.2e}, inference time - PyTorch: {torch_time:.3f}s, ONNX Runtime: {ort_time:.3f}s")
+
+def export_baseline(args, fold):
+    # Load KC dictionary, trained model and test data
+    kc_dict, kc_emb_matrix, sbert_model = load_baseline_kcs(args)
+    model = get_baseline_model(kc_dict, kc_emb_matrix, args)
+    model_name = args.model_name + (f"_{fold}" if fold else "")
+    if not os.path.exists(get_checkpoint_path(model_name + ".pt")):
+        raise Exception(f"No trained model at {get_checkpoint_path(model_name + '.pt')}, set --model_name to the name used for training")
+    model.load_state_dict(torch.load(get_checkpoint_path(model_name + ".pt"), map_location=device))
+    model.eval()
+    _, _, test_df = load_annotated_data(args, fold)
+    test_dataset = DKTDataset(test_df, kc_dict, kc_emb_matrix, sbert_model)
+    test_dataloader = get_dataloader(test_dataset, DKTCollator(args.model_type not in NON_FLAT_KC_ARCH), args.batch_size, False)
+
+    # Export and check against PyTorch model on test set
+    onnx_path = get_onnx_path(model_name)
+    export_onnx(model, kc_dict, next(iter(test_dataloader)), onnx_path, args)
+    start_time = time.perf_counter()
+    predictor = ONNXKTPredictor(onnx_path)
+    print(f"Exported {onnx_path}, predictor load time: {time.perf_counter() - start_time:.3f}s")
+    check_onnx_parity(model, predictor, test_dataloader, args)
+
+def export(args):
+    apply_defaults(args)
+    if args.model_type not in ONNX_INPUTS:
+        raise Exception(f"Export not supported for {args.model_type}")
+    if not args.model_name:
+        args.model_name = args.model_type
+        print(f"No --model_name given, exporting {args.model_name}")
+    if args.crossval:
+        for fold in COMTA_SUBJECTS if args.split_by_subject else range(1, 6):
+            export_baseline(args, fold)
+    else:
+        export_baseline(args, get_default_fold(args))
@@ -1,11 +1,13 @@
 from typing import Dict, List
+from abc import ABC, abstractmethod
 import pandas as pd
+import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from torch.nn.utils.rnn import pad_sequence
-from sentence_transformers import SentenceTransformer
 
 from models.dkt_sem import ALT_ARCH
+from embedding_cache import SBERTEmbeddingCache
 from prompting import kt_system_prompt, kt_user_prompt, dkt_sem_prompt
 from utils import device
 
@@ -48,6 +50,15 @@ class DatasetBase(Dataset):
     def __len__(self):
         return len(self.data)
 
+    def subsample(self, max_samples: int, seed: int = 221):
+        # Keep a fixed random subset of samples in original order, e.g., for cheaper validation on large sets
+        if max_samples and len(self.data) > max_samples:
+            keep_idxs = np.sort(np.random.default_rng(seed).choice(len(self.data), max_samples, replace=False))
+            self.select(keep_idxs.tolist())
+
+    def select(self, idxs: List[int]):
+        self.data = [self.data[idx] for idx in idxs]
+
 class LMKTDatasetUnpacked(DatasetBase):
     def __init__(self, data: pd.DataFrame, tokenizer, args, skip_first_turn: bool = False):
         self.data = []
@@ -85,15 +96,19 @@ class LMKTCollatorUnpacked:
     def __init__(self, tokenizer):
         self.tokenizer = tokenizer
 
+    def get_sample_lengths(self, sample: dict):
+        # One padded row per KC prompt
+        return [len(ids) for ids in self.tokenizer(sample["prompts"]).input_ids]
+
     def __call__(self, batch):
         all_prompts = [prompt for sample in batch for prompt in sample["prompts"]]
-        prompts_tokenized = self.tokenizer(all_prompts, return_tensors="pt", padding=True).to(device)
+        prompts_tokenized = self.tokenizer(all_prompts, return_tensors="pt", padding=True)
         return {
             "input_ids": prompts_tokenized.input_ids,
             "attention_mask": prompts_tokenized.attention_mask,
             "last_idxs": prompts_tokenized.attention_mask.sum(dim=-1) - 2, # Take index of token before eos
-            "num_kcs": torch.LongTensor([len(sample["prompts"]) for sample in batch]).to(device),
-            "labels": torch.Tensor([sample["label"] for sample in batch]).to(device),
+            "num_kcs": torch.LongTensor([len(sample["prompts"]) for sample in batch]),
+            "labels": torch.Tensor([sample["label"] for sample in batch]),
             "meta_data": batch
         }
 
@@ -141,13 +156,16 @@ class LMKTCollatorPacked:
     def __init__(self, tokenizer):
         self.tokenizer = tokenizer
 
+    def get_sample_lengths(self, sample: dict):
+        return [len(self.tokenizer(sample["prompt"]).input_ids)]
+
     def __call__(self, batch):
         prompts = [sample["prompt"] for sample in batch]
         prompts_tokenized = self.tokenizer(prompts, return_tensors="pt", padding=True)
-        input_ids = prompts_tokenized.input_ids.to(device)
+        input_ids = prompts_tokenized.input_ids
         batch_size, max_seq_len = input_ids.shape
         eos_idxs = [
-            (input_ids[seq_idx] == self.tokenizer.eos_token_id).nonzero().squeeze().cpu()
+            (input_ids[seq_idx] == self.tokenizer.eos_token_id).nonzero().squeeze()
             for seq_idx in range(batch_size)
         ]
         # Create default lower triangular 4D attention mask
@@ -178,20 +196,45 @@ class LMKTCollatorPacked:
         last_idxs = pad_sequence([idxs[3::2] - 1 for idxs in eos_idxs], batch_first=True)
         return {
             "input_ids": input_ids,
-            "attention_mask": attention_mask.unsqueeze(1).to(device), # Add singleton head dimension
-            "position_ids": position_ids.to(device),
+            "attention_mask": attention_mask.unsqueeze(1), # Add singleton head dimension
+            "position_ids": position_ids,
             "last_idxs": last_idxs,
-            "num_kcs": torch.LongTensor([len(sample["kcs"]) for sample in batch]).to(device),
-            "labels": torch.Tensor([sample["label"] for sample in batch]).to(device),
+            "num_kcs": torch.LongTensor([len(sample["kcs"]) for sample in batch]),
+            "labels": torch.Tensor([sample["label"] for sample in batch]),
             "meta_data": batch
         }
 
+class LMKTCollatorIncremental:
+    def __call__(self, batch):
+        # Only collect labels, prompts are tokenized per sample by LMKTIncrementalEngine
+        return {
+            "labels": torch.Tensor([sample["label"] for sample in batch]),
+            "meta_data": batch
+        }
+
+DKT_FLAT_KEYS = ["labels_flat", "kc_ids_flat"] # Padded to number of KCs in sequence instead of number of turns
+DKT_PADDING_VALUES = {"labels": -100, "num_kcs": 1} # Everything else is padded with 0
+DKT_LENGTH_KEYS = ["seq_lens", "flat_lens"] # Unpadded number of turns and KCs per sequence, used to skip padded LSTM steps
+LENGTH_BUCKETS = [16, 32, 64, 128, 256, 512]
+NUM_KC_BUCKETS = [1, 2, 4, 8, 16]
+
+def get_bucket_len(length: int, buckets: List[int]):
+    # Smallest bucket that fits length, lengths beyond the largest bucket are left as is
+    return next((bucket for bucket in buckets if bucket >= length), length)
+
+def pad_dim(tensor: torch.Tensor, dim: int, length: int, value: int = 0):
+    padding = [0, 0] * (tensor.dim() - dim - 1) + [0, length - tensor.shape[dim]]
+    return torch.nn.functional.pad(tensor, padding, value=value)
+
 class DKTDataset(DatasetBase):
-    def __init__(self, data: pd.DataFrame, kc_dict: Dict[str, int], kc_emb_matrix: torch.Tensor, sbert_model: SentenceTransformer):
+    def __init__(self, data: pd.DataFrame, kc_dict: Dict[str, int], kc_emb_matrix: torch.Tensor, sbert_model: SBERTEmbeddingCache):
         self.data = []
         failed = 0
         num_data_points = 0
         num_correct = 0
+        # Keep all tensors on CPU so batches can be collated in worker processes
+        if kc_emb_matrix is not None:
+            kc_emb_matrix = kc_emb_matrix.cpu()
         for idx, sample in data.iterrows():
             dialogue = apply_annotations(sample)
             if not dialogue:
@@ -223,18 +266,13 @@ class DKTDataset(DatasetBase):
                 self.data.append(dialogue_data)
                 num_data_points += len(dialogue_data["labels"])
                 num_correct += sum(dialogue_data["labels"])
-        # Batch encode all dialogue text
+        # Encode all dialogue text at once, the cache deduplicates and only embeds unseen texts
         if sbert_model is not None:
-            batch_size = 512
             if ALT_ARCH:
                 seqs = [dkt_sem_prompt(tt, st, kcs, corr)
                         for dialogue in self.data
                         for tt, st, kcs, corr in zip(dialogue["teacher_turns"], dialogue["student_turns"], dialogue["kcs"], dialogue["labels"])]
-                result_embs = []
-                for batch_start_idx in range(0, len(seqs), batch_size):
-                    batch = seqs[batch_start_idx : batch_start_idx + batch_size]
-                    result_embs.append(sbert_model.encode(batch, convert_to_tensor=True))
-                result_embs = torch.concat(result_embs, dim=0)
+                result_embs = sbert_model.encode(seqs)
                 turn_counter = 0
                 for dialogue in self.data:
                     seq_len = len(dialogue["labels"])
@@ -243,11 +281,7 @@ class DKTDataset(DatasetBase):
             else:
                 seqs = [turn for dialogue in self.data for turn in dialogue["teacher_turns"]] + [
                         turn for dialogue in self.data for turn in dialogue["student_turns"]]
-                result_embs = []
-                for batch_start_idx in range(0, len(seqs), batch_size):
-                    batch = seqs[batch_start_idx : batch_start_idx + batch_size]
-                    result_embs.append(sbert_model.encode(batch, convert_to_tensor=True))
-                result_embs = torch.concat(result_embs, dim=0)
+                result_embs = sbert_model.encode(seqs)
                 turn_counter = 0
                 for dialogue in self.data:
                     seq_len = len(dialogue["labels"])
@@ -255,67 +289,273 @@ class DKTDataset(DatasetBase):
                     stud_start = result_embs.shape[0] // 2
                     dialogue["student_embs"] = result_embs[stud_start + turn_counter : stud_start + turn_counter + seq_len]
                     turn_counter += seq_len
-        self.majority_class = 1 if num_correct / num_data_points >= .5 else 0
+        self.tensorize()
+        self.majority_class = 1 if num_correct >= num_data_points / 2 else 0
         print(f"{failed} / {len(data)} dialogues failed processing")
         print(f"Num dialogues: {len(self.data)}, num data points: {num_data_points}, {num_correct} correct")
 
-class DKTCollator:
-    def __init__(self, flatten_kcs: bool):
-        self.flatten_kcs = flatten_kcs
-
-    def __call__(self, batch):
-        labels = pad_sequence(
-            [torch.LongTensor(seq["labels"]) for seq in batch],
-            batch_first=True, padding_value=-100 # Pad with -100 to ignore loss on padding regions
-        )
-        # # Fill in KC ids, 2D matrix (length x max num KCs) per sequence
-        num_kcs = pad_sequence(
-            [torch.LongTensor([len(kc_ids) for kc_ids in seq["kc_ids"]]) for seq in batch],
-            batch_first=True, padding_value=1 # Pad with 1 to avoid division by 0
+    def tensorize(self):
+        # Pad all dialogues once into contiguous tensors, so batches are built by index slicing instead of padding every epoch
+        def pad_seqs(seqs: List[torch.Tensor], padding_value: int = 0):
+            # pad_sequence doesn't accept an empty list, which happens when no dialogue has at least 2 tagged turns
+            if not seqs:
+                return torch.zeros((0, 0), dtype=torch.long)
+            return pad_sequence(seqs, batch_first=True, padding_value=padding_value)
+        def pad(key: str, padding_value: int = 0):
+            return pad_seqs([torch.LongTensor(seq[key]) for seq in self.data], padding_value)
+        num_kcs = pad_seqs(
+            [torch.LongTensor([len(kc_ids) for kc_ids in seq["kc_ids"]]) for seq in self.data],
+            DKT_PADDING_VALUES["num_kcs"] # Pad with 1 to avoid division by 0
         )
-        max_num_kcs = num_kcs.max()
-        kc_ids = torch.zeros((*num_kcs.shape, max_num_kcs), dtype=torch.long)
-        for seq_idx, seq in enumerate(batch):
+        # Fill in KC ids, 2D matrix (length x max num KCs) per sequence
+        kc_ids = torch.zeros((*num_kcs.shape, num_kcs.max() if self.data else 0), dtype=torch.long)
+        for seq_idx, seq in enumerate(self.data):
             for turn_idx, turn_kc_ids in enumerate(seq["kc_ids"]):
                 kc_ids[seq_idx, turn_idx, :len(turn_kc_ids)] = torch.LongTensor(turn_kc_ids)
+        self.tensors = {
+            "seq_lens": torch.LongTensor([len(seq["labels"]) for seq in self.data]),
+            "flat_lens": torch.LongTensor([len(seq["labels_flat"]) for seq in self.data]),
+            "labels": pad("labels", DKT_PADDING_VALUES["labels"]), # Pad with -100 to ignore loss on padding regions
+            "kc_ids": kc_ids,
+            "num_kcs": num_kcs,
+            "labels_flat": pad("labels_flat"),
+            "kc_ids_flat": pad("kc_ids_flat"),
+            "turn_end_idxs": pad("turn_end_idxs")
+        }
+        # Move text embeddings out of per-dialogue data, so only the padded copy is kept
+        for key in ["kc_embs", "teacher_embs", "student_embs", "turn_embs"]:
+            embs = [seq.pop(key, []) for seq in self.data]
+            if embs and len(embs[0]):
+                self.tensors[key] = pad_sequence([torch.stack(emb) if isinstance(emb, list) else emb for emb in embs], batch_first=True)
+
+    def select(self, idxs: List[int]):
+        super().select(idxs)
+        self.tensors = {key: tensor[idxs] for key, tensor in self.tensors.items()}
 
+    def __getitems__(self, idxs: List[int]):
+        # Called by DataLoader with all indices of a batch, slices padded tensors and trims them to the longest sequence in the batch
+        idxs = torch.LongTensor(idxs)
+        max_len = self.tensors["seq_lens"][idxs].max()
+        max_flat_len = self.tensors["flat_lens"][idxs].max()
+        batch = {}
+        for key, tensor in self.tensors.items():
+            if key in DKT_LENGTH_KEYS:
+                batch[key] = tensor[idxs]
+                continue
+            batch[key] = tensor[:, :max_flat_len if key in DKT_FLAT_KEYS else max_len][idxs]
+        batch["kc_ids"] = batch["kc_ids"][:, :, :batch["num_kcs"].max()]
+        return batch
+
+class DKTCollator:
+    def __init__(self, flatten_kcs: bool, pad_to_buckets: bool = False):
+        self.flatten_kcs = flatten_kcs
+        self.pad_to_buckets = pad_to_buckets
+
+    def get_sample_lengths(self, sample: dict):
+        return [len(sample["kc_ids_flat"]) if self.flatten_kcs else len(sample["labels"])]
+
+    def __call__(self, batch: dict):
+        # Batch is already padded and trimmed by DKTDataset, only select the inputs needed by the model
         result = {
-            "labels": labels.to(device),
-            "kc_ids": kc_ids.to(device),
-            "num_kcs": num_kcs.to(device)
+            "labels": batch["labels"],
+            "kc_ids": batch["kc_ids"],
+            "num_kcs": batch["num_kcs"],
+            "seq_lens": batch["seq_lens"]
         }
 
         if self.flatten_kcs:
             # Add flattened versions of KC ids and labels for unrolled model input
-            kc_ids_flat = pad_sequence([torch.LongTensor(seq["kc_ids_flat"]) for seq in batch], batch_first=True)
-            labels_flat = pad_sequence([torch.LongTensor(seq["labels_flat"]) for seq in batch], batch_first=True)
-            turn_end_idxs = pad_sequence([torch.LongTensor(seq["turn_end_idxs"]) for seq in batch], batch_first=True)
             result = {
                 **result,
-                "labels_flat": labels_flat.to(device),
-                "kc_ids_flat": kc_ids_flat.to(device),
-                "turn_end_idxs": turn_end_idxs.to(device)
+                "labels_flat": batch["labels_flat"],
+                "kc_ids_flat": batch["kc_ids_flat"],
+                "turn_end_idxs": batch["turn_end_idxs"],
+                "flat_lens": batch["flat_lens"]
             }
 
         # Add text embeddings for DKT-Sem
-        if batch[0]["kc_embs"] and not ALT_ARCH:
-            kc_embs = pad_sequence([torch.stack(seq["kc_embs"]) for seq in batch], batch_first=True)
-            teacher_embs = pad_sequence([seq["teacher_embs"] for seq in batch], batch_first=True)
-            student_embs = pad_sequence([seq["student_embs"] for seq in batch], batch_first=True)
+        if "kc_embs" in batch and not ALT_ARCH:
             result = {
                 **result,
-                "kc_embs": kc_embs,
-                "teacher_embs": teacher_embs,
-                "student_embs": student_embs
+                "kc_embs": batch["kc_embs"],
+                "teacher_embs": batch["teacher_embs"],
+                "student_embs": batch["student_embs"]
             }
-        elif "turn_embs" in batch[0]:
-            turn_embs = pad_sequence([seq["turn_embs"] for seq in batch], batch_first=True)
+        elif "turn_embs" in batch:
             result = {
                 **result,
-                "turn_embs": turn_embs
+                "turn_embs": batch["turn_embs"]
             }
 
+        if self.pad_to_buckets:
+            result = self.pad_batch_to_buckets(result)
+
         return result
 
-def get_dataloader(dataset: Dataset, collator, batch_size: int, shuffle: bool):
-    return DataLoader(dataset, collate_fn=collator, batch_size=batch_size, shuffle=shuffle)
+    def pad_batch_to_buckets(self, batch: dict):
+        """
+        Pad sequence lengths and number of KCs up to fixed buckets, so compiled models only see a few distinct shapes
+        Padded turns have label -100, so they are excluded from the loss and metrics like any other padding
+        """
+        seq_len = get_bucket_len(batch["labels"].shape[1], LENGTH_BUCKETS)
+        result = {}
+        for key, val in batch.items():
+            if key in DKT_LENGTH_KEYS:
+                result[key] = val
+                continue
+            length = get_bucket_len(val.shape[1], LENGTH_BUCKETS) if key in DKT_FLAT_KEYS else seq_len
+            result[key] = pad_dim(val, 1, length, DKT_PADDING_VALUES.get(key, 0))
+        result["kc_ids"] = pad_dim(result["kc_ids"], 2, get_bucket_len(result["kc_ids"].shape[2], NUM_KC_BUCKETS))
+        return result
+
+class LengthGroupedBatchSampler(Sampler, ABC):
+    """
+    Base class for batch samplers that group samples of similar length to reduce padding
+    Each epoch, samples are shuffled, split into chunks, sorted by length within each chunk, grouped into batches,
+    and then the batches are shuffled, so batch composition still changes across epochs
+    """
+
+    def __init__(self, sample_lengths: List[List[int]], shuffle: bool, chunk_size: int):
+        # Each sample has a list of lengths, one per row it contributes to the padded batch
+        self.num_rows = [len(lengths) for lengths in sample_lengths]
+        self.seq_lens = [max(lengths) for lengths in sample_lengths]
+        self.num_tokens = [sum(lengths) for lengths in sample_lengths]
+        self.shuffle = shuffle
+        self.chunk_size = chunk_size
+        self.batches = self.plan_batches()
+        self.planned_for_epoch = True
+
+    @abstractmethod
+    def group_batches(self, sorted_idxs: List[int]) -> List[List[int]]:
+        pass
+
+    def plan_batches(self):
+        num_samples = len(self.seq_lens)
+        order = torch.randperm(num_samples).tolist() if self.shuffle else list(range(num_samples))
+        batches = []
+        for chunk_start_idx in range(0, num_samples, self.chunk_size):
+            chunk = sorted(order[chunk_start_idx : chunk_start_idx + self.chunk_size], key=lambda idx: self.seq_lens[idx])
+            batches.extend(self.group_batches(chunk))
+        if self.shuffle:
+            batches = [batches[batch_idx] for batch_idx in torch.randperm(len(batches)).tolist()]
+        return batches
+
+    def get_padding_ratio(self):
+        # Fraction of positions in padded batches that are padding
+        total_tokens = sum(sum(self.num_tokens[idx] for idx in batch) for batch in self.batches)
+        padded_tokens = sum(
+            sum(self.num_rows[idx] for idx in batch) * max(self.seq_lens[idx] for idx in batch)
+            for batch in self.batches
+        )
+        return 1 - total_tokens / padded_tokens
+
+    def __iter__(self):
+        # Re-plan at the start of every epoch after the first, length is then stable for the rest of the epoch
+        if not self.planned_for_epoch:
+            self.batches = self.plan_batches()
+        self.planned_for_epoch = False
+        yield from self.batches
+
+    def __len__(self):
+        return len(self.batches)
+
+class BucketBatchSampler(LengthGroupedBatchSampler):
+    def __init__(self, sample_lengths: List[List[int]], batch_size: int, shuffle: bool, buckets_per_chunk: int = 50):
+        self.batch_size = batch_size
+        super().__init__(sample_lengths, shuffle, batch_size * buckets_per_chunk)
+
+    def group_batches(self, sorted_idxs: List[int]):
+        return [sorted_idxs[start_idx : start_idx + self.batch_size] for start_idx in range(0, len(sorted_idxs), self.batch_size)]
+
+class TokenBudgetBatchSampler(LengthGroupedBatchSampler):
+    def __init__(self, sample_lengths: List[List[int]], max_tokens: int, shuffle: bool, chunk_size: int = 1024):
+        self.max_tokens = max_tokens
+        super().__init__(sample_lengths, shuffle, chunk_size)
+
+    def group_batches(self, sorted_idxs: List[int]):
+        # Greedily fill batches until padded size would exceed budget, samples longer than budget get their own batch
+        batches = []
+        cur_batch = []
+        cur_rows = 0
+        for idx in sorted_idxs:
+            # Sorted by length, so the new sample sets the max length of the batch
+            if cur_batch and (cur_rows + self.num_rows[idx]) * self.seq_lens[idx] > self.max_tokens:
+                batches.append(cur_batch)
+                cur_batch = []
+                cur_rows = 0
+            cur_batch.append(idx)
+            cur_rows += self.num_rows[idx]
+        if cur_batch:
+            batches.append(cur_batch)
+        return batches
+
+class DevicePrefetcher:
+    """
+    Wraps a DataLoader to return batches on device
+    On GPU, the next batch is copied on a side stream while the current batch is being processed
+    """
+
+    def __init__(self, dataloader: DataLoader):
+        self.dataloader = dataloader
+        self.stream = torch.cuda.Stream() if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def to_device(self, batch: dict):
+        return {
+            key: val.to(device, non_blocking=True) if isinstance(val, torch.Tensor) else val
+            for key, val in batch.items()
+        }
+
+    def load_next(self, batch_iter):
+        batch = next(batch_iter, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self.to_device(batch)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.dataloader:
+                yield self.to_device(batch)
+            return
+        batch_iter = iter(self.dataloader)
+        next_batch = self.load_next(batch_iter)
+        while next_batch is not None:
+            # Wait for copy to finish and mark tensors as used by main stream so memory isn't reused early
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            for val in batch.values():
+                if isinstance(val, torch.Tensor):
+                    val.record_stream(torch.cuda.current_stream())
+            next_batch = self.load_next(batch_iter)
+            yield batch
+
+def get_dataloader(dataset: Dataset, collator, batch_size: int, shuffle: bool, batching: str = "default", max_tokens: int = None,
+                   num_workers: int = 0):
+    # Collators return CPU tensors, so they can run in worker processes and be pinned for async copies
+    loader_kwargs = {
+        "collate_fn": collator,
+        "num_workers": num_workers,
+        "persistent_workers": num_workers > 0,
+        "pin_memory": device.type == "cuda"
+    }
+    if batching == "default":
+        return DevicePrefetcher(DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **loader_kwargs))
+    sample_lengths = [collator.get_sample_lengths(sample) for sample in dataset]
+    if batching == "bucket":
+        batch_sampler = BucketBatchSampler(sample_lengths, batch_size, shuffle)
+    elif batching == "tokens":
+        batch_sampler = TokenBudgetBatchSampler(sample_lengths, max_tokens, shuffle)
+    else:
+        raise Exception(f"Batching {batching} not supported")
+    print(f"{batching} batching: {len(batch_sampler)} batches, padding ratio: {batch_sampler.get_padding_ratio():.4f}")
+    return DevicePrefetcher(DataLoader(dataset, batch_sampler=batch_sampler, **loader_kwargs))
+
+def prepare_resumed_epoch(dataloader: DevicePrefetcher, epoch: int):
+    # Length-grouped samplers plan the first epoch on construction and re-plan later epochs when iterated,
+    # so a run resumed after the first epoch has to re-plan like the original run did
+    batch_sampler = dataloader.dataloader.batch_sampler
+    if isinstance(batch_sampler, LengthGroupedBatchSampler):
+        batch_sampler.planned_for_epoch = epoch == 0
@@ -4,6 +4,8 @@ from annotate import annotate
 from human_eval import human_eval
 from training import train, test, BASELINE_MODELS
 from visualize import visualize
+from benchmark import benchmark
+from export import export
 from utils import initialize_seeds, bool_type
 
 def main():
@@ -33,7 +35,20 @@ def main():
     parser_train.add_argument("--lora_alpha", type=int, help="LoRA alpha")
     parser_train.add_argument("--optim", type=str, choices=["adamw", "adafactor"], default="adamw", help="Optimizer")
     parser_train.add_argument("--pt_model_name", type=str, help="Name of pre-trained model to initialize weights from")
+    parser_train.add_argument("--batching", type=str, choices=["default", "bucket", "tokens"], default="default", help="Group training samples by length into fixed size (bucket) or token budget (tokens) batches")
+    parser_train.add_argument("--max_batch_tokens", type=int, default=4096, help="Max padded tokens per batch for token budget batching")
+    parser_train.add_argument("--patience", type=int, default=0, help="Stop training after this many validations without improvement (0 to disable)")
+    parser_train.add_argument("--val_every_steps", type=int, default=0, help="Also validate every N optimizer steps within an epoch (0 for end of epoch only)")
+    parser_train.add_argument("--val_subsample", type=int, default=0, help="Max validation samples used during training, fixed random subset (0 for all)")
+    parser_train.add_argument("--checkpoint_every_steps", type=int, default=0, help="Save full training state (optimizer, position, RNG) in the background every N optimizer steps and after each epoch (0 to disable)")
+    parser_train.add_argument("--resume", action="store_true", help="Resume training from saved training state if it exists")
     parser_train.add_argument("--hyperparam_sweep", action="store_true", help="Run a hyperparameter sweep experiment")
+    parser_train.add_argument("--sweep_workers", type=int, default=1, help="Number of processes to run hyperparameter sweep configs/folds in parallel")
+    parser_train.add_argument("--sweep_threads", type=int, help="Torch threads per sweep worker process (default: split CPU cores evenly between workers)")
+    parser_train.add_argument("--sweep_mode", type=str, choices=["grid", "asha"], default="grid", help="Train every sweep config for all epochs (grid) or stop underperforming configs early with asynchronous successive halving (asha)")
+    parser_train.add_argument("--asha_min_epochs", type=int, default=1, help="For ASHA sweeps, epochs before the first rung")
+    parser_train.add_argument("--asha_eta", type=int, default=3, help="For ASHA sweeps, reduction factor - top 1/eta of runs are promoted at each rung")
+    parser_train.add_argument("--sweep_stack", type=bool_type, default=False, help="For DKT/DKT-Multi/DKT-Sem sweeps, train configs with the same embedding size as one stacked model, about 1.4-2.3x faster than training 4 configs independently (validates every epoch only, not supported with --val_every_steps, --checkpoint_every_steps, --resume or --compile)")
 
     parser_test = subparsers.add_parser("test", help="Test KT model")
     parser_test.set_defaults(func=test)
@@ -41,28 +56,47 @@ def main():
     parser_visualize = subparsers.add_parser("visualize", help="Visualize KCs")
     parser_visualize.set_defaults(func=visualize)
 
-    for subparser in [parser_annotate, parser_hum_eval, parser_train, parser_test, parser_visualize]:
+    parser_benchmark = subparsers.add_parser("benchmark", help="Benchmark KT model throughput")
+    parser_benchmark.set_defaults(func=benchmark)
+    parser_benchmark.add_argument("--benchmark", type=str, choices=["compile", "attention", "kv_cache", "packed", "streaming", "stacked", "lmkt_cpu", "lmkt_incremental", "lmkt_prefix_cache"], default="compile", help="Benchmark to run - compile: eager vs compiled training throughput, attention: simpleKT fused vs reference attention equivalence and throughput, kv_cache: cached incremental vs full recompute online inference equivalence and latency, packed: DKT-family length-sorted vs padded LSTM equivalence and throughput, streaming: DKT-Multi/DKT-Sem turn-by-turn streaming vs full forward equivalence and per-turn latency, stacked: DKT-family learning rate sweep trained as one stacked model vs independently, per-model validation metrics and training time, lmkt_cpu: LLMKT CPU inference with merged LoRA, bf16 and int8 weights vs f32, lmkt_incremental: LLMKT incremental (kv_cache) vs full prompt inference equivalence and latency with a tiny random Llama, lmkt_prefix_cache: LLMKT prefix cache vs full prompt equivalence, LRU eviction and adapter keying with a tiny random Llama")
+    parser_benchmark.add_argument("--benchmark_epochs", type=int, default=3, help="Number of timed epochs (or steps for attention, sequences for kv_cache, passes over test dialogues for streaming, lmkt_cpu, lmkt_incremental and lmkt_prefix_cache) per mode")
+    parser_benchmark.add_argument("--lr", type=float, help="Learning rate")
+    parser_benchmark.add_argument("--wd", type=float, help="Weight decay")
+
+    parser_export = subparsers.add_parser("export", help="Export trained DKT family model to ONNX and check ONNX Runtime outputs against PyTorch")
+    parser_export.set_defaults(func=export)
+
+    for subparser in [parser_annotate, parser_hum_eval, parser_train, parser_test, parser_visualize, parser_benchmark, parser_export]:
         subparser.add_argument("--dataset", type=str, choices=["comta", "mathdial"], default="comta", help="Which dataset to use")
         subparser.add_argument("--split_by_subject", action="store_true", help="For CoMTA, define train/test and folds using subjects")
         subparser.add_argument("--typical_cutoff", type=int, default=1, help="For MathDial, lowest acceptable dialogue 'typical' score")
         subparser.add_argument("--tag_src", type=str, choices=["base", "atc"], default="atc", help="Source of KC tags - base: generated by LLM, atc: ATC standards")
         subparser.add_argument("--debug", action="store_true", help="Use subset of data for debugging")
 
-    for subparser in [parser_train, parser_test, parser_visualize]:
+    for subparser in [parser_train, parser_test, parser_visualize, parser_benchmark, parser_export]:
         subparser.add_argument("--model_type", type=str, choices=["lmkt", "random", "majority", "bkt"] + BASELINE_MODELS, default="lmkt", help="Model architecture to use")
         subparser.add_argument("--model_name", type=str, help="Name of model to save for training or load for testing")
         subparser.add_argument("--base_model", type=str, default="meta-llama/Meta-Llama-3.1-8B-Instruct", help="HuggingFace base model for LLMKT")
         subparser.add_argument("--inc_first_label", action="store_true", help="Include first turn label in dialogues when testing")
 
-    for subparser in [parser_train, parser_test]:
+    for subparser in [parser_train, parser_test, parser_benchmark, parser_export]:
         subparser.add_argument("--batch_size", type=int, help="Model batch size")
+        subparser.add_argument("--num_workers", type=int, default=0, help="Number of worker processes for data loading")
         subparser.add_argument("--crossval", action="store_true", help="Run training/testing over all folds and aggregate results")
         subparser.add_argument("--testonval", action="store_true", help="Run testing phase on validation set (automatic for hyperparam_sweep)")
         subparser.add_argument("--agg", type=str, choices=["prod", "mean-ar", "mean-geo"], default="mean-geo", help="Method for aggregating KC probabilities into correctness probability")
+        subparser.add_argument("--eval_all_aggs", type=bool_type, default=False, help="When testing, also compute metrics for the other aggregation methods from the same predictions")
+        subparser.add_argument("--eval_val_and_test", type=bool_type, default=False, help="When testing, evaluate on both validation and test sets with the same loaded model")
         subparser.add_argument("--pack_kcs", type=bool_type, default=True, help="For LLMKT, pack all KCs for a turn in a single prompt")
-        subparser.add_argument("--quantize", type=bool_type, default=False, help="Quantize LLMKT base model")
+        subparser.add_argument("--quantize", type=bool_type, default=False, help="Quantize LLMKT base model (bitsandbytes int8 on GPU, dynamic int8 Linear layers on CPU for testing only)")
+        subparser.add_argument("--merge_lora", type=bool_type, default=False, help="For LLMKT testing, merge LoRA adapters into base weights (always done when quantizing on CPU)")
+        subparser.add_argument("--cpu_dtype", type=str, choices=["bf16", "fp32"], default="bf16", help="For LLMKT on CPU (no GPU available), dtype of non-quantized weights")
+        subparser.add_argument("--cpu_threads", type=int, default=0, help="For LLMKT on CPU, number of intra-op threads (0 for PyTorch default)")
+        subparser.add_argument("--kv_cache", type=bool_type, default=False, help="For LLMKT testing, reuse KV cache of dialogue history across turns")
+        subparser.add_argument("--prefix_cache_tokens", type=int, default=0, help="For LLMKT testing, max tokens of shared prompt prefix KV states to cache (0 to disable)")
         subparser.add_argument("--prompt_inc_labels", type=bool_type, default=False, help="For LLMKT, include explicit correctness and KC labels in prompt")
         subparser.add_argument("--emb_size", type=int, help="Latent state dimension for DKT family models")
+        subparser.add_argument("--compile", type=bool_type, default=False, help="For DKT family models, run model and loss with torch.compile, padding batches to length buckets to limit recompiles (only recommended on GPU, usually slower than eager on CPU)")
 
     args = parser.parse_args()
     args.func(args)
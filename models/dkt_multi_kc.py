@@ -3,11 +3,21 @@ DKT model that averages KC embeddings per item
 Based on pykt implementation: https://github.com/pykt-team/pykt-toolkit/blob/main/pykt/models/dkt.py
 """
 
+from typing import Optional, Tuple
 import torch
-from torch.nn import Module, Embedding, LSTM, Linear, Dropout
+import torch.nn.functional as F
+from torch.nn import Module, Embedding, LSTM, Dropout
 
+from models.output_head import GatheredLinear
+from models.packed_lstm import run_lstm
 from utils import device
 
+def get_kc_weights(batch, dtype: torch.dtype):
+    # Weights for averaging each turn's KC embeddings (B x L x K), padded KC ids get weight 0 instead of being masked out,
+    # which keeps shapes static under compile
+    kc_mask = torch.arange(batch["kc_ids"].shape[2], device=device) < batch["num_kcs"].unsqueeze(2)
+    return kc_mask.type(dtype) / torch.clip(batch["num_kcs"], min=1).unsqueeze(2)
+
 class DKTMultiKC(Module):
     def __init__(self, num_kcs: int, emb_size: int, dropout=0.1):
         super().__init__()
@@ -19,29 +29,46 @@ class DKTMultiKC(Module):
 
         self.lstm_layer = LSTM(self.emb_size, self.hidden_size, batch_first=True)
         self.dropout_layer = Dropout(dropout)
-        self.out_layer = Linear(self.hidden_size, self.num_kcs)
+        self.out_layer = GatheredLinear(self.hidden_size, self.num_kcs)
 
         print("trainable params:", sum([param.numel() for param in self.parameters()]))
 
-    def forward(self, batch):
+    def embed(self, batch):
         batch_size, max_seq_len, max_num_kcs = batch["kc_ids"].shape
 
-        # Get KC embeddings
-        xemb = self.interaction_emb(batch["kc_ids"]) # B x L x K x D
-        # Mask out padded KC ids
-        kc_pad_mask = torch.arange(max_num_kcs).repeat(batch_size, max_seq_len, 1).to(device) >= batch["num_kcs"].unsqueeze(2)
-        zeros = torch.zeros_like(xemb).to(device)
-        xemb = torch.masked_scatter(xemb, kc_pad_mask.unsqueeze(3), zeros)
-        # Average KC embeddings
-        xemb = xemb.sum(dim=2) / batch["num_kcs"].unsqueeze(2) # B x L x D
+        # Average KC embeddings per turn with an embedding bag over the padded KC ids, so B x L x K x D is never materialized
+        xemb = F.embedding_bag(
+            batch["kc_ids"].view(-1, max_num_kcs), self.interaction_emb.weight, mode="sum",
+            per_sample_weights=get_kc_weights(batch, self.interaction_emb.weight.dtype).view(-1, max_num_kcs)
+        )
+        xemb = xemb.view(batch_size, max_seq_len, self.emb_size) # B x L x D
         # Add correctness embeddings, clip is so padding labels don't go out of range
         correct_emb = self.interaction_emb(self.num_kcs + torch.clip(batch["labels"], min=0)) # B x L x D
         xemb += correct_emb
+        return xemb
 
-        # Run embeddings through LSTM to get output predictions
-        h, _ = self.lstm_layer(xemb)
+    def predict(self, h: torch.Tensor, next_kc_ids: Optional[torch.Tensor] = None):
         h = self.dropout_layer(h)
+        if next_kc_ids is not None:
+            # Only score requested KCs for the following turn
+            return torch.sigmoid(self.out_layer.forward_gathered(h[:, :-1], next_kc_ids)) # B x L-1 x K
         y = self.out_layer(h)
         y = torch.sigmoid(y) # B x L x K(all)
-
         return y
+
+    def forward(self, batch, next_kc_ids: Optional[torch.Tensor] = None):
+        """
+        Run embeddings through LSTM to get output predictions for all KCs (B x L x K(all)), skipping padded steps if seq_lens in batch
+        If next_kc_ids is given (B x L-1 x K), only those KCs are scored at each turn for the following turn (B x L-1 x K)
+        """
+        h = run_lstm(self.lstm_layer, self.embed(batch), batch.get("seq_lens"))
+        return self.predict(h, next_kc_ids)
+
+    def step(self, state: Optional[Tuple[torch.Tensor, torch.Tensor]], turn: dict):
+        """
+        Advance B sessions by one turn, carrying the LSTM (h, c) state so each turn costs the same regardless of history length
+        state is None for new sessions, turn has kc_ids (B x K), num_kcs (B) and labels (B), see models/streaming.py
+        Returns new state and KC probabilities after the turn (B x K(all)), same as forward at the same position up to float rounding
+        """
+        h, state = self.lstm_layer(self.embed({key: val.unsqueeze(1) for key, val in turn.items()}), state)
+        return state, self.predict(h)[:, 0]
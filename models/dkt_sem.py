@@ -1,6 +1,9 @@
+from typing import Optional, Tuple
 import torch
 from torch import nn
 
+from models.packed_lstm import run_lstm
+
 ALT_ARCH = False
 
 class DKTSem(nn.Module):
@@ -23,7 +26,7 @@ class DKTSem(nn.Module):
         self.dropout_layer = nn.Dropout(dropout)
         self.out_layer = nn.Linear(emb_size, text_emb_size)
 
-    def forward(self, batch):
+    def embed(self, batch):
         # Get input vectors from transformed text embeddings and correctness embedding
         if ALT_ARCH:
             xemb = self.input_encoder(batch["turn_embs"])
@@ -33,12 +36,33 @@ class DKTSem(nn.Module):
             )
             correctness_emb = self.correctness_encoder(torch.clip(batch["labels"], min=0))
             xemb = text_emb + correctness_emb
+        return xemb
 
-        # Run embeddings through LSTM, compute bilinear with KC embedding matrix to get predictions
-        h, _ = self.lstm_layer(xemb)
+    def predict(self, h: torch.Tensor, next_kc_ids: Optional[torch.Tensor] = None):
+        # Compute bilinear with KC embedding matrix to get predictions
         h = self.dropout_layer(h)
         h_text_space = self.out_layer(h)
-        y = torch.bmm(h_text_space, self.kc_emb_matrix.T.unsqueeze(0).expand(batch["labels"].shape[0], -1, -1))
+        if next_kc_ids is not None:
+            # Only score requested KCs for the following turn with a dot product against their gathered embeddings
+            y = torch.matmul(self.kc_emb_matrix[next_kc_ids], h_text_space[:, :-1].unsqueeze(3)).squeeze(3)
+            return torch.sigmoid(y) # B x L-1 x K
+        y = torch.bmm(h_text_space, self.kc_emb_matrix.T.unsqueeze(0).expand(h.shape[0], -1, -1))
         y = torch.sigmoid(y) # B x L x K(all)
-
         return y
+
+    def forward(self, batch, next_kc_ids: Optional[torch.Tensor] = None):
+        """
+        Run embeddings through LSTM to get output predictions for all KCs (B x L x K(all)), skipping padded steps if seq_lens in batch
+        If next_kc_ids is given (B x L-1 x K), only those KCs are scored at each turn for the following turn (B x L-1 x K)
+        """
+        h = run_lstm(self.lstm_layer, self.embed(batch), batch.get("seq_lens"))
+        return self.predict(h, next_kc_ids)
+
+    def step(self, state: Optional[Tuple[torch.Tensor, torch.Tensor]], turn: dict):
+        """
+        Advance B sessions by one turn, carrying the LSTM (h, c) state so each turn costs the same regardless of history length
+        state is None for new sessions, turn has text embeddings (B x D) and labels (B), see models/streaming.py
+        Returns new state and KC probabilities after the turn (B x K(all)), same as forward at the same position up to float rounding
+        """
+        h, state = self.lstm_layer(self.embed({key: val.unsqueeze(1) for key, val in turn.items()}), state)
+        return state, self.predict(h)[:, 0]
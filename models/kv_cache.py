@@ -0,0 +1,208 @@
+"""
+Incremental inference for the attention-based KT baselines (simpleKT, AKT, SAINT) in online use, where one interaction is appended at a time
+Per-layer keys and values of the processed prefix are cached, so a new position only attends over the cache, O(L) per prediction instead of O(L^2)
+Models should be in eval mode, step outputs match the full-sequence forward at the same position up to float rounding
+"""
+
+import math
+from abc import ABC, abstractmethod
+import torch
+import torch.nn.functional as F
+from torch.nn import Module, MultiheadAttention
+from pykt.models.akt import AKT
+from pykt.models.saint import SAINT
+
+from models.simplekt import simpleKT
+
+def split_heads(x: torch.Tensor, num_heads: int):
+    # B x D -> B x H x 1 x D/H
+    return x.view(x.shape[0], num_heads, 1, -1)
+
+def merge_heads(x: torch.Tensor):
+    # B x H x 1 x D/H -> B x D
+    return x.reshape(x.shape[0], -1)
+
+class IncrementalKT(ABC):
+    """
+    Base class for cached inference of B sequences advanced in lockstep
+    step(kc_ids, labels) appends interaction t (KC id and correctness, both of size B) and returns the model outputs at position t (B x K(all)),
+    same as forward(...)[:, t] - these outputs don't depend on the correctness at t, which is only cached for later positions
+    """
+
+    def __init__(self, model: Module):
+        self.model = model
+        self.reset()
+
+    def reset(self):
+        self.num_steps = 0
+        self.cache = {}
+
+    def extend_cache(self, name: str, key: torch.Tensor, value: torch.Tensor):
+        # Append keys and values of the current position (B x H x 1 x D/H) to a layer's cache and return the full cache
+        if name in self.cache:
+            prev_keys, prev_values = self.cache[name]
+            key = torch.concat([prev_keys, key], dim=2)
+            value = torch.concat([prev_values, value], dim=2)
+        self.cache[name] = (key, value)
+        return key, value
+
+    def get_cache(self, name: str):
+        return self.cache[name]
+
+    @abstractmethod
+    def forward_step(self, kc_ids: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+        pass
+
+    @torch.no_grad()
+    def step(self, kc_ids: torch.Tensor, labels: torch.Tensor):
+        outputs = self.forward_step(kc_ids, labels)
+        self.num_steps += 1
+        return outputs
+
+class SimpleKTIncremental(IncrementalKT):
+    """
+    Each layer attends from the current question to previous questions and interactions (values are interaction embeddings for all layers)
+    The first position can't see anything, so its attention output is zero like zero_pad in the full forward
+    """
+
+    def __init__(self, model: simpleKT):
+        assert model.emb_type == "qid" and not model.separate_qa
+        super().__init__(model)
+
+    def forward_step(self, kc_ids: torch.Tensor, labels: torch.Tensor):
+        model = self.model
+        q_embed_data = model.q_embed(kc_ids)
+        qa_embed_data = model.qa_embed(labels) + q_embed_data
+        if model.n_pid > 0:
+            q_embed_data = q_embed_data + model.difficult_param(kc_ids) * model.q_embed_diff(kc_ids)
+        pos_emb = model.model.position_emb.weight[0, self.num_steps]
+        x = q_embed_data + pos_emb
+        y = qa_embed_data + pos_emb
+        for layer_idx, block in enumerate(model.model.blocks_2):
+            attn = block.masked_attn_head
+            query = split_heads((attn.k_linear if attn.kq_same else attn.q_linear)(x), attn.h)
+            if self.num_steps == 0:
+                attn_out = torch.zeros_like(query)
+            else:
+                keys, values = self.get_cache(layer_idx)
+                attn_out = F.scaled_dot_product_attention(query, keys, values, scale=1 / math.sqrt(attn.d_k))
+            # Current position is only visible to later positions
+            self.extend_cache(layer_idx, split_heads(attn.k_linear(x), attn.h), split_heads(attn.v_linear(y), attn.h))
+            x = block.layer_norm1(x + attn.out_proj(merge_heads(attn_out)))
+            x = block.layer_norm2(x + block.linear2(block.activation(block.linear1(x))))
+        return torch.sigmoid(model.out(torch.concat([x, q_embed_data], dim=-1)))
+
+class AKTIncremental(IncrementalKT):
+    """
+    Monotonic attention only depends on the query's own row of scores, so it can be computed for the current position from the cached keys
+    Interaction encoder (blocks_1) and question self-attention layers can see the current position, knowledge retriever layers only previous ones
+    """
+
+    def __init__(self, model: AKT):
+        assert model.emb_type == "qid" and not model.separate_qa
+        super().__init__(model)
+
+    def attend(self, attn: Module, query: torch.Tensor, keys: torch.Tensor, values: torch.Tensor):
+        # Same as pykt AKT attention for one query row over all visible keys, which precede the query by num_steps - key idx
+        scores = torch.matmul(query, keys.transpose(-2, -1)) / math.sqrt(attn.d_k) # B x H x 1 x N
+        scores_ = F.softmax(scores, dim=-1)
+        distcum_scores = torch.cumsum(scores_, dim=-1)
+        disttotal_scores = torch.sum(scores_, dim=-1, keepdim=True)
+        position_effect = (self.num_steps - torch.arange(keys.shape[2], device=keys.device)).type(scores.dtype)
+        dist_scores = torch.clamp((disttotal_scores - distcum_scores) * position_effect, min=0.).sqrt()
+        gamma = -1. * F.softplus(attn.gammas).unsqueeze(0)
+        total_effect = torch.clamp(torch.clamp((dist_scores * gamma).exp(), min=1e-5), max=1e5)
+        return torch.matmul(F.softmax(scores * total_effect, dim=-1), values)
+
+    def block_step(self, name: str, block: Module, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                   peek_current: bool, apply_pos: bool):
+        attn = block.masked_attn_head
+        query_heads = split_heads((attn.k_linear if attn.kq_same else attn.q_linear)(query), attn.h)
+        key_heads = split_heads(attn.k_linear(key), attn.h)
+        value_heads = split_heads(attn.v_linear(value), attn.h)
+        if peek_current:
+            attn_out = self.attend(attn, query_heads, *self.extend_cache(name, key_heads, value_heads))
+        else:
+            attn_out = torch.zeros_like(query_heads) if self.num_steps == 0 else self.attend(attn, query_heads, *self.get_cache(name))
+            self.extend_cache(name, key_heads, value_heads)
+        query = block.layer_norm1(query + attn.out_proj(merge_heads(attn_out)))
+        if apply_pos:
+            query = block.layer_norm2(query + block.linear2(block.activation(block.linear1(query))))
+        return query
+
+    def forward_step(self, kc_ids: torch.Tensor, labels: torch.Tensor):
+        model = self.model
+        q_embed_data = model.q_embed(kc_ids)
+        qa_embed_data = model.qa_embed(labels) + q_embed_data
+        if model.n_pid > 0:
+            q_embed_diff_data = model.q_embed_diff(kc_ids)
+            pid_embed_data = model.difficult_param(kc_ids)
+            q_embed_data = q_embed_data + pid_embed_data * q_embed_diff_data
+            qa_embed_data = qa_embed_data + pid_embed_data * (model.qa_embed_diff(labels) + q_embed_diff_data)
+        y = qa_embed_data
+        for layer_idx, block in enumerate(model.model.blocks_1):
+            y = self.block_step(f"blocks_1.{layer_idx}", block, y, y, y, True, True)
+        x = q_embed_data
+        for layer_idx, block in enumerate(model.model.blocks_2):
+            if layer_idx % 2 == 0:
+                x = self.block_step(f"blocks_2.{layer_idx}", block, x, x, x, True, False)
+            else:
+                x = self.block_step(f"blocks_2.{layer_idx}", block, x, x, y, False, True)
+        return torch.sigmoid(model.out(torch.concat([x, q_embed_data], dim=-1)))
+
+class SAINTIncremental(IncrementalKT):
+    """
+    Encoder self-attention, decoder self-attention and decoder cross-attention over encoder outputs are all causal including the current position
+    The decoder input at each position is the previous correctness (start token at the first position), so labels are kept for the next step
+    """
+
+    def __init__(self, model: SAINT):
+        assert model.emb_type == "qid"
+        super().__init__(model)
+        self.prev_labels = None
+
+    def reset(self):
+        super().reset()
+        self.prev_labels = None
+
+    def attend(self, name: str, mha: MultiheadAttention, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor):
+        # Same as nn.MultiheadAttention for one query position over all cached positions and the current one
+        weight_q, weight_k, weight_v = mha.in_proj_weight.chunk(3)
+        bias_q, bias_k, bias_v = mha.in_proj_bias.chunk(3)
+        query_heads = split_heads(F.linear(query, weight_q, bias_q), mha.num_heads)
+        keys, values = self.extend_cache(
+            name, split_heads(F.linear(key, weight_k, bias_k), mha.num_heads), split_heads(F.linear(value, weight_v, bias_v), mha.num_heads)
+        )
+        return mha.out_proj(merge_heads(F.scaled_dot_product_attention(query_heads, keys, values)))
+
+    def forward_step(self, kc_ids: torch.Tensor, labels: torch.Tensor):
+        model = self.model
+        pos_emb = model.embd_pos.weight[self.num_steps]
+        en_out = None
+        for layer_idx, block in enumerate(model.encoder):
+            out = block.embd_ex(kc_ids) + block.emb_cat(kc_ids) + pos_emb if layer_idx == 0 else en_out
+            out = block.layer_norm1(out)
+            out = out + self.attend(f"encoder.{layer_idx}", block.multi_en, out, out, out)
+            out = block.layer_norm2(out)
+            en_out = out + block.ffn_en(out)
+        prev_labels = torch.full_like(labels, 2) if self.prev_labels is None else self.prev_labels
+        self.prev_labels = labels
+        out = None
+        for layer_idx, block in enumerate(model.decoder):
+            out = block.embd_res(prev_labels) + pos_emb if layer_idx == 0 else out
+            out = block.layer_norm1(out)
+            out = out + self.attend(f"decoder.{layer_idx}.self", block.multi_de1, out, out, out)
+            en_out_norm = block.layer_norm2(en_out)
+            out = out + self.attend(f"decoder.{layer_idx}.cross", block.multi_de2, out, en_out_norm, en_out_norm)
+            out = block.layer_norm3(out)
+            out = out + block.ffn_en(out)
+        return torch.sigmoid(model.out(out))
+
+def get_incremental_model(model: Module):
+    if isinstance(model, simpleKT):
+        return SimpleKTIncremental(model)
+    if isinstance(model, AKT):
+        return AKTIncremental(model)
+    if isinstance(model, SAINT):
+        return SAINTIncremental(model)
+    raise Exception(f"Cached inference not supported for {type(model).__name__}")
@@ -1,33 +1,134 @@
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
-from peft import LoraConfig, PeftModel, get_peft_model, prepare_model_for_kbit_training
+from torch.nn import Linear
+from torch.ao.quantization import quantize_dynamic
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, LlamaConfig, LlamaForCausalLM
+from peft import LoraConfig, PeftModel, get_peft_model, prepare_model_for_kbit_training, get_peft_model_state_dict
 
-from utils import get_checkpoint_path
+from utils import get_checkpoint_path, device
+
+LORA_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
 
 bnb_config = BitsAndBytesConfig(
     load_in_8bit=True,
 )
 
-def get_base_model(base_model_name: str, tokenizer: AutoTokenizer, quantize: bool):
+# Without a GPU (or with CUDA_VISIBLE_DEVICES empty), models run on CPU - bitsandbytes is GPU only,
+# so quantization is instead done with PyTorch dynamic int8 quantization of Linear layers after loading, for inference only
+on_cpu = device.type == "cpu"
+
+def set_cpu_threads(num_threads: int):
+    # Intra-op threads for CPU inference, 0 keeps the PyTorch default (number of physical cores)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+def get_dtype(quantize: bool, cpu_dtype: str):
+    # f32 seems helpful for train/test time consistency when quantizing, bf16 performs best for non-quantized
+    # Dynamic quantization on CPU also needs f32 weights, and fp32 can be faster than bf16 on CPUs without native bf16 support
+    if quantize or (on_cpu and cpu_dtype == "fp32"):
+        return torch.float32
+    return torch.bfloat16
+
+def get_tokenizer(base_model_name: str):
+    tokenizer = AutoTokenizer.from_pretrained(base_model_name, padding_side="right")
+    tokenizer.pad_token = tokenizer.bos_token # Have to pick some token, and eos triggers a warning
+    return tokenizer
+
+def get_base_model(base_model_name: str, tokenizer: AutoTokenizer, quantize: bool, cpu_dtype: str = "bf16"):
     base_model = AutoModelForCausalLM.from_pretrained(
         base_model_name,
         pad_token_id=tokenizer.pad_token_id,
-        quantization_config=bnb_config if quantize else None,
-        # f32 seems helpful for train/test time consistency when quantizing, bf16 performs best for non-quantized
-        torch_dtype=torch.float32 if quantize else torch.bfloat16,
-        device_map={"": 0}
+        quantization_config=bnb_config if quantize and not on_cpu else None,
+        torch_dtype=get_dtype(quantize, cpu_dtype),
+        device_map={"": "cpu" if on_cpu else 0}
     )
     base_model.config.use_cache = False
     base_model.config.pretraining_tp = 1
     return base_model
 
+# Small Llama architecture for checking inference paths, outputs are meaningless but exercise the same attention and KV cache code
+TINY_LLAMA_CONFIG = {
+    "hidden_size": 64,
+    "intermediate_size": 128,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 4,
+    "num_key_value_heads": 2,
+    "max_position_embeddings": 8192
+}
+
+def get_tiny_random_model(base_model_name: str):
+    # Randomly initialized f32 tiny Llama using the tokenizer of base_model_name, so prompts are tokenized like with the full model
+    tokenizer = get_tokenizer(base_model_name)
+    torch.manual_seed(221)
+    config = LlamaConfig(vocab_size=len(tokenizer), pad_token_id=tokenizer.pad_token_id, **TINY_LLAMA_CONFIG)
+    model = LlamaForCausalLM(config).to(device)
+    model.config.use_cache = False
+    return model.eval(), tokenizer
+
+def quantize_cpu_model(model):
+    # Dynamic int8 quantization of decoder Linear layers, the LM head is kept in f32 since only its True/False rows are used
+    quantize_dynamic(model.get_decoder(), {Linear}, dtype=torch.qint8, inplace=True)
+
+# Base models loaded in this process, shared across crossval folds and hyperparameter sweep configs
+# LoRA adapters are injected into the shared model and removed again with release_model
+_base_model_registry = {}
+
+def get_registered_base_model(base_model_name: str, quantize: bool, cpu_dtype: str = "bf16"):
+    key = (base_model_name, quantize, get_dtype(quantize, cpu_dtype))
+    if key not in _base_model_registry:
+        tokenizer = get_tokenizer(base_model_name)
+        _base_model_registry[key] = (get_base_model(base_model_name, tokenizer, quantize, cpu_dtype), tokenizer)
+    return _base_model_registry[key]
+
+def get_merged_model(base_model_name: str, model_name: str, quantize: bool, cpu_dtype: str):
+    """
+    Load inference-time model with LoRA adapters merged into the base weights, so no adapter layers run at inference
+    Merging changes the base weights, so this loads a separate copy of the base model instead of the shared registered one
+    On CPU with quantize, Linear layers are dynamically quantized after merging
+    """
+    tokenizer = get_tokenizer(base_model_name)
+    model = get_base_model(base_model_name, tokenizer, quantize, cpu_dtype)
+    if model_name:
+        print("Initializing inference-time model with merged LoRA adapters")
+        model = PeftModel.from_pretrained(model, get_checkpoint_path(model_name)).merge_and_unload()
+    else:
+        print("Initializing inference-time model from pre-trained weights")
+    if on_cpu and quantize:
+        quantize_cpu_model(model)
+    return model, tokenizer
+
+def release_model(model):
+    # Remove LoRA layers in place, restoring the registered base model for the next fold/config
+    if isinstance(model, PeftModel):
+        model.unload()
+
+def get_adapter_state(model: PeftModel):
+    # Copy of current adapter weights, for keeping the best checkpoint in memory during training
+    return {key: val.detach().to("cpu", copy=True) for key, val in get_peft_model_state_dict(model).items()}
+
+def get_causal_lm(model):
+    # LoRA layers are injected in place, so the wrapped model runs with adapters applied
+    return model.get_base_model() if isinstance(model, PeftModel) else model
+
+def get_true_false_logits(model, query_idxs: tuple, true_token: int, false_token: int, **model_kwargs):
+    # Run decoder without LM head and only project hidden states at query positions onto True/False token rows
+    # Avoids materializing full vocabulary logits at every position
+    causal_lm = get_causal_lm(model)
+    hidden_states = causal_lm.get_decoder()(**model_kwargs).last_hidden_state[query_idxs]
+    out_weight = causal_lm.get_output_embeddings().weight[[true_token, false_token]]
+    return (hidden_states @ out_weight.T).float()
+
 def get_model(base_model_name: str, test: bool,
               model_name: str = None, pt_model_name: str = None,
               r: int = None, lora_alpha: int = None,
-              quantize: bool = True, use_gradient_checkpointing: bool = True):
-    tokenizer = AutoTokenizer.from_pretrained(base_model_name, padding_side="right")
-    tokenizer.pad_token = tokenizer.bos_token # Have to pick some token, and eos triggers a warning
-    model = get_base_model(base_model_name, tokenizer, quantize)
+              quantize: bool = True, use_gradient_checkpointing: bool = True,
+              merge_lora: bool = False, cpu_dtype: str = "bf16", cpu_threads: int = 0):
+    if on_cpu:
+        set_cpu_threads(cpu_threads)
+        if quantize and not test:
+            raise Exception("Quantized LLMKT training needs a GPU, quantization on CPU is only supported for inference")
+    if test and (merge_lora or (on_cpu and quantize)):
+        return get_merged_model(base_model_name, model_name, quantize, cpu_dtype)
+    model, tokenizer = get_registered_base_model(base_model_name, quantize, cpu_dtype)
     if test and model_name:
         # Note we are loading adapter on quantized model and not merging
         # Recommended here - https://huggingface.co/docs/trl/main/en/dpo_trainer#downsides-to-merging-qlora-before-dpo-approach-2
@@ -43,7 +144,7 @@ def get_model(base_model_name: str, test: bool,
         else:
             print("Initializing trainable model with new LoRA adapters")
             peft_config = LoraConfig(
-                target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
+                target_modules=LORA_TARGET_MODULES,
                 r=r,
                 lora_alpha=lora_alpha,
                 lora_dropout=0.05,
@@ -0,0 +1,177 @@
+from typing import List
+from collections import OrderedDict
+import copy
+import torch
+from transformers import DynamicCache
+
+from models.lm import get_causal_lm, get_true_false_logits
+from prompting import get_true_false_tokens, DIALOGUE_START
+from utils import device
+
+def get_common_prefix_len(seq_1: List[int], seq_2: List[int]):
+    max_len = min(len(seq_1), len(seq_2))
+    for idx in range(max_len):
+        if seq_1[idx] != seq_2[idx]:
+            return idx
+    return max_len
+
+class LMKTIncrementalEngine:
+    """
+    Computes LMKT KC probabilities one sample at a time, keeping the KV cache of the previous sample's shared prefix
+    Samples from the same dialogue arrive in turn order, so only the new dialogue text and the KC query branches are encoded
+    """
+
+    def __init__(self, model, tokenizer, pack_kcs: bool):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.pack_kcs = pack_kcs
+        self.true_token, self.false_token = get_true_false_tokens(tokenizer)
+        self.cache = DynamicCache()
+        self.cached_ids = []
+
+    def split_sample(self, sample: dict):
+        # Split sample into context token ids (trunk) shared by all KCs and a continuation (branch) per KC
+        # Query idxs are relative to the start of each branch
+        if self.pack_kcs:
+            # Mirrors LMKTCollatorPacked - KC continuations replace the eos at end of context and attend to everything before it
+            ids = self.tokenizer(sample["prompt"]).input_ids
+            eos_idxs = [idx for idx, token in enumerate(ids) if token == self.tokenizer.eos_token_id]
+            context_end_idx = eos_idxs[1]
+            branches = []
+            query_idxs = []
+            start_idx = context_end_idx + 1
+            for end_idx in eos_idxs[3::2]:
+                branches.append(ids[start_idx : end_idx + 1])
+                query_idxs.append(end_idx - 1 - start_idx)
+                start_idx = end_idx + 1
+            return ids[:context_end_idx], branches, query_idxs
+        # Mirrors LMKTCollatorUnpacked - separate prompt per KC, share everything up to the first difference
+        prompts_ids = self.tokenizer(sample["prompts"]).input_ids
+        trunk_len = min(len(ids) for ids in prompts_ids) - 2 # Keep the token before eos in every branch
+        for ids in prompts_ids[1:]:
+            trunk_len = min(trunk_len, get_common_prefix_len(prompts_ids[0], ids))
+        branches = [ids[trunk_len:] for ids in prompts_ids]
+        query_idxs = [len(ids) - 2 - trunk_len for ids in prompts_ids]
+        return prompts_ids[0][:trunk_len], branches, query_idxs
+
+    def extend_trunk(self, trunk_ids: List[int]):
+        # Drop cached tokens that diverge from the new trunk and encode the remainder
+        prefix_len = get_common_prefix_len(self.cached_ids, trunk_ids)
+        if prefix_len == 0:
+            self.cache = DynamicCache()
+        else:
+            self.cache.crop(prefix_len)
+        if prefix_len < len(trunk_ids):
+            # No logits needed for trunk, so skip LM head
+            get_causal_lm(self.model).get_decoder()(
+                input_ids=torch.LongTensor([trunk_ids[prefix_len:]]).to(device),
+                past_key_values=self.cache,
+                use_cache=True
+            )
+        self.cached_ids = trunk_ids
+
+    def predict(self, sample: dict):
+        trunk_ids, branches, query_idxs = self.split_sample(sample)
+        self.extend_trunk(trunk_ids)
+        trunk_len = len(trunk_ids)
+
+        # Pack all branches into one sequence, each attending to the cached trunk and causally to itself
+        branch_lens = [len(branch) for branch in branches]
+        total_len = sum(branch_lens)
+        min_dtype = torch.finfo(self.model.dtype).min
+        attention_mask = torch.full((total_len, trunk_len + total_len), min_dtype)
+        attention_mask[:, :trunk_len] = 0
+        position_ids = torch.zeros(total_len, dtype=torch.long)
+        abs_query_idxs = []
+        start_idx = 0
+        for branch_len, query_idx in zip(branch_lens, query_idxs):
+            end_idx = start_idx + branch_len
+            branch_mask = torch.full((branch_len, branch_len), min_dtype).triu(diagonal=1)
+            attention_mask[start_idx : end_idx, trunk_len + start_idx : trunk_len + end_idx] = branch_mask
+            position_ids[start_idx : end_idx] = torch.arange(trunk_len, trunk_len + branch_len)
+            abs_query_idxs.append(start_idx + query_idx)
+            start_idx = end_idx
+        logits = get_true_false_logits(
+            self.model, (0, abs_query_idxs), self.true_token, self.false_token,
+            input_ids=torch.LongTensor([[token for branch in branches for token in branch]]).to(device),
+            attention_mask=attention_mask.type(self.model.dtype)[None, None].to(device),
+            position_ids=position_ids.unsqueeze(0).to(device),
+            past_key_values=self.cache,
+            use_cache=True
+        )
+        # Branches are never reused, so roll cache back to the trunk
+        self.cache.crop(trunk_len)
+
+        # Return probability of True token over False token for each KC
+        return torch.softmax(logits, dim=1)[:, 0]
+
+class LMKTPrefixCache:
+    """
+    LRU cache of KV states for prompt prefixes that are shared across batches
+    Two levels are cached: the system prompt (shared by all samples) and the dialogue context before the dialogue text
+    (e.g., the MathDial problem and solutions, shared by all turns of a dialogue)
+    Entries are keyed by active adapter and exact token ids, so a hit is always equivalent to recomputing the prefix
+    Stored entries are never modified - forward passes append to a cache and batch_repeat_interleave expands it in place,
+    so new entries extend a copy of the shorter prefix's entry and get returns a copy (checked by "benchmark --benchmark lmkt_prefix_cache")
+    """
+
+    def __init__(self, model, tokenizer, max_tokens: int):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.entries = OrderedDict()
+        self.num_tokens = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.num_tokens = 0
+
+    def get_prefix_lens(self, input_ids: torch.Tensor, last_idxs: torch.Tensor, prompt: str):
+        # Prefix must be shared by all sequences in the batch and end before the first query position
+        shared_len = (input_ids == input_ids[:1]).all(dim=0).long().cumprod(dim=0).sum().item()
+        max_len = min(shared_len, last_idxs[last_idxs > 0].min().item())
+        ids = input_ids[0].tolist()
+        system_len = ids.index(self.tokenizer.eos_token_id) + 1
+        context_ids = self.tokenizer(prompt[:prompt.index(DIALOGUE_START)]).input_ids
+        context_len = get_common_prefix_len(context_ids, ids)
+        return [prefix_len for prefix_len in sorted({system_len, context_len}) if 0 < prefix_len <= max_len]
+
+    def get_entry(self, prefix_ids: List[int]):
+        key = (getattr(self.model, "active_adapter", None), tuple(prefix_ids))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        return None
+
+    def add_entry(self, prefix_ids: List[int], cache: DynamicCache):
+        key = (getattr(self.model, "active_adapter", None), tuple(prefix_ids))
+        self.entries[key] = cache
+        self.num_tokens += len(prefix_ids)
+        # Evict least recently used prefixes until within token budget
+        while self.num_tokens > self.max_tokens and len(self.entries) > 1:
+            (_, evicted_ids), _ = self.entries.popitem(last=False)
+            self.num_tokens -= len(evicted_ids)
+
+    def get(self, input_ids: torch.Tensor, last_idxs: torch.Tensor, prompt: str):
+        """
+        Returns length of the cached prefix and a copy of its KV cache expanded to the batch size
+        The copy is consumed by the forward pass, so the stored entry is never modified
+        """
+        ids = input_ids[0].tolist()
+        cache = None
+        cache_len = 0
+        for prefix_len in self.get_prefix_lens(input_ids, last_idxs, prompt):
+            entry = self.get_entry(ids[:prefix_len])
+            if entry is None:
+                # Extend the next shortest prefix to create a new entry
+                entry = copy.deepcopy(cache) if cache is not None else DynamicCache()
+                get_causal_lm(self.model).get_decoder()(input_ids=input_ids[:1, cache_len:prefix_len], past_key_values=entry, use_cache=True)
+                self.add_entry(ids[:prefix_len], entry)
+            cache = entry
+            cache_len = prefix_len
+        if cache is None:
+            return 0, None
+        cache = copy.deepcopy(cache)
+        if input_ids.shape[0] > 1:
+            cache.batch_repeat_interleave(input_ids.shape[0])
+        return cache_len, cache
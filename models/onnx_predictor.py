@@ -0,0 +1,50 @@
+"""
+ONNX Runtime predictor for DKT-family baselines exported with "main.py export", for serving KT predictions from lightweight CPU workers
+Only needs numpy and onnxruntime, model type and KC dictionary are stored in the ONNX metadata
+"""
+
+import json
+from typing import Dict, List
+import numpy as np
+import onnxruntime as ort
+
+class ONNXKTPredictor:
+    """
+    Runs an exported model on CPU, inputs are numpy arrays with the same names and shapes as DKTDataset batch entries:
+        dkt-multi - kc_ids (B x L x K), num_kcs (B x L), labels (B x L)
+        dkt-sem - teacher_embs, student_embs, kc_embs (B x L x D), labels (B x L), or turn_embs (B x L x D) with ALT_ARCH
+        dkt - kc_ids_flat, labels_flat (B x L(flat))
+    Returns KC probabilities for all KCs at every step (B x L x K(all)), same as the PyTorch model's forward
+    """
+
+    def __init__(self, onnx_path: str, num_threads: int = 0):
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = num_threads # 0 lets ONNX Runtime pick
+        self.session = ort.InferenceSession(onnx_path, session_options, providers=["CPUExecutionProvider"])
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.model_type = metadata["model_type"]
+        self.kc_dict: Dict[str, int] = json.loads(metadata["kc_dict"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def predict(self, inputs: Dict[str, np.ndarray]) -> np.ndarray:
+        return self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+
+    def get_inputs(self, turn_kcs: List[List[str]], labels: List[int]):
+        """
+        Build inputs for a single dialogue from each turn's KCs and correctness, for models that only use KC ids
+        For dkt, the prediction for the turn after turn t is at the index of turn t's last KC
+        """
+        kc_ids = [[self.kc_dict[kc] for kc in kcs] for kcs in turn_kcs]
+        if self.model_type == "dkt-multi":
+            max_num_kcs = max(len(turn_kc_ids) for turn_kc_ids in kc_ids)
+            return {
+                "kc_ids": np.array([[turn_kc_ids + [0] * (max_num_kcs - len(turn_kc_ids)) for turn_kc_ids in kc_ids]], dtype=np.int64),
+                "num_kcs": np.array([[len(turn_kc_ids) for turn_kc_ids in kc_ids]], dtype=np.int64),
+                "labels": np.array([labels], dtype=np.int64)
+            }
+        if self.model_type == "dkt":
+            return {
+                "kc_ids_flat": np.array([[kc_id for turn_kc_ids in kc_ids for kc_id in turn_kc_ids]], dtype=np.int64),
+                "labels_flat": np.array([[label for turn_kc_ids, label in zip(kc_ids, labels) for _ in turn_kc_ids]], dtype=np.int64)
+            }
+        raise Exception(f"Model {self.model_type} needs text embeddings as inputs")
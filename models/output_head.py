@@ -0,0 +1,43 @@
+"""
+Output head for KT baselines that predict all KCs at each position, while the loss only needs the few KCs of the next turn
+Targets can be given so logits are only computed for those KC ids, keeping per-step cost flat as the number of KCs grows
+"""
+
+from contextlib import contextmanager
+import torch
+from torch.nn import Linear
+
+class GatheredLinear(Linear):
+    """
+    Linear layer over all KCs (same parameters as Linear, so checkpoints are interchangeable) that can instead output logits for target KC ids only,
+    using gathered rows of the weight matrix
+    Models that call their head internally (pykt AKT, DKVMN, SAINT, simpleKT) get targets set around the forward pass with gather_targets
+    """
+
+    def __init__(self, in_features: int, out_features: int):
+        super().__init__(in_features, out_features)
+        self.target_idxs = None
+        self.target_kc_ids = None
+
+    def forward_gathered(self, x: torch.Tensor, kc_ids: torch.Tensor):
+        # Dot product with weight rows of target KCs, x is B x L x D and kc_ids is B x L x K, returns B x L x K
+        return torch.matmul(self.weight[kc_ids], x.unsqueeze(3)).squeeze(3) + self.bias[kc_ids]
+
+    def forward(self, x: torch.Tensor):
+        if self.target_kc_ids is None:
+            return super().forward(x)
+        # Only keep positions that have targets
+        x = torch.gather(x, 1, self.target_idxs.unsqueeze(2).expand(-1, -1, x.shape[2]))
+        return self.forward_gathered(x, self.target_kc_ids)
+
+@contextmanager
+def gather_targets(head: GatheredLinear, target_idxs: torch.Tensor, target_kc_ids: torch.Tensor):
+    """
+    Within the context, head only outputs logits for target_kc_ids (B x T x K) at sequence positions target_idxs (B x T)
+    Post-processing in the model (sigmoid, squeeze) is applied as usual, so outputs are B x T x K, or B x T if K is 1
+    """
+    head.target_idxs, head.target_kc_ids = target_idxs, target_kc_ids
+    try:
+        yield
+    finally:
+        head.target_idxs, head.target_kc_ids = None, None
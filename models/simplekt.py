@@ -9,7 +9,7 @@ from torch.nn.init import constant_
 import math
 import torch.nn.functional as F
 from enum import IntEnum
-import numpy as np
+from functools import lru_cache
 from pykt.models.utils import transformer_FFN, ut_mask, pos_encode, get_clones
 from torch.nn import Module, Embedding, LSTM, Linear, Dropout, LayerNorm, TransformerEncoder, TransformerEncoderLayer, \
         MultiLabelMarginLoss, MultiLabelSoftMarginLoss, CrossEntropyLoss, BCELoss, MultiheadAttention
@@ -232,9 +232,7 @@ class TransformerLayer(nn.Module):
         """
 
         seqlen, batch_size = query.size(1), query.size(0)
-        nopeek_mask = np.triu(
-            np.ones((1, 1, seqlen, seqlen)), k=mask).astype('uint8')
-        src_mask = (torch.from_numpy(nopeek_mask) == 0).to(device)
+        src_mask = get_nopeek_mask(seqlen, mask, query.device)
         if mask == 0:  # If 0, zero-padding is needed.
             # Calls block.masked_attn_head.forward() method
             query2 = self.masked_attn_head(
@@ -319,27 +317,29 @@ class MultiHeadAttention(nn.Module):
         return output
 
 
+@lru_cache(maxsize=64)
+def get_nopeek_mask(seqlen, mask, device):
+    """
+    Boolean attention mask (True where attending is allowed), query i can see keys j < i + mask
+    Cached by length so it isn't rebuilt by every layer on every forward
+    With mask=0 the first query can't see any keys, so it is allowed to see the first key to keep softmax finite,
+    its output is then replaced by zeros (zero_pad) like in the original implementation
+    """
+    src_mask = torch.ones(seqlen, seqlen, dtype=torch.bool, device=device).tril(mask - 1)
+    src_mask[0, 0] = True
+    return src_mask
+
+
 def attention(q, k, v, d_k, mask, dropout, zero_pad):
     """
     This is called by Multi-head atention object to find the values.
+    Uses fused scaled dot product attention, dropout is applied to attention weights like before
     """
-    # d_k: 每一个头的dim
-    scores = torch.matmul(q, k.transpose(-2, -1)) / \
-        math.sqrt(d_k)  # BS, 8, seqlen, seqlen
-    bs, head, seqlen = scores.size(0), scores.size(1), scores.size(2)
-
-    scores.masked_fill_(mask == 0, -1e32)
-    scores = F.softmax(scores, dim=-1)  # BS,8,seqlen,seqlen
-    # print(f"before zero pad scores: {scores.shape}")
-    # print(zero_pad)
+    output = F.scaled_dot_product_attention(
+        q, k, v, attn_mask=mask, dropout_p=dropout.p if dropout.training else 0.0, scale=1 / math.sqrt(d_k)
+    )  # BS,8,seqlen,d_k
     if zero_pad:
-        pad_zero = torch.zeros(bs, head, 1, seqlen).to(device)
-        scores = torch.cat([pad_zero, scores[:, :, 1:, :]], dim=2) # 第一行score置0
-    # print(f"after zero pad scores: {scores}")
-    scores = dropout(scores)
-    output = torch.matmul(scores, v)
-    # import sys
-    # sys.exit()
+        output = F.pad(output[:, :, 1:, :], (0, 0, 1, 0)) # 第一行置0
     return output
 
 
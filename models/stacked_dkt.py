@@ -0,0 +1,165 @@
+"""
+Trains K same-shaped DKT-family models (DKTMultiKC, DKTSem, pykt DKT) together in one batched forward/backward pass
+Parameters of the K models are stacked along a new first dimension and every layer is run with grouped ops over models
+torch.func.vmap has no batching rule for LSTMs, so the LSTM is unrolled over time with batched matmuls
+The unrolled loop gives up the fused nn.LSTM kernel, so the realized speedup over training K models independently is well below K,
+about 1.4-2.3x for 4 configs on CPU (lowest for DKT), see benchmark --benchmark stacked
+"""
+
+from typing import List
+import torch
+from torch.nn import Module, Parameter, ParameterDict
+import torch.nn.functional as F
+from pykt.models.dkt import DKT
+
+from models.dkt_multi_kc import DKTMultiKC, get_kc_weights
+from models.dkt_sem import DKTSem, ALT_ARCH
+
+STACKABLE_MODELS = [DKTMultiKC, DKTSem, DKT]
+
+def stacked_lstm(x: torch.Tensor, weight_ih: torch.Tensor, weight_hh: torch.Tensor, bias_ih: torch.Tensor, bias_hh: torch.Tensor):
+    """
+    Single layer LSTM for K models at once, same gate layout as torch.nn.LSTM
+    x: M x B x L x D, weight_ih: M x 4H x D, weight_hh: M x 4H x H, biases: M x 4H, returns M x B x L x H
+    One fused torch.lstm call over the concatenated hidden dim with block-diagonal weights was measured 2-6x slower than this loop
+    on CPU (M=4..16, H=64..256), since it does M times the matmul work for the off-diagonal zeros
+    """
+    num_models, batch_size, seq_len, _ = x.shape
+    hidden_size = weight_hh.shape[2]
+    # Input projections don't depend on state, so compute them for all time steps in one matmul
+    x_proj = torch.baddbmm(
+        (bias_ih + bias_hh).unsqueeze(1), x.reshape(num_models, batch_size * seq_len, -1), weight_ih.transpose(1, 2)
+    ).view(num_models, batch_size, seq_len, 4 * hidden_size)
+    weight_hh_t = weight_hh.transpose(1, 2)
+    h = x.new_zeros(num_models, batch_size, hidden_size)
+    c = x.new_zeros(num_models, batch_size, hidden_size)
+    outputs = []
+    # Unbind instead of indexing per step, so backward stacks step gradients once instead of filling a full-size tensor per step
+    for step_proj in x_proj.unbind(dim=2):
+        gates = step_proj + torch.bmm(h, weight_hh_t)
+        in_gate, forget_gate, cell_gate, out_gate = gates.chunk(4, dim=2)
+        c = torch.sigmoid(forget_gate) * c + torch.sigmoid(in_gate) * torch.tanh(cell_gate)
+        h = torch.sigmoid(out_gate) * torch.tanh(c)
+        outputs.append(h)
+    return torch.stack(outputs, dim=2)
+
+def stacked_linear(x: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor):
+    # x: M x ... x D_in, weight: M x D_out x D_in, bias: M x D_out
+    shape = x.shape
+    out = torch.baddbmm(bias.unsqueeze(1), x.reshape(shape[0], -1, shape[-1]), weight.transpose(1, 2))
+    return out.view(*shape[:-1], weight.shape[1])
+
+def stacked_embedding(idxs: torch.Tensor, weight: torch.Tensor):
+    # idxs: any shape shared by all models, weight: M x V x D, returns M x idxs.shape x D
+    return weight[:, idxs]
+
+class StackedDKT(Module):
+    """
+    Stack of same-shaped DKTMultiKC, DKTSem or pykt DKT models
+    Forward returns M x B x L x K(all) KC probabilities, matching each model's own forward
+    Parameters are stored under the original names (with "." replaced by "__") so each model can be unstacked into a regular state dict
+    """
+
+    def __init__(self, models: List[Module]):
+        super().__init__()
+        self.arch = type(models[0])
+        assert self.arch in STACKABLE_MODELS
+        assert all(type(model) == self.arch for model in models)
+        self.num_models = len(models)
+        self.dropout = models[0].dropout_layer.p
+        if self.arch == DKTMultiKC:
+            self.num_kcs = models[0].num_kcs
+        elif self.arch == DKT:
+            self.num_c = models[0].num_c
+        else:
+            self.kc_emb_matrix = models[0].kc_emb_matrix
+        self.params = ParameterDict({
+            name.replace(".", "__"): Parameter(torch.stack([model.state_dict()[name] for model in models]))
+            for name, _ in models[0].named_parameters()
+        })
+
+    def get_state_dict(self, model_idx: int):
+        # State dict for a single model, loadable into the original architecture
+        return {name.replace("__", "."): param[model_idx].detach().clone() for name, param in self.params.items()}
+
+    def lstm(self, x: torch.Tensor):
+        p = self.params
+        h = stacked_lstm(x, p["lstm_layer__weight_ih_l0"], p["lstm_layer__weight_hh_l0"], p["lstm_layer__bias_ih_l0"], p["lstm_layer__bias_hh_l0"])
+        h = F.dropout(h, self.dropout, self.training)
+        return h
+
+    def forward(self, batch):
+        p = self.params
+        if self.arch == DKTMultiKC:
+            # Average KC embeddings of all models with one embedding bag over their concatenated embedding dims (V x M*D),
+            # so M x B x L x K x D is never materialized, then add correctness embedding
+            batch_size, max_seq_len, max_num_kcs = batch["kc_ids"].shape
+            weight = p["interaction_emb__weight"]
+            xemb = F.embedding_bag(
+                batch["kc_ids"].view(-1, max_num_kcs), weight.transpose(0, 1).reshape(weight.shape[1], -1), mode="sum",
+                per_sample_weights=get_kc_weights(batch, weight.dtype).view(-1, max_num_kcs)
+            )
+            xemb = xemb.view(batch_size, max_seq_len, self.num_models, -1).permute(2, 0, 1, 3) # M x B x L x D
+            xemb = xemb + stacked_embedding(self.num_kcs + torch.clip(batch["labels"], min=0), p["interaction_emb__weight"])
+            h = self.lstm(xemb)
+            return torch.sigmoid(stacked_linear(h, p["out_layer__weight"], p["out_layer__bias"]))
+        if self.arch == DKTSem:
+            if ALT_ARCH:
+                text_emb = batch["turn_embs"]
+            else:
+                text_emb = torch.concat([batch["teacher_embs"], batch["student_embs"], batch["kc_embs"]], dim=2)
+            text_emb = text_emb.unsqueeze(0).expand(self.num_models, *text_emb.shape)
+            xemb = torch.tanh(stacked_linear(text_emb, p["input_encoder__0__weight"], p["input_encoder__0__bias"]))
+            if not ALT_ARCH:
+                xemb = xemb + stacked_embedding(torch.clip(batch["labels"], min=0), p["correctness_encoder__weight"])
+            h = self.lstm(xemb)
+            h_text_space = stacked_linear(h, p["out_layer__weight"], p["out_layer__bias"])
+            return torch.sigmoid(h_text_space @ self.kc_emb_matrix.T)
+        # pykt DKT on flattened KC sequences
+        xemb = stacked_embedding(batch["kc_ids_flat"] + self.num_c * batch["labels_flat"], p["interaction_emb__weight"])
+        h = self.lstm(xemb)
+        return torch.sigmoid(stacked_linear(h, p["out_layer__weight"], p["out_layer__bias"]))
+
+class StackedAdamW:
+    """
+    AdamW over stacked parameters with a learning rate and weight decay per model, same update as torch.optim.AdamW
+    Also provides per-model gradient norm clipping, since each model's norm only covers its own slices
+    """
+
+    def __init__(self, params: List[Parameter], lrs: List[float], wds: List[float], betas=(0.9, 0.999), eps: float = 1e-8):
+        self.params = list(params)
+        self.lrs = torch.tensor(lrs, device=self.params[0].device)
+        self.wds = torch.tensor(wds, device=self.params[0].device)
+        self.betas = betas
+        self.eps = eps
+        self.num_steps = 0
+        self.exp_avgs = [torch.zeros_like(param) for param in self.params]
+        self.exp_avg_sqs = [torch.zeros_like(param) for param in self.params]
+
+    def per_model(self, vals: torch.Tensor, param: torch.Tensor):
+        # Reshape per-model values to broadcast over stacked param
+        return vals.view(-1, *([1] * (param.dim() - 1)))
+
+    def clip_grad_norm_(self, max_norm: float):
+        sq_norms = sum(param.grad.pow(2).flatten(1).sum(dim=1) for param in self.params)
+        clip_coefs = torch.clamp(max_norm / (sq_norms.sqrt() + 1e-6), max=1.0)
+        for param in self.params:
+            param.grad.mul_(self.per_model(clip_coefs, param))
+
+    @torch.no_grad()
+    def step(self):
+        self.num_steps += 1
+        beta1, beta2 = self.betas
+        bias_correction1 = 1 - beta1 ** self.num_steps
+        bias_correction2_sqrt = (1 - beta2 ** self.num_steps) ** 0.5
+        for param, exp_avg, exp_avg_sq in zip(self.params, self.exp_avgs, self.exp_avg_sqs):
+            lrs = self.per_model(self.lrs, param)
+            param.mul_(1 - lrs * self.per_model(self.wds, param))
+            exp_avg.lerp_(param.grad, 1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(param.grad, param.grad, value=1 - beta2)
+            denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt).add_(self.eps)
+            param.sub_(lrs / bias_correction1 * exp_avg / denom)
+
+    def zero_grad(self):
+        for param in self.params:
+            param.grad = None
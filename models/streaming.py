@@ -0,0 +1,47 @@
+"""
+Streaming inference for DKTMultiKC and DKTSem, predicting KC mastery for live sessions one turn at a time
+Each session keeps its own LSTM (h, c) state, concurrent sessions are advanced together in one batched step
+A session's turn has the same keys as a DKTDataset batch, without batch/sequence dims:
+    DKTMultiKC - kc_ids (list of KC ids), labels (correctness of the turn)
+    DKTSem - teacher_embs, student_embs, kc_embs (D tensors, kc_embs is the mean of the turn's KC embeddings), labels
+        or turn_embs (D tensor) with ALT_ARCH
+"""
+
+from typing import List, Optional, Tuple
+import torch
+from torch.nn import Module
+from torch.nn.utils.rnn import pad_sequence
+
+from utils import device
+
+LSTMState = Tuple[torch.Tensor, torch.Tensor]
+
+def collate_turns(turns: List[dict]):
+    # Batch one turn per session into the turn format expected by step
+    result = {}
+    for key in turns[0]:
+        if key == "kc_ids":
+            result["kc_ids"] = pad_sequence([torch.LongTensor(turn["kc_ids"]) for turn in turns], batch_first=True)
+            result["num_kcs"] = torch.LongTensor([len(turn["kc_ids"]) for turn in turns])
+        elif key == "labels":
+            result["labels"] = torch.LongTensor([turn["labels"] for turn in turns])
+        else:
+            result[key] = torch.stack([turn[key] for turn in turns])
+    return {key: val.to(device) for key, val in result.items()}
+
+def stack_states(model: Module, states: List[Optional[LSTMState]]):
+    # Combine per-session states along the batch dim, new sessions start from zeros like in forward
+    zeros = torch.zeros(model.lstm_layer.num_layers, 1, model.lstm_layer.hidden_size, device=device)
+    return (
+        torch.concat([zeros if state is None else state[0] for state in states], dim=1),
+        torch.concat([zeros if state is None else state[1] for state in states], dim=1)
+    )
+
+@torch.no_grad()
+def step_sessions(model: Module, states: List[Optional[LSTMState]], turns: List[dict]):
+    """
+    Advance many concurrent sessions by one turn each in a single call, model should be in eval mode
+    states has one entry per session (None for new sessions), returns new per-session states and KC probabilities (B x K(all))
+    """
+    state, kc_probs = model.step(stack_states(model, states), collate_turns(turns))
+    return list(zip(state[0].split(1, dim=1), state[1].split(1, dim=1))), kc_probs
@@ -5,6 +5,8 @@ from data_loading import correct_to_str, standards_to_str
 
 # ===== General functions =====
 
+DIALOGUE_START = "[BEGIN DIALOGUE]"
+
 def get_dialogue_text(dialogue: List[dict], turn_idx: int = None, include_labels: bool = False, tag_wrapper: bool = True):
     lines = []
     for turn in dialogue:
@@ -21,7 +23,7 @@ def get_dialogue_text(dialogue: List[dict], turn_idx: int = None, include_labels
             lines.append(f"Turn {turn['turn']} Knowledge Components: {standards_to_str(turn['kcs'], ' ')}")
     prompt = "\n".join(lines)
     if tag_wrapper:
-        prompt = "[BEGIN DIALOGUE]\n" + prompt + "\n[END DIALOGUE]"
+        prompt = DIALOGUE_START + "\n" + prompt + "\n[END DIALOGUE]"
     return prompt
 
 def get_mathdial_context(sample: dict):
@@ -1,4 +1,10 @@
+import os
 import json
+import copy
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List
 from tqdm import tqdm
 import torch
 import transformers
@@ -10,18 +16,24 @@ from pykt.models.akt import AKT
 from pykt.models.dkvmn import DKVMN
 from pykt.models.saint import SAINT
 from pyBKT.models import Model as BKT
-from sentence_transformers import SentenceTransformer
 
-from models.lm import get_model
+from peft import set_peft_model_state_dict
+
+from models.lm import get_model, get_true_false_logits, get_adapter_state, release_model
+from models.lm_inference import LMKTIncrementalEngine, LMKTPrefixCache
 from models.dkt_multi_kc import DKTMultiKC
 from models.dkt_sem import DKTSem
 from models.simplekt import simpleKT
+from models.output_head import GatheredLinear, gather_targets
+from models.packed_lstm import dkt_forward
+from models.stacked_dkt import StackedDKT, StackedAdamW
 from data_loading import (load_annotated_data, get_kc_result_filename, get_qual_result_filename, get_default_fold, load_kc_dict,
                           correct_to_str, standards_to_str, get_model_file_suffix, COMTA_SUBJECTS)
-from kt_data_loading import (LMKTDatasetUnpacked, LMKTCollatorUnpacked, LMKTDatasetPacked, LMKTCollatorPacked,
-                             DKTDataset, DKTCollator, get_dataloader, apply_annotations)
+from kt_data_loading import (LMKTDatasetUnpacked, LMKTCollatorUnpacked, LMKTDatasetPacked, LMKTCollatorPacked, LMKTCollatorIncremental,
+                             DKTDataset, DKTCollator, get_dataloader, prepare_resumed_epoch, apply_annotations)
+from embedding_cache import SBERTEmbeddingCache
 from prompting import get_true_false_tokens
-from utils import device, get_checkpoint_path
+from utils import device, get_checkpoint_path, initialize_seeds, get_rng_state, set_rng_state, AsyncCheckpointWriter
 
 # ===== Common Functions =====
 
@@ -51,29 +63,168 @@ def apply_defaults(args):
         if getattr(args, key, None) is None:
             setattr(args, key, val)
 
+def get_sweep_configs(args):
+    # Model name and hyperparameter overrides for each config in the sweep grid
+    if args.model_type == "lmkt":
+        return [
+            (f"hpsweep_{args.dataset}_{args.tag_src}_lmkt_agg{args.agg}_lr{lr}_r{r}", {"lr": lr, "r": r, "lora_alpha": r})
+            for lr in [5e-5, 1e-4, 2e-4, 3e-4]
+            for r in [2, 4, 8, 16, 32]
+        ]
+    return [
+        (f"hpsweep_{args.dataset}_{args.tag_src}_{args.model_type}_agg{args.agg}_lr{lr}_es{emb_size}", {"lr": lr, "emb_size": emb_size})
+        for lr in [1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3]
+        for emb_size in [8, 16, 32, 64, 128, 256]
+    ]
+
+def get_sweep_ledger_filename(args):
+    return f"results/hpsweep_ledger_{args.dataset}_{args.tag_src}_{args.model_type}.jsonl"
+
+# Args that don't change a run's results, left out of the sweep fingerprint
+NON_RESULT_ARGS = ["func", "model_name", "num_workers", "sweep_workers", "sweep_threads", "resume", "checkpoint_every_steps", "cpu_threads"]
+
+def get_sweep_fingerprint(args):
+    # Hash of sweep-level args that affect results (epochs, patience, data options, sweep mode...), config overrides are in the model name
+    run_args = {key: val for key, val in vars(args).items() if key not in NON_RESULT_ARGS}
+    return hashlib.sha1(json.dumps(run_args, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+def load_sweep_ledger(filename: str, fingerprint: str):
+    # Metrics of finished runs with the same fingerprint, keyed by model name and fold
+    ledger = {}
+    if os.path.exists(filename):
+        with open(filename) as ledger_file:
+            for line in ledger_file:
+                entry = json.loads(line)
+                if "metrics" in entry and entry.get("fingerprint") == fingerprint: # Skip ASHA rung entries and runs with other args
+                    ledger[(entry["model_name"], entry["fold"])] = np.array(entry["metrics"])
+    return ledger
+
+class ASHACallback:
+    """
+    Epoch callback for asynchronous successive halving
+    At each rung epoch, the run's validation loss is recorded in the sweep ledger and the run only continues if it is in
+    the top 1/eta of runs that reached the same rung on the same fold so far, in sweeps with the same fingerprint (which includes the sweep mode)
+    Going through the ledger file lets parallel sweep workers and resumed sweeps see each other's rung results
+    """
+
+    def __init__(self, ledger_filename: str, model_name: str, fold, fingerprint: str, rungs: List[int], eta: int):
+        self.ledger_filename = ledger_filename
+        self.model_name = model_name
+        self.fingerprint = fingerprint
+        self.fold = fold
+        self.rungs = rungs
+        self.eta = eta
+
+    def __call__(self, epoch: int, val_loss: float):
+        if epoch not in self.rungs:
+            return True
+        with open(self.ledger_filename, "a") as ledger_file:
+            ledger_file.write(json.dumps({
+                "model_name": self.model_name, "fold": self.fold, "fingerprint": self.fingerprint, "epoch": epoch, "val_loss": val_loss
+            }) + "\n")
+        rung_losses = {}
+        with open(self.ledger_filename) as ledger_file:
+            for line in ledger_file:
+                entry = json.loads(line)
+                if entry.get("epoch") == epoch and entry["fold"] == self.fold and entry.get("fingerprint") == self.fingerprint:
+                    rung_losses[entry["model_name"]] = entry["val_loss"]
+        competing_losses = sorted(rung_losses.values())
+        promote_idx = max(len(competing_losses) // self.eta - 1, 0)
+        if val_loss <= competing_losses[promote_idx]:
+            return True
+        print(f"Stopping after epoch {epoch}, val loss not in top 1/{self.eta} of {len(competing_losses)} runs at this rung")
+        return False
+
+def get_asha_rungs(args):
+    # Epochs at which runs are compared, growing geometrically and excluding the final epoch
+    rungs = []
+    epoch = args.asha_min_epochs
+    while epoch < args.epochs:
+        rungs.append(epoch)
+        epoch *= args.asha_eta
+    return rungs
+
+def init_sweep_worker(num_threads: int):
+    torch.set_num_threads(num_threads)
+
+def run_sweep_task(configs: list, fold):
+    # Reseed per run so results don't depend on scheduling order or on resuming from the ledger
+    initialize_seeds(221)
+    if len(configs) > 1:
+        return [get_primary_metrics(metrics) for metrics in train_baseline_stacked(configs, fold)]
+    args = configs[0]
+    fn = train_lmkt if args.model_type == "lmkt" else train_baseline
+    epoch_callback = None
+    if args.sweep_mode == "asha":
+        epoch_callback = ASHACallback(get_sweep_ledger_filename(args), args.model_name, fold, args.sweep_fingerprint, get_asha_rungs(args), args.asha_eta)
+    return [get_primary_metrics(fn(args, fold, epoch_callback))]
+
 def hyperparam_sweep(args):
     apply_defaults(args)
     args.testonval = True
     args.crossval = args.dataset == "comta"
-    model_names = []
-    results = []
-    if args.model_type == "lmkt":
-        for lr in [5e-5, 1e-4, 2e-4, 3e-4]:
-            for r in [2, 4, 8, 16, 32]:
-                args.model_name = f"hpsweep_{args.dataset}_{args.tag_src}_lmkt_agg{args.agg}_lr{lr}_r{r}"
-                args.lr = lr
-                args.r = r
-                args.lora_alpha = r
-                model_names.append(args.model_name)
-                results.append(train(args))
+    folds = (COMTA_SUBJECTS if args.split_by_subject else range(1, 6)) if args.crossval else [get_default_fold(args)]
+    args.sweep_fingerprint = get_sweep_fingerprint(args)
+    configs = []
+    for model_name, overrides in get_sweep_configs(args):
+        config_args = copy.copy(args)
+        config_args.model_name = model_name
+        vars(config_args).update(overrides)
+        configs.append(config_args)
+
+    # Optionally group configs that only differ in learning rate to train them as one stacked model
+    if args.sweep_stack:
+        assert args.model_type in STACKABLE_BASELINES and args.sweep_mode == "grid"
+        check_stack_args(args)
+        groups = {}
+        for config_args in configs:
+            groups.setdefault(config_args.emb_size, []).append(config_args)
+        config_groups = list(groups.values())
     else:
-        for lr in [1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3]:
-            for emb_size in [8, 16, 32, 64, 128, 256]:
-                args.model_name = f"hpsweep_{args.dataset}_{args.tag_src}_{args.model_type}_agg{args.agg}_lr{lr}_es{emb_size}"
-                args.lr = lr
-                args.emb_size = emb_size
-                model_names.append(args.model_name)
-                results.append(train(args))
+        config_groups = [[config_args] for config_args in configs]
+
+    # Skip runs already recorded in the ledger with the same args, so an interrupted sweep resumes where it stopped
+    ledger_filename = get_sweep_ledger_filename(args)
+    ledger = load_sweep_ledger(ledger_filename, args.sweep_fingerprint)
+    tasks = []
+    for config_group in config_groups:
+        for fold in folds:
+            remaining = [config_args for config_args in config_group if (config_args.model_name, fold) not in ledger]
+            if remaining:
+                tasks.append((remaining, fold))
+    num_runs = sum(len(task_configs) for task_configs, _ in tasks)
+    print(f"Running {num_runs} sweep runs, {len(configs) * len(folds) - num_runs} already finished in {ledger_filename}")
+    if args.sweep_mode == "asha":
+        print(f"ASHA rungs at epochs {get_asha_rungs(args)}, eta={args.asha_eta}")
+    with open(ledger_filename, "a") as ledger_file:
+        def record(task_configs, fold, task_metrics):
+            for config_args, metrics in zip(task_configs, task_metrics):
+                metrics = np.array(metrics)
+                ledger[(config_args.model_name, fold)] = metrics
+                ledger_file.write(json.dumps({
+                    "model_name": config_args.model_name, "fold": fold, "fingerprint": args.sweep_fingerprint, "metrics": metrics.tolist()
+                }) + "\n")
+            ledger_file.flush()
+
+        if args.sweep_workers <= 1:
+            for task_configs, fold in tasks:
+                record(task_configs, fold, run_sweep_task(task_configs, fold))
+        else:
+            # Spread runs across processes, splitting CPU threads between them since small models barely use one core
+            num_threads = args.sweep_threads or max(1, os.cpu_count() // args.sweep_workers)
+            with ProcessPoolExecutor(
+                args.sweep_workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_sweep_worker, initargs=(num_threads,)
+            ) as executor:
+                futures = {executor.submit(run_sweep_task, task_configs, fold): (task_configs, fold) for task_configs, fold in tasks}
+                for future in as_completed(futures):
+                    record(*futures[future], future.result())
+
+    # Aggregate folds per config and report best
+    model_names = [config_args.model_name for config_args in configs]
+    results = []
+    for config_args in configs:
+        fold_metrics = [ledger[(config_args.model_name, fold)] for fold in folds]
+        results.append(report_crossval(fold_metrics, folds, config_args) if args.crossval else fold_metrics[0])
     aucs = np.array([metrics.mean(0)[2] if args.crossval else metrics[2] for metrics in results])
     best_model_idx = aucs.argmax()
     result_str = "\n".join([f"{model_name}: {auc:.2f}" for model_name, auc in zip(model_names, aucs)])
@@ -82,6 +233,37 @@ def hyperparam_sweep(args):
     with open(f"results/metrics_hpsweep_{args.dataset}_{args.tag_src}_{args.model_type}.txt", "w") as file:
         file.write(result_str + "\n")
 
+AGG_METHODS = ["prod", "mean-ar", "mean-geo"]
+
+def get_eval_splits(args, val_df: pd.DataFrame, test_df: pd.DataFrame):
+    # First split is the primary one, whose metrics are returned for crossval/hyperparam sweep
+    primary = [("val", val_df)] if args.testonval else [("test", test_df)]
+    if not args.eval_val_and_test:
+        return primary
+    return primary + ([("test", test_df)] if args.testonval else [("val", val_df)])
+
+def get_eval_aggs(args):
+    # First aggregation method is the primary one, matching args.agg
+    return [args.agg] + ([agg for agg in AGG_METHODS if agg != args.agg] if args.eval_all_aggs else [])
+
+def get_eval_args(args, split: str, agg: str):
+    # Copy of args for naming result files of one split/aggregation, primary result keeps the original names
+    eval_args = copy.copy(args)
+    eval_args.agg = agg
+    eval_args.eval_suffix = ""
+    if split != ("val" if args.testonval else "test"):
+        eval_args.eval_suffix += f"_{split}"
+    if agg != args.agg and args.model_name: # Unnamed models already include agg in file names
+        eval_args.eval_suffix += f"_agg{agg}"
+    return eval_args
+
+def get_eval_results(results: dict):
+    # Return only primary metrics unless evaluating multiple splits/aggregation methods
+    return next(iter(results.values())) if len(results) == 1 else results
+
+def get_primary_metrics(metrics):
+    return next(iter(metrics.values())) if isinstance(metrics, dict) else metrics
+
 def crossval(args, fn):
     # Train/test models across folds
     metrics_agg = []
@@ -90,6 +272,16 @@ def crossval(args, fn):
         print(f"Fold {fold}...")
         metrics = fn(args, fold)
         metrics_agg.append(metrics)
+    if not isinstance(metrics_agg[0], dict):
+        return report_crossval(metrics_agg, folds, args)
+    # Report each split/aggregation method separately, return primary metrics
+    results = [
+        report_crossval([metrics[key] for metrics in metrics_agg], folds, get_eval_args(args, *key))
+        for key in metrics_agg[0]
+    ]
+    return results[0]
+
+def report_crossval(metrics_agg: list, folds, args):
     # Aggregate and report metrics across folds
     metrics_np = np.stack(metrics_agg, axis=0)
     avg = metrics_np.mean(axis=0)
@@ -125,7 +317,7 @@ def train(args):
     if args.crossval:
         return crossval(args, fn)
     else:
-        return fn(args, get_default_fold(args))
+        return get_primary_metrics(fn(args, get_default_fold(args)))
 
 def test(args):
     apply_defaults(args)
@@ -135,6 +327,36 @@ def test(args):
     else:
         return fn(args, get_default_fold(args))
 
+def aggregate_kc_probs(kc_probs: torch.Tensor, turn_idxs: torch.Tensor, num_kcs: torch.Tensor, agg: str, kc_mask: torch.Tensor = None):
+    """
+    Get probability that all KCs are True for each turn with a single segment reduction
+    kc_probs and turn_idxs are flat (one entry per KC), num_kcs has one entry per turn
+    Optional kc_mask excludes padded entries, prod and mean-geo are computed in log space
+    """
+    if agg == "mean-ar":
+        vals = kc_probs
+    else:
+        vals = torch.log(torch.clip(kc_probs, min=torch.finfo(kc_probs.dtype).tiny))
+    if kc_mask is not None:
+        vals = torch.where(kc_mask, vals, 0)
+    totals = torch.zeros(num_kcs.shape[0], dtype=vals.dtype, device=vals.device).index_add(0, turn_idxs, vals)
+    if agg == "prod":
+        return totals.exp()
+    if agg == "mean-ar":
+        return totals / num_kcs
+    if agg == "mean-geo":
+        return (totals / num_kcs).exp()
+    raise Exception(f"Aggregation {agg} not supported")
+
+def group_kc_probs(kc_probs: List[float], num_kcs: List[int]):
+    # Split flat list of KC probs into one list per turn
+    kc_probs_grouped = []
+    num_kc_counter = 0
+    for turn_num_kcs in num_kcs:
+        kc_probs_grouped.append(kc_probs[num_kc_counter : num_kc_counter + turn_num_kcs])
+        num_kc_counter += turn_num_kcs
+    return kc_probs_grouped
+
 def compute_metrics(labels, preds):
     hard_preds = np.round(preds)
     acc = accuracy_score(labels, hard_preds)
@@ -163,67 +385,209 @@ def compute_all_metrics(loss, all_labels, all_preds, final_turn_labels, final_tu
     return all_metrics, final_metrics
 
 
+class EarlyStopper:
+    """
+    Tracks best validation loss, calling save_best on each improvement
+    Signals a stop once patience validations in a row fail to improve (never if patience is 0)
+    """
+
+    def __init__(self, save_best, patience: int):
+        self.save_best = save_best
+        self.patience = patience
+        self.best_val_loss = None
+        self.num_bad_vals = 0
+
+    def update(self, val_loss: float):
+        if not self.best_val_loss or val_loss < self.best_val_loss:
+            print("Best! Saving model...")
+            self.save_best()
+            self.best_val_loss = val_loss
+            self.num_bad_vals = 0
+        else:
+            self.num_bad_vals += 1
+        return bool(self.patience) and self.num_bad_vals >= self.patience
+
+def validate(model, val_dataloader, get_batch_loss):
+    total_val_loss = 0
+    with torch.no_grad():
+        model.eval()
+        for batch in tqdm(val_dataloader, desc="Validating"):
+            loss = get_batch_loss(batch)
+            total_val_loss += loss.detach() # Keep on device to avoid sync per batch
+    model.train()
+    return float(total_val_loss) / len(val_dataloader)
+
+def train_loop(model, optimizer, train_dataloader, val_dataloader, get_batch_loss, save_best, args, epoch_callback=None,
+               state_path: str = None, best_state: dict = None):
+    """
+    Training loop shared by LMKT and baselines
+    Validates after every epoch, and also every args.val_every_steps optimizer steps if set
+    Calls save_best on each new best validation loss and stops early after args.patience validations without improvement
+    epoch_callback(epoch, val_loss) is called after each epoch and returns False to stop training early
+    If args.checkpoint_every_steps is set, the full training state is saved to state_path in the background every N optimizer
+    steps and after each epoch, and args.resume continues from it exactly; best_state holds any in-memory best weights to include
+    """
+    early_stopper = EarlyStopper(save_best, args.patience)
+    writer = AsyncCheckpointWriter() if args.checkpoint_every_steps else None
+    step = 0
+    start_epoch = 0
+    resume_state = None
+    if args.resume:
+        if os.path.exists(state_path):
+            print(f"Resuming training from {state_path}")
+            resume_state = torch.load(state_path, map_location="cpu", weights_only=False)
+            model.load_state_dict(resume_state["model"], strict=False)
+            optimizer.load_state_dict(resume_state["optimizer"])
+            early_stopper.best_val_loss = resume_state["best_val_loss"]
+            early_stopper.num_bad_vals = resume_state["num_bad_vals"]
+            if best_state is not None:
+                best_state.update(resume_state["best_state"])
+            step = resume_state["step"]
+            start_epoch = resume_state["epoch"]
+        else:
+            print(f"No training state found at {state_path}, starting from scratch")
+
+    def save_train_state(epoch: int, batch_idx: int, total_train_loss: float, epoch_rng_state: dict):
+        # Only called right after optimizer steps, so there are no accumulated gradients to save
+        writer.save({
+            "epoch": epoch,
+            "batch_idx": batch_idx,
+            "step": step,
+            "total_train_loss": total_train_loss,
+            "model": {name: param for name, param in model.named_parameters() if param.requires_grad},
+            "optimizer": optimizer.state_dict(),
+            "best_val_loss": early_stopper.best_val_loss,
+            "num_bad_vals": early_stopper.num_bad_vals,
+            "best_state": best_state,
+            "epoch_rng_state": epoch_rng_state,
+            "rng_state": get_rng_state()
+        }, state_path)
+
+    for epoch in range(start_epoch, args.epochs):
+        print(f"Epoch {epoch + 1}")
+        total_train_loss = 0
+        skip_batches = 0
+        stop = False
+        if resume_state is not None:
+            # Reproduce the interrupted epoch's batch order, then skip batches that were already trained on
+            set_rng_state(resume_state["epoch_rng_state"])
+            prepare_resumed_epoch(train_dataloader, epoch)
+            total_train_loss = resume_state["total_train_loss"]
+            skip_batches = resume_state["batch_idx"]
+        epoch_rng_state = get_rng_state()
+
+        model.train()
+        for batch_idx, batch in enumerate(tqdm(train_dataloader, desc="Training")):
+            if batch_idx < skip_batches:
+                continue
+            if resume_state is not None:
+                # Restore RNG state from the interrupted step, at the start of an epoch it was already restored above
+                if skip_batches:
+                    set_rng_state(resume_state["rng_state"])
+                resume_state = None
+            loss = get_batch_loss(batch)
+            total_train_loss += loss.item()
+            loss = loss / args.grad_accum_steps
+            loss.backward()
+            if (batch_idx + 1) % args.grad_accum_steps == 0 or batch_idx == len(train_dataloader) - 1:
+                if args.gc:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.gc)
+                optimizer.step()
+                optimizer.zero_grad()
+                step += 1
+                # Validate and checkpoint mid-epoch, end of epoch is handled below
+                if args.val_every_steps and step % args.val_every_steps == 0 and batch_idx < len(train_dataloader) - 1:
+                    val_loss = validate(model, val_dataloader, get_batch_loss)
+                    print(f"Step {step}, Train Loss: {total_train_loss / (batch_idx + 1):.4f}, Val Loss: {val_loss:.4f}")
+                    if early_stopper.update(val_loss):
+                        stop = True
+                        break
+                if writer and step % args.checkpoint_every_steps == 0 and batch_idx < len(train_dataloader) - 1:
+                    save_train_state(epoch, batch_idx + 1, total_train_loss, epoch_rng_state)
+
+        if stop:
+            print(f"No improvement in {args.patience} validations, stopping early")
+            break
+        avg_train_loss = total_train_loss / len(train_dataloader)
+        avg_val_loss = validate(model, val_dataloader, get_batch_loss)
+        print(f"Train Loss: {avg_train_loss:.4f}, Val Loss: {avg_val_loss:.4f}")
+        if early_stopper.update(avg_val_loss):
+            print(f"No improvement in {args.patience} validations, stopping early")
+            break
+        if epoch_callback and not epoch_callback(epoch + 1, avg_val_loss):
+            break
+        if writer:
+            save_train_state(epoch + 1, 0, 0, get_rng_state())
+
+    # Training is done, so resuming would only need the saved best model
+    if writer:
+        writer.wait()
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
 # ===== LMKT =====
 
-def get_lmkt_loss_unpacked(model, batch, true_token, false_token, args):
-    # Get logits at last token of each sequence
-    model_output = model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"])
-    batch_size = model_output.logits.shape[0]
-    logits = model_output.logits[torch.arange(batch_size), batch["last_idxs"]]
+def get_lmkt_loss_unpacked(model, batch, true_token, false_token, args, prefix_cache: LMKTPrefixCache = None):
+    # Optionally start from cached KV states of prompt prefix
+    prefix_len, past_key_values = 0, None
+    if prefix_cache:
+        prefix_len, past_key_values = prefix_cache.get(batch["input_ids"], batch["last_idxs"], batch["meta_data"][0]["prompts"][0])
+    # Get True/False logits at last token of each sequence
+    batch_size = batch["input_ids"].shape[0]
+    logits = get_true_false_logits(
+        model, (torch.arange(batch_size), batch["last_idxs"] - prefix_len), true_token, false_token,
+        input_ids=batch["input_ids"][:, prefix_len:], attention_mask=batch["attention_mask"], past_key_values=past_key_values
+    )
     # Return probability of True token over False token for each sequence
-    logits = torch.stack([logits[:, true_token], logits[:, false_token]], dim=1)
     kc_probs = torch.softmax(logits, dim=1)[torch.arange(batch_size), 0]
     # Get probability that all KCs are True for each turn in the batch
-    num_kc_counter = 0
-    kc_probs_grouped = []
-    corr_probs = []
-    for num_kcs in batch["num_kcs"]:
-        kc_probs_grouped.append(kc_probs[num_kc_counter : num_kc_counter + num_kcs].tolist())
-        if args.agg == "prod":
-            prob = kc_probs[num_kc_counter : num_kc_counter + num_kcs].prod()
-        elif args.agg == "mean-ar":
-            prob = kc_probs[num_kc_counter : num_kc_counter + num_kcs].mean()
-        elif args.agg == "mean-geo":
-            prob = kc_probs[num_kc_counter : num_kc_counter + num_kcs].prod() ** (1 / num_kcs)
-        corr_probs.append(prob)
-        num_kc_counter += num_kcs
-    corr_probs = torch.stack(corr_probs)
+    turn_idxs = torch.repeat_interleave(torch.arange(len(batch["num_kcs"]), device=kc_probs.device), batch["num_kcs"], output_size=batch_size)
+    corr_probs = aggregate_kc_probs(kc_probs, turn_idxs, batch["num_kcs"], args.agg)
     # Get BCE loss with correctness labels and predicted probabilities
     loss = torch.nn.BCELoss()(corr_probs, batch["labels"])
-    return loss, kc_probs_grouped, corr_probs
+    return loss, kc_probs, corr_probs
 
-def get_lmkt_loss_packed(model, batch, true_token, false_token, args):
+def get_lmkt_loss_packed(model, batch, true_token, false_token, args, prefix_cache: LMKTPrefixCache = None):
     # Invert attention mask
     attention_mask = batch["attention_mask"]
     min_dtype = torch.finfo(model.dtype).min
     attention_mask[attention_mask == 0] = min_dtype
     attention_mask[attention_mask == 1] = 0
     attention_mask = attention_mask.type(model.dtype)
-    # Get logits at last token of each sequence
-    model_output = model(input_ids=batch["input_ids"], attention_mask=attention_mask, position_ids=batch["position_ids"])
-    batch_size = model_output.logits.shape[0]
-    logits = model_output.logits[torch.arange(batch_size).unsqueeze(1), batch["last_idxs"]]
+    # Optionally start from cached KV states of prompt prefix, only need mask rows for the remaining tokens
+    prefix_len, past_key_values = 0, None
+    if prefix_cache:
+        prefix_len, past_key_values = prefix_cache.get(batch["input_ids"], batch["last_idxs"], batch["meta_data"][0]["prompt"])
+    # Get True/False logits at last token of each KC
+    batch_size = batch["input_ids"].shape[0]
+    logits = get_true_false_logits(
+        model, (torch.arange(batch_size).unsqueeze(1), torch.clip(batch["last_idxs"] - prefix_len, min=0)), true_token, false_token,
+        input_ids=batch["input_ids"][:, prefix_len:], attention_mask=attention_mask[:, :, prefix_len:],
+        position_ids=batch["position_ids"][:, prefix_len:], past_key_values=past_key_values
+    )
     # Return probability of True token over False token for each sequence
-    logits = torch.stack([logits[:, :, true_token], logits[:, :, false_token]], dim=2)
     kc_probs = torch.softmax(logits, dim=2)[:, :, 0]
-    # Get probability that all KCs are True for each turn in the batch
-    kc_probs_grouped = [probs[:num_kcs].tolist() for probs, num_kcs in zip(kc_probs, batch["num_kcs"])]
-    # Set probs on padded indices
-    padding_val = 0 if args.agg == "mean-ar" else 1
-    kc_probs = torch.masked_scatter(kc_probs, batch["last_idxs"].to(device) == 0, torch.full_like(kc_probs, padding_val).to(device))
+    # Get probability that all KCs are True for each turn in the batch, excluding padded indices
+    kc_mask = (batch["last_idxs"] != 0).reshape(-1)
+    turn_idxs = torch.arange(batch_size, device=kc_probs.device).repeat_interleave(kc_probs.shape[1])
+    corr_probs = aggregate_kc_probs(kc_probs.reshape(-1), turn_idxs, batch["num_kcs"], args.agg, kc_mask)
     # Get BCE loss with correctness labels and predicted probabilities
-    if args.agg == "prod":
-        corr_probs = kc_probs.prod(dim=1)
-    elif args.agg == "mean-ar":
-        corr_probs = kc_probs.sum(dim=1) / batch["num_kcs"]
-    elif args.agg == "mean-geo":
-        corr_probs = kc_probs.prod(dim=1) ** (1 / batch["num_kcs"])
     loss = torch.nn.BCELoss()(corr_probs, batch["labels"])
-    return loss, kc_probs_grouped, corr_probs
+    return loss, kc_probs.reshape(-1)[kc_mask], corr_probs
 
-def train_lmkt(args, fold):
+def get_lmkt_loss_incremental(engine: LMKTIncrementalEngine, batch, args):
+    # Samples are run one at a time in dialogue order so the engine can reuse the KV cache of previous turns
+    kc_probs = torch.concat([engine.predict(sample) for sample in batch["meta_data"]])
+    num_kcs = torch.LongTensor([len(sample["kcs"]) for sample in batch["meta_data"]]).to(device)
+    turn_idxs = torch.repeat_interleave(torch.arange(len(num_kcs), device=device), num_kcs, output_size=len(kc_probs))
+    corr_probs = aggregate_kc_probs(kc_probs, turn_idxs, num_kcs, args.agg)
+    loss = torch.nn.BCELoss()(corr_probs, batch["labels"])
+    return loss, kc_probs, corr_probs
+
+def train_lmkt(args, fold, epoch_callback=None):
     # Load language model with trainable LoRA adapters
-    model, tokenizer = get_model(args.base_model, False, pt_model_name=args.pt_model_name, r=args.r, lora_alpha=args.lora_alpha, quantize=args.quantize)
+    model, tokenizer = get_model(args.base_model, False, pt_model_name=args.pt_model_name, r=args.r, lora_alpha=args.lora_alpha, quantize=args.quantize,
+                                 cpu_dtype=args.cpu_dtype, cpu_threads=args.cpu_threads)
     model.print_trainable_parameters()
 
     # Load and split dataset, annotated with correctness and KCs
@@ -238,9 +602,10 @@ def train_lmkt(args, fold):
         print(val_df.iloc[0])
     train_dataset = KTDataset(train_df, tokenizer, args)
     val_dataset = KTDataset(val_df, tokenizer, args)
+    val_dataset.subsample(args.val_subsample)
     collator = KTCollator(tokenizer)
-    train_dataloader = get_dataloader(train_dataset, collator, args.batch_size, True)
-    val_dataloader = get_dataloader(val_dataset, collator, args.batch_size, False)
+    train_dataloader = get_dataloader(train_dataset, collator, args.batch_size, True, args.batching, args.max_batch_tokens, args.num_workers)
+    val_dataloader = get_dataloader(val_dataset, collator, args.batch_size, False, args.batching, args.max_batch_tokens, args.num_workers)
 
     # For finding logits for loss
     true_token, false_token = get_true_false_tokens(tokenizer)
@@ -250,84 +615,108 @@ def train_lmkt(args, fold):
         optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.wd)
     else:
         optimizer = transformers.Adafactor(model.parameters(), lr=args.lr, weight_decay=args.wd, relative_step=False)
-    best_val_loss = None
-    for epoch in range(args.epochs):
-        print(f"Epoch {epoch + 1}")
-        total_train_loss = 0
-        total_val_loss = 0
-
-        model.train()
-        for batch_idx, batch in enumerate(tqdm(train_dataloader, desc="Training")):
-            loss, _, _ = get_loss(model, batch, true_token, false_token, args)
-            total_train_loss += loss.item()
-            loss = loss / args.grad_accum_steps
-            loss.backward()
-            if (batch_idx + 1) % args.grad_accum_steps == 0 or batch_idx == len(train_dataloader) - 1:
-                if args.gc:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.gc)
-                optimizer.step()
-                optimizer.zero_grad()
+    best_adapter_state = {}
+    def save_best():
+        # Keep best adapters in memory, only saved to disk once training is done
+        best_adapter_state.update(get_adapter_state(model))
+    get_batch_loss = lambda batch: get_loss(model, batch, true_token, false_token, args)[0]
+    model_name = args.model_name + (f"_{fold}" if fold else "")
+    train_loop(model, optimizer, train_dataloader, val_dataloader, get_batch_loss, save_best, args, epoch_callback,
+               get_checkpoint_path(model_name + "_train_state.pt"), best_adapter_state)
 
-        with torch.no_grad():
-            model.eval()
-            for batch in tqdm(val_dataloader, desc="Validating"):
-                loss, _, _ = get_loss(model, batch, true_token, false_token, args)
-                total_val_loss += loss.item()
+    # Save best adapters and test them directly on the already loaded model
+    print("Saving best model...")
+    set_peft_model_state_dict(model, best_adapter_state)
+    model.save_pretrained(get_checkpoint_path(model_name))
+    return test_lmkt(args, fold, model, tokenizer)
 
-        avg_train_loss = total_train_loss / len(train_dataloader)
-        avg_val_loss = total_val_loss / len(val_dataloader)
-        print(f"Train Loss: {avg_train_loss:.4f}, Val Loss: {avg_val_loss:.4f}")
-        if not best_val_loss or avg_val_loss < best_val_loss:
-            print("Best! Saving model...")
-            model_name = args.model_name + (f"_{fold}" if fold else "")
-            model.save_pretrained(get_checkpoint_path(model_name))
-            best_val_loss = avg_val_loss
+def test_lmkt(args, fold, model=None, tokenizer=None):
+    # Load trained language model, unless testing a model that was just trained
+    if model is None:
+        model_name = args.model_name and args.model_name + (f"_{fold}" if fold else "")
+        model, tokenizer = get_model(args.base_model, True, model_name=model_name, quantize=args.quantize,
+                                     merge_lora=args.merge_lora, cpu_dtype=args.cpu_dtype, cpu_threads=args.cpu_threads)
+    model.eval()
 
-    return test_lmkt(args, fold)
+    # Load annotated data and evaluate on each requested split with the same model
+    _, val_df, test_df = load_annotated_data(args, fold)
+    results = {}
+    for split, split_df in get_eval_splits(args, val_df, test_df):
+        results.update(eval_lmkt(model, tokenizer, split, split_df, args, fold))
 
-def test_lmkt(args, fold):
-    # Load trained language model
-    model_name = args.model_name and args.model_name + (f"_{fold}" if fold else "")
-    model, tokenizer = get_model(args.base_model, True, model_name=model_name, quantize=args.quantize)
-    model.eval()
+    # Remove adapters so the base model can be reused by the next fold/config
+    release_model(model)
+    return get_eval_results(results)
 
-    # Load annotated data
+def eval_lmkt(model, tokenizer, split: str, test_df: pd.DataFrame, args, fold):
     KTDataset = LMKTDatasetPacked if args.pack_kcs else LMKTDatasetUnpacked
     KTCollator = LMKTCollatorPacked if args.pack_kcs else LMKTCollatorUnpacked
     get_loss = get_lmkt_loss_packed if args.pack_kcs else get_lmkt_loss_unpacked
-    _, val_df, test_df = load_annotated_data(args, fold)
-    if args.testonval:
-        test_df = val_df
     if args.debug:
         test_df = test_df[:10]
         print(test_df.iloc[0])
     test_dataset = KTDataset(test_df, tokenizer, args, skip_first_turn=not args.inc_first_label)
-    collator = KTCollator(tokenizer)
-    test_dataloader = get_dataloader(test_dataset, collator, args.batch_size, False)
+    engine = None
+    prefix_cache = None
+    if args.kv_cache:
+        # Tokenization happens inside the engine since it needs each sample's prefix structure
+        engine = LMKTIncrementalEngine(model, tokenizer, args.pack_kcs)
+        collator = LMKTCollatorIncremental()
+    else:
+        if args.prefix_cache_tokens:
+            prefix_cache = LMKTPrefixCache(model, tokenizer, args.prefix_cache_tokens)
+        collator = KTCollator(tokenizer)
+    test_dataloader = get_dataloader(test_dataset, collator, args.batch_size, False, num_workers=args.num_workers)
 
     # For finding logits for loss
     true_token, false_token = get_true_false_tokens(tokenizer)
 
     # Collect meta data and predicted KC/correctness probabilities for test set
+    # KC probs don't depend on aggregation, so correctness probs for all aggregation methods come from the same forward pass
     dialogue_idx_to_sample_idxs = {}
+    aggs = get_eval_aggs(args)
+    # Predictions are kept on device and only transferred once at the end
     all_labels = []
-    all_preds = []
+    all_preds = {agg: [] for agg in aggs}
     all_kc_probs = []
     all_kcs = []
-    total_loss = 0
+    total_loss = {agg: 0 for agg in aggs}
     for batch_idx, batch in enumerate(tqdm(test_dataloader)):
         for sample_idx, sample in enumerate(batch["meta_data"]):
             dialogue_idx_to_sample_idxs.setdefault(sample["dialogue_idx"], []).append(batch_idx + sample_idx)
         with torch.no_grad():
-            loss, kc_probs, corr_probs = get_loss(model, batch, true_token, false_token, args)
-        total_loss += loss.item()
-        all_labels.extend(batch["labels"].tolist())
-        all_preds.extend(corr_probs.tolist())
-        all_kc_probs.extend(kc_probs)
+            if engine:
+                loss, kc_probs, corr_probs = get_lmkt_loss_incremental(engine, batch, args)
+            else:
+                loss, kc_probs, corr_probs = get_loss(model, batch, true_token, false_token, args, prefix_cache=prefix_cache)
+            if len(aggs) > 1:
+                num_kcs = torch.LongTensor([len(sample["kcs"]) for sample in batch["meta_data"]]).to(kc_probs.device)
+                turn_idxs = torch.repeat_interleave(torch.arange(len(num_kcs), device=kc_probs.device), num_kcs, output_size=len(kc_probs))
+        for agg in aggs:
+            if agg != args.agg:
+                corr_probs = aggregate_kc_probs(kc_probs, turn_idxs, num_kcs, agg)
+                loss = torch.nn.BCELoss()(corr_probs, batch["labels"])
+            total_loss[agg] += loss
+            all_preds[agg].append(corr_probs)
+        all_labels.append(batch["labels"])
+        all_kc_probs.append(kc_probs)
         all_kcs.extend([sample["kcs"] for sample in batch["meta_data"]])
+    all_labels = torch.concat(all_labels).tolist()
+    all_kc_probs = group_kc_probs(torch.concat(all_kc_probs).tolist(), [len(kcs) for kcs in all_kcs])
+
+    results = {}
+    for agg in aggs:
+        eval_args = get_eval_args(args, split, agg)
+        agg_preds = torch.concat(all_preds[agg]).tolist()
+        loss = float(total_loss[agg]) / len(test_dataloader)
+        results[(split, agg)] = save_lmkt_results(
+            test_df, dialogue_idx_to_sample_idxs, all_labels, agg_preds, all_kc_probs, all_kcs, loss, eval_args, fold
+        )
+    return results
 
+def save_lmkt_results(test_df: pd.DataFrame, dialogue_idx_to_sample_idxs: dict, all_labels: list, all_preds: list,
+                      all_kc_probs: list, all_kcs: list, loss: float, args, fold):
     # Compute quantitative metrics and save metrics file
-    loss = total_loss / len(test_dataloader)
     final_turn_labels = [all_labels[idxs[-1]] for idxs in dialogue_idx_to_sample_idxs.values()]
     final_turn_preds = [all_preds[idxs[-1]] for idxs in dialogue_idx_to_sample_idxs.values()]
     all_metrics, final_metrics = compute_all_metrics(loss, all_labels, all_preds, final_turn_labels, final_turn_preds, args, fold)
@@ -390,36 +779,50 @@ def test_lmkt(args, fold):
 
 BASELINE_MODELS = ["dkt-multi", "dkt-sem", "dkt", "akt", "dkvmn", "saint", "simplekt"]
 NON_FLAT_KC_ARCH = ["dkt-multi", "dkt-sem"]
+STACKABLE_BASELINES = ["dkt-multi", "dkt-sem", "dkt"] # Can be trained as stacks of configs, see models/stacked_dkt.py
 
-def select_flat_baseline_out_vectors(y: torch.Tensor, batch, shift_turn_end_idxs: bool):
+def get_turn_out_idxs(batch, shift_turn_end_idxs: bool):
+    # Index in flat sequence of the output vector used to predict each turn's next turn (B x L)
     if shift_turn_end_idxs:
         # Predict KCs with output from first KC of turn for models where correctness is only visible in previous idxs
         # Clip at end to prevent out of bounds, no effect since last pred unused
-        batch["turn_end_idxs"] = torch.clip(batch["turn_end_idxs"] + 1, max=batch["turn_end_idxs"].max())
-    # Get output vectors at index of last KC per turn (to predict next turn's KCs)
-    turn_end_idxs = batch["turn_end_idxs"].unsqueeze(2).repeat(1, 1, y.shape[2])
-    return torch.gather(y, 1, turn_end_idxs)
+        return torch.clip(batch["turn_end_idxs"] + 1, max=batch["turn_end_idxs"].max())
+    # Output vectors at index of last KC per turn
+    return batch["turn_end_idxs"]
+
+def select_flat_baseline_out_vectors(y: torch.Tensor, batch, shift_turn_end_idxs: bool):
+    turn_out_idxs = get_turn_out_idxs(batch, shift_turn_end_idxs).unsqueeze(2).repeat(1, 1, y.shape[2])
+    return torch.gather(y, 1, turn_out_idxs)
+
+def get_flat_baseline_head_targets(batch, shift_turn_end_idxs: bool):
+    # Output idxs and next turn's KC ids for gathered output heads of flat models, last turn is skipped since it doesn't predict anything
+    return get_turn_out_idxs(batch, shift_turn_end_idxs)[:, :-1], batch["kc_ids"][:, 1:]
 
-def get_baseline_loss(y: torch.Tensor, batch, args):
+def get_baseline_loss(y: torch.Tensor, batch, args, gathered: bool):
     # Aggregate KC probs from outputs, one output per question
     batch_size, max_seq_len, max_num_kcs = batch["kc_ids"].shape
-    kc_pad_mask = torch.arange(max_num_kcs).repeat(batch_size, max_seq_len, 1).to(device) >= batch["num_kcs"].unsqueeze(2)
-    y = y[:, :-1].contiguous() # Last item in sequence doesn't predict anything
-    kc_probs = torch.gather(y, 2, batch["kc_ids"][:, 1:]) # Collect KC predictions for next question, B x L x K
-    # Set probs on padded indices
-    padding_val = 0 if args.agg == "mean-ar" else 1
-    kc_probs = torch.masked_scatter(kc_probs, kc_pad_mask[:, 1:], torch.full_like(kc_probs, padding_val).to(device))
-    # Calculate correct probabilities (B x L)
-    if args.agg == "prod":
-        corr_probs = kc_probs.prod(dim=2)
-    elif args.agg == "mean-ar":
-        corr_probs = kc_probs.sum(dim=2) / batch["num_kcs"][:, 1:]
-    elif args.agg == "mean-geo":
-        corr_probs = kc_probs.prod(dim=2) ** (1 / batch["num_kcs"][:, 1:])
+    kc_mask = torch.arange(max_num_kcs, device=device) < batch["num_kcs"][:, 1:].unsqueeze(2)
+    if gathered:
+        kc_probs = y # Sparse scoring and gathered output heads already return predictions for next question's KCs
+    else:
+        y = y[:, :-1].contiguous() # Last item in sequence doesn't predict anything
+        kc_probs = torch.gather(y, 2, batch["kc_ids"][:, 1:]) # Collect KC predictions for next question, B x L x K
+    # Calculate correct probabilities (B x L), excluding padded indices
+    turn_idxs = torch.arange(batch_size * (max_seq_len - 1), device=device).repeat_interleave(max_num_kcs)
+    corr_probs = aggregate_kc_probs(
+        kc_probs.view(-1), turn_idxs, batch["num_kcs"][:, 1:].reshape(-1), args.agg, kc_mask.view(-1)
+    ).view(batch_size, max_seq_len - 1)
 
     # Compute BCE loss
     labels_flat = batch["labels"][:, 1:].contiguous().view(-1)
     loss_mask = labels_flat != -100
+    if torch.compiler.is_compiling():
+        # Boolean indexing has a data-dependent shape, so use a weighted mean instead to keep the compiled graph whole
+        loss_weights = loss_mask.type(corr_probs.dtype)
+        loss = torch.nn.functional.binary_cross_entropy(
+            corr_probs.view(-1), torch.clip(labels_flat, min=0).type(corr_probs.dtype), weight=loss_weights, reduction="sum"
+        ) / loss_weights.sum()
+        return loss, corr_probs
     labels_flat = labels_flat[loss_mask].type(torch.float)
     corr_probs_flat = corr_probs.view(-1)[loss_mask]
     loss: torch.Tensor = torch.nn.BCELoss()(corr_probs_flat, labels_flat)
@@ -438,81 +841,118 @@ def get_baseline_model(kc_dict: dict, kc_emb_matrix: torch.Tensor, args):
     if args.model_type == "akt":
         model = AKT(num_kcs, num_kcs, emb_size, n_blocks, 0.05, emb_size, final_fc_dim=emb_size)
         model.out[3] = torch.nn.Linear(emb_size, emb_size) # Reduce from 256 to emb_size to avoid overparameterization
-        model.out[6] = torch.nn.Linear(emb_size, num_kcs) # Predict all KCs instead of just current question
+        model.out[6] = GatheredLinear(emb_size, num_kcs) # Predict all KCs instead of just current question
         return model.to(device)
     if args.model_type == "dkvmn":
         model = DKVMN(num_kcs, emb_size, 50)
-        model.p_layer = torch.nn.Linear(emb_size, num_kcs) # Predict all KCs instead of just current question
+        model.p_layer = GatheredLinear(emb_size, num_kcs) # Predict all KCs instead of just current question
         return model.to(device)
     if args.model_type == "saint":
         model = SAINT(num_kcs, num_kcs, 256, emb_size, 8, 0.2, n_blocks)
-        model.out = torch.nn.Linear(emb_size, num_kcs) # Predict all KCs instead of just current question
+        model.out = GatheredLinear(emb_size, num_kcs) # Predict all KCs instead of just current question
         return model.to(device)
     if args.model_type == "simplekt":
         model = simpleKT(num_kcs, num_kcs, emb_size, n_blocks, 0.2, d_ff=emb_size, final_fc_dim=emb_size, final_fc_dim2=emb_size)
-        model.out[6] = torch.nn.Linear(emb_size, num_kcs) # Predict all KCs instead of just current question
+        model.out[6] = GatheredLinear(emb_size, num_kcs) # Predict all KCs instead of just current question
         return model.to(device)
     raise Exception(f"Model {args.model_type} not supported")
 
-def compute_baseline_loss(model, batch, args):
+def mark_dynamic_batch_size(*tensors):
+    # Lengths are bucketed by the collator, batch size is left dynamic so smaller final batches don't recompile
+    for tensor in tensors:
+        torch._dynamo.maybe_mark_dynamic(tensor, 0)
+
+def get_head_targets(batch, args):
+    # Targets are set on the output head as module attributes, so they need to be marked dynamic like the batch itself
+    targets = get_flat_baseline_head_targets(batch, True)
+    if args.compile:
+        mark_dynamic_batch_size(*targets)
+    return targets
+
+def get_baseline_outputs(model, batch, args):
+    """
+    Run model and return per-KC output vectors for each turn, along with any auxiliary loss and whether outputs are gathered,
+    i.e. only next turn KC predictions (B x L-1 x K) rather than predictions for all KCs at every turn (B x L x K(all))
+    """
+    if args.compile:
+        mark_dynamic_batch_size(*batch.values())
     if args.model_type == "dkt-multi":
-        y = model(batch)
-        return get_baseline_loss(y, batch, args)
+        # Only score the KCs needed for the loss instead of all KCs
+        return model(batch, batch["kc_ids"][:, 1:]), 0, True
     elif args.model_type == "dkt-sem":
-        y = model(batch)
-        return get_baseline_loss(y, batch, args)
+        # Only score the KCs needed for the loss instead of the full KC matrix
+        return model(batch, batch["kc_ids"][:, 1:]), 0, True
     elif args.model_type == "dkt":
-        y = model(batch["kc_ids_flat"], batch["labels_flat"])
-        y = select_flat_baseline_out_vectors(y, batch, False)
-        return get_baseline_loss(y, batch, args)
+        if args.compile:
+            # Call the compiled module, its pykt forward is dkt_forward over all steps, which are already padded to length buckets
+            y = model(batch["kc_ids_flat"], batch["labels_flat"])
+        else:
+            y = dkt_forward(model, batch["kc_ids_flat"], batch["labels_flat"], batch["flat_lens"])
+        return select_flat_baseline_out_vectors(y, batch, False), 0, False
+    # Output heads of remaining models only score next turn KCs at selected positions, view restores KC dim if model squeezed it
     elif args.model_type == "akt":
-        y, rasch_loss = model(batch["kc_ids_flat"], batch["labels_flat"], batch["kc_ids_flat"])
-        y = select_flat_baseline_out_vectors(y, batch, True)
-        loss, corr_probs = get_baseline_loss(y, batch, args)
-        loss += rasch_loss
-        return loss, corr_probs
+        with gather_targets(model.out[6], *get_head_targets(batch, args)):
+            y, rasch_loss = model(batch["kc_ids_flat"], batch["labels_flat"], batch["kc_ids_flat"])
+        return y.view_as(batch["kc_ids"][:, 1:]), rasch_loss, True
     elif args.model_type == "dkvmn":
-        y = model(batch["kc_ids_flat"], batch["labels_flat"])
-        y = select_flat_baseline_out_vectors(y, batch, True)
-        return get_baseline_loss(y, batch, args)
+        with gather_targets(model.p_layer, *get_head_targets(batch, args)):
+            y = model(batch["kc_ids_flat"], batch["labels_flat"])
+        return y.view_as(batch["kc_ids"][:, 1:]), 0, True
     elif args.model_type == "saint":
-        y = model(batch["kc_ids_flat"], batch["kc_ids_flat"], batch["labels_flat"][:, :-1])
-        y = select_flat_baseline_out_vectors(y, batch, True)
-        return get_baseline_loss(y, batch, args)
+        with gather_targets(model.out, *get_head_targets(batch, args)):
+            y = model(batch["kc_ids_flat"], batch["kc_ids_flat"], batch["labels_flat"][:, :-1])
+        return y.view_as(batch["kc_ids"][:, 1:]), 0, True
     elif args.model_type == "simplekt":
-        y = model({
-            "qseqs": batch["kc_ids_flat"][:, :-1],
-            "cseqs": batch["kc_ids_flat"][:, :-1],
-            "rseqs": batch["labels_flat"][:, :-1],
-            "shft_qseqs": batch["kc_ids_flat"][:, 1:],
-            "shft_cseqs": batch["kc_ids_flat"][:, 1:],
-            "shft_rseqs": batch["labels_flat"][:, 1:]
-        })
-        y = select_flat_baseline_out_vectors(y, batch, True)
-        return get_baseline_loss(y, batch, args)
+        with gather_targets(model.out[6], *get_head_targets(batch, args)):
+            y = model({
+                "qseqs": batch["kc_ids_flat"][:, :-1],
+                "cseqs": batch["kc_ids_flat"][:, :-1],
+                "rseqs": batch["labels_flat"][:, :-1],
+                "shft_qseqs": batch["kc_ids_flat"][:, 1:],
+                "shft_cseqs": batch["kc_ids_flat"][:, 1:],
+                "shft_rseqs": batch["labels_flat"][:, 1:]
+            })
+        return y.view_as(batch["kc_ids"][:, 1:]), 0, True
     raise Exception(f"Model {args.model_type} not supported")
 
-def compute_kc_emb_matrix(sbert_model: SentenceTransformer, kc_dict: dict):
-    print("Computing SBERT embeddings...")
+def compute_baseline_loss(model, batch, args, loss_fn=get_baseline_loss):
+    y, aux_loss, gathered = get_baseline_outputs(model, batch, args)
+    if args.compile:
+        # Loss is compiled separately, so model outputs are new inputs to it
+        mark_dynamic_batch_size(y)
+    loss, corr_probs = loss_fn(y, batch, args, gathered)
+    return loss + aux_loss, corr_probs
+
+def get_baseline_fns(model, args):
+    """
+    Returns model and loss function to run baseline batches with, both compiled if requested
+    State dicts should still be taken from the original model, since compiled modules prefix parameter names
+    Compiling is meant for GPU, on CPU the small baselines usually run slower than eager after a long warmup,
+    and the LSTM in DKT family models always runs eagerly between compiled graphs
+    """
+    if not args.compile:
+        return model, get_baseline_loss
+    if device.type == "cpu":
+        print("Warning: compiling on CPU is usually slower than eager for these models, compile is only recommended on GPU")
+    return torch.compile(model), torch.compile(get_baseline_loss)
+
+def compute_kc_emb_matrix(sbert_model: SBERTEmbeddingCache, kc_dict: dict):
     kcs = [kv[0] for kv in sorted(kc_dict.items(), key=lambda kv: kv[1])]
-    kc_emb_matrix = sbert_model.encode(kcs, convert_to_tensor=True)
+    kc_emb_matrix = sbert_model.encode(kcs).to(device)
     return kc_emb_matrix
 
-def train_baseline(args, fold):
-    assert args.model_type in BASELINE_MODELS
-
+def load_baseline_kcs(args):
     # Load KC dictionary and optionally text embeddings
     kc_dict = load_kc_dict(args)
     if args.model_type == "dkt-sem":
-        sbert_model = SentenceTransformer("all-mpnet-base-v2")
+        sbert_model = SBERTEmbeddingCache("all-mpnet-base-v2")
         kc_emb_matrix = compute_kc_emb_matrix(sbert_model, kc_dict)
     else:
         sbert_model = None
         kc_emb_matrix = None
+    return kc_dict, kc_emb_matrix, sbert_model
 
-    # Create model
-    model = get_baseline_model(kc_dict, kc_emb_matrix, args)
-
+def load_baseline_train_data(kc_dict: dict, kc_emb_matrix: torch.Tensor, sbert_model: SBERTEmbeddingCache, args, fold):
     # Load and split dataset, annotated with correctness and KCs
     train_df, val_df, _ = load_annotated_data(args, fold)
     if args.debug:
@@ -523,13 +963,75 @@ def train_baseline(args, fold):
     flatten_kcs = args.model_type not in NON_FLAT_KC_ARCH # Flatten KCs in sequence for architectures that don't support multi-KCs
     train_dataset = DKTDataset(train_df, kc_dict, kc_emb_matrix, sbert_model)
     val_dataset = DKTDataset(val_df, kc_dict, kc_emb_matrix, sbert_model)
-    collator = DKTCollator(flatten_kcs)
-    train_dataloader = get_dataloader(train_dataset, collator, args.batch_size, True)
-    val_dataloader = get_dataloader(val_dataset, collator, args.batch_size, False)
+    val_dataset.subsample(args.val_subsample)
+    collator = DKTCollator(flatten_kcs, args.compile)
+    train_dataloader = get_dataloader(train_dataset, collator, args.batch_size, True, args.batching, args.max_batch_tokens, args.num_workers)
+    val_dataloader = get_dataloader(val_dataset, collator, args.batch_size, False, args.batching, args.max_batch_tokens, args.num_workers)
+    return train_dataloader, val_dataloader
+
+def train_baseline(args, fold, epoch_callback=None):
+    assert args.model_type in BASELINE_MODELS
+
+    # Create model and load data
+    kc_dict, kc_emb_matrix, sbert_model = load_baseline_kcs(args)
+    model = get_baseline_model(kc_dict, kc_emb_matrix, args)
+    train_dataloader, val_dataloader = load_baseline_train_data(kc_dict, kc_emb_matrix, sbert_model, args, fold)
 
     # Do training loop
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.wd)
-    best_val_loss = None
+    model_name = args.model_name + (f"_{fold}" if fold else "")
+    save_best = lambda: torch.save(model.state_dict(), get_checkpoint_path(model_name + ".pt"))
+    run_model, loss_fn = get_baseline_fns(model, args)
+    get_batch_loss = lambda batch: compute_baseline_loss(run_model, batch, args, loss_fn)[0]
+    train_loop(model, optimizer, train_dataloader, val_dataloader, get_batch_loss, save_best, args, epoch_callback,
+               get_checkpoint_path(model_name + "_train_state.pt"))
+
+    return test_baseline(args, fold)
+
+def check_stack_args(args):
+    # Stacked training only validates at the end of each epoch and has no checkpointed or compiled variant,
+    # so refuse these options rather than silently ignoring them
+    unsupported = [f"--{name}" for name in ["val_every_steps", "checkpoint_every_steps", "resume", "compile"] if getattr(args, name, None)]
+    if unsupported:
+        raise Exception(f"{', '.join(unsupported)} not supported with stacked training")
+
+def get_stacked_losses(model: StackedDKT, batch, configs: list):
+    # Loss of each stacked model on batch (M), each with its own config's loss settings
+    y = model(batch)
+    losses = []
+    for model_idx, config_args in enumerate(configs):
+        model_y = y[model_idx] if config_args.model_type in NON_FLAT_KC_ARCH else select_flat_baseline_out_vectors(y[model_idx], batch, False)
+        losses.append(get_baseline_loss(model_y, batch, config_args, False)[0])
+    return torch.stack(losses)
+
+def train_baseline_stacked(configs: list, fold):
+    """
+    Train baseline configs that only differ in learning rate/weight decay as one stacked model in a single forward/backward pass
+    Each config has its own optimizer state, best checkpoint and early stopping, and is then tested on its own
+    """
+    args = configs[0]
+    assert args.model_type in STACKABLE_BASELINES
+    check_stack_args(args)
+    assert all(config_args.emb_size == args.emb_size for config_args in configs)
+
+    # Create models, each initialized as if trained on its own, and load data
+    kc_dict, kc_emb_matrix, sbert_model = load_baseline_kcs(args)
+    models = []
+    for config_args in configs:
+        initialize_seeds(221)
+        models.append(get_baseline_model(kc_dict, kc_emb_matrix, config_args))
+    model = StackedDKT(models).to(device)
+    train_dataloader, val_dataloader = load_baseline_train_data(kc_dict, kc_emb_matrix, sbert_model, args, fold)
+    print(f"Training {len(configs)} stacked {args.model_type} models")
+
+    def save_best(model_idx: int):
+        model_name = configs[model_idx].model_name + (f"_{fold}" if fold else "") + ".pt"
+        torch.save(model.get_state_dict(model_idx), get_checkpoint_path(model_name))
+
+    # Do training loop, models that stop early are frozen by zeroing their learning rate
+    optimizer = StackedAdamW(model.parameters(), [config_args.lr for config_args in configs], [config_args.wd for config_args in configs])
+    early_stoppers = [EarlyStopper(lambda model_idx=model_idx: save_best(model_idx), args.patience) for model_idx in range(len(configs))]
+    active = [True] * len(configs)
     for epoch in range(args.epochs):
         print(f"Epoch {epoch + 1}")
         total_train_loss = 0
@@ -537,42 +1039,39 @@ def train_baseline(args, fold):
 
         model.train()
         for batch_idx, batch in enumerate(tqdm(train_dataloader, desc="Training")):
-            loss, _ = compute_baseline_loss(model, batch, args)
-            total_train_loss += loss.item()
-            loss = loss / args.grad_accum_steps
-            loss.backward()
+            losses = get_stacked_losses(model, batch, configs)
+            total_train_loss += losses.detach()
+            # Models don't share parameters, so backward on the sum gives each model its own gradients
+            (losses.sum() / args.grad_accum_steps).backward()
             if (batch_idx + 1) % args.grad_accum_steps == 0 or batch_idx == len(train_dataloader) - 1:
                 if args.gc:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.gc)
+                    optimizer.clip_grad_norm_(args.gc)
                 optimizer.step()
                 optimizer.zero_grad()
 
         with torch.no_grad():
             model.eval()
             for batch in tqdm(val_dataloader, desc="Validating"):
-                loss, _ = compute_baseline_loss(model, batch, args)
-                total_val_loss += loss.item()
+                total_val_loss += get_stacked_losses(model, batch, configs)
 
-        avg_train_loss = total_train_loss / len(train_dataloader)
-        avg_val_loss = total_val_loss / len(val_dataloader)
-        print(f"Train Loss: {avg_train_loss:.4f}, Val Loss: {avg_val_loss:.4f}")
-        if not best_val_loss or avg_val_loss < best_val_loss:
-            print("Best! Saving model...")
-            model_name = args.model_name + (f"_{fold}" if fold else "") + ".pt"
-            torch.save(model.state_dict(), get_checkpoint_path(model_name))
-            best_val_loss = avg_val_loss
+        avg_train_losses = (total_train_loss / len(train_dataloader)).tolist()
+        avg_val_losses = (total_val_loss / len(val_dataloader)).tolist()
+        for model_idx, config_args in enumerate(configs):
+            if not active[model_idx]:
+                continue
+            print(f"{config_args.model_name} - Train Loss: {avg_train_losses[model_idx]:.4f}, Val Loss: {avg_val_losses[model_idx]:.4f}")
+            if early_stoppers[model_idx].update(avg_val_losses[model_idx]):
+                print(f"No improvement in {args.patience} validations, stopping early")
+                active[model_idx] = False
+                optimizer.lrs[model_idx] = 0
+        if not any(active):
+            break
 
-    return test_baseline(args, fold)
+    return [test_baseline(config_args, fold) for config_args in configs]
 
 def test_baseline(args, fold):
     # Load KC dictionary and optionally text embeddings
-    kc_dict = load_kc_dict(args)
-    if args.model_type == "dkt-sem":
-        sbert_model = SentenceTransformer("all-mpnet-base-v2")
-        kc_emb_matrix = compute_kc_emb_matrix(sbert_model, kc_dict)
-    else:
-        sbert_model = None
-        kc_emb_matrix = None
+    kc_dict, kc_emb_matrix, sbert_model = load_baseline_kcs(args)
 
     # Load trained model
     if args.model_type in BASELINE_MODELS:
@@ -583,48 +1082,67 @@ def test_baseline(args, fold):
     else:
         model = None
 
-    # Load annotated data
+    # Load annotated data and evaluate on each requested split with the same model
     _, val_df, test_df = load_annotated_data(args, fold)
-    if args.testonval:
-        test_df = val_df
-    if args.debug:
-        test_df = test_df[:10]
-        print(test_df.iloc[0])
-    flatten_kcs = args.model_type not in NON_FLAT_KC_ARCH # Flatten KCs in sequence for architectures that don't support multi-KCs
-    test_dataset = DKTDataset(test_df, kc_dict, kc_emb_matrix, sbert_model)
-    collator = DKTCollator(flatten_kcs)
-    test_dataloader = get_dataloader(test_dataset, collator, args.batch_size, False)
+    results = {}
+    for split, split_df in get_eval_splits(args, val_df, test_df):
+        if args.debug:
+            split_df = split_df[:10]
+            print(split_df.iloc[0])
+        flatten_kcs = args.model_type not in NON_FLAT_KC_ARCH # Flatten KCs in sequence for architectures that don't support multi-KCs
+        test_dataset = DKTDataset(split_df, kc_dict, kc_emb_matrix, sbert_model)
+        collator = DKTCollator(flatten_kcs, args.compile)
+        test_dataloader = get_dataloader(test_dataset, collator, args.batch_size, False, num_workers=args.num_workers)
+        results.update(eval_baseline(model, test_dataset, test_dataloader, split, args, fold))
+    return get_eval_results(results)
 
+def eval_baseline(model, test_dataset: DKTDataset, test_dataloader, split: str, args, fold):
     # Collect meta data and predicted KC/correctness probabilities for test set
+    # Model outputs don't depend on aggregation, so correctness probs for all aggregation methods come from the same forward pass
+    aggs = get_eval_aggs(args)
+    agg_args = {agg: get_eval_args(args, split, agg) for agg in aggs}
+    # Predictions are kept on device and only transferred once at the end
     all_labels = []
-    all_preds = []
+    all_preds = {agg: [] for agg in aggs}
     final_turn_labels = []
-    final_turn_preds = []
-    total_loss = 0
+    final_turn_preds = {agg: [] for agg in aggs}
+    total_loss = {agg: 0 for agg in aggs}
+    if model is not None:
+        run_model, loss_fn = get_baseline_fns(model, args)
     for batch in tqdm(test_dataloader):
         labels = batch["labels"][:, 1:]
+        mask = labels != -100
+        final_idxs = mask.sum(dim=1) - 1
         if model is not None:
             with torch.no_grad():
-                loss, corr_probs = compute_baseline_loss(model, batch, args)
+                y, aux_loss, gathered = get_baseline_outputs(run_model, batch, args)
+                agg_outputs = {agg: loss_fn(y, batch, agg_args[agg], gathered) for agg in aggs}
+            agg_outputs = {agg: (loss + aux_loss, corr_probs) for agg, (loss, corr_probs) in agg_outputs.items()}
         elif args.model_type == "random":
             corr_probs = torch.zeros_like(labels).random_(0, 2)
-            loss = torch.tensor(0)
+            agg_outputs = {agg: (torch.tensor(0), corr_probs) for agg in aggs}
         elif args.model_type == "majority":
             corr_probs = torch.full_like(labels, fill_value=test_dataset.majority_class)
-            loss = torch.tensor(0)
-        total_loss += loss.item()
-        mask = labels != -100
-        all_labels.extend(labels[mask].tolist())
-        all_preds.extend(corr_probs[mask].tolist())
-        final_idxs = mask.sum(dim=1) - 1
-        final_turn_labels.extend(labels[torch.arange(mask.shape[0]), final_idxs].tolist())
-        final_turn_preds.extend(corr_probs[torch.arange(mask.shape[0]), final_idxs].tolist())
+            agg_outputs = {agg: (torch.tensor(0), corr_probs) for agg in aggs}
+        for agg, (loss, corr_probs) in agg_outputs.items():
+            total_loss[agg] += loss
+            all_preds[agg].append(corr_probs[mask])
+            final_turn_preds[agg].append(corr_probs[torch.arange(mask.shape[0]), final_idxs])
+        all_labels.append(labels[mask])
+        final_turn_labels.append(labels[torch.arange(mask.shape[0]), final_idxs])
+    all_labels = torch.concat(all_labels).tolist()
+    final_turn_labels = torch.concat(final_turn_labels).tolist()
 
     # Compute quantitative metrics across all turns and only on final turns
-    loss = total_loss / len(test_dataloader)
-    all_metrics, final_metrics = compute_all_metrics(loss, all_labels, all_preds, final_turn_labels, final_turn_preds, args, fold)
-
-    return np.array([loss, *all_metrics, *final_metrics])
+    results = {}
+    for agg in aggs:
+        loss = float(total_loss[agg]) / len(test_dataloader)
+        all_metrics, final_metrics = compute_all_metrics(
+            loss, all_labels, torch.concat(all_preds[agg]).tolist(), final_turn_labels, torch.concat(final_turn_preds[agg]).tolist(),
+            agg_args[agg], fold
+        )
+        results[(split, agg)] = np.array([loss, *all_metrics, *final_metrics])
+    return results
 
 def bkt_prep_data(df: pd.DataFrame, kc_dict: dict):
     dataset = DKTDataset(df, kc_dict, None, None)
@@ -1,4 +1,6 @@
+import os
 import random
+import threading
 import numpy as np
 import torch
 
@@ -20,3 +22,58 @@ def bool_type(x: str):
 
 def get_checkpoint_path(model_name: str):
     return f"saved_models/{model_name}"
+
+def get_rng_state():
+    return {
+        "random": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    }
+
+def set_rng_state(state: dict):
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None:
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def copy_to_cpu(obj):
+    # Recursively copy tensors in nested state dicts to CPU, so training can keep modifying the originals
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: copy_to_cpu(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(val) for val in obj)
+    return obj
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints with torch.save on a background thread so training isn't blocked by disk writes
+    State is copied to CPU before returning, and files are written to a temp path and renamed so a crash never leaves a partial file
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def write(self, state: dict, path: str):
+        try:
+            torch.save(state, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except Exception as error:
+            self.error = error
+
+    def save(self, state: dict, path: str):
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(copy_to_cpu(state), path))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error